@@ -20,16 +20,24 @@
 # https://www.nationalpooling.com/reports/region/AllBlocksAugmentedReport.zip
 
 import argparse
+import concurrent.futures
 import csv
 import constants
 import datetime
+import hashlib
 import json
 import logging
 import os
 import re
+import shutil
 import sqlite3
+import sys
+import time
 import uuid
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import phone2geo_build
+
 parser = argparse.ArgumentParser(description='''Imports the NANPA NPA database,
   the NANPA Central Office Code Assignment Records, and the National Pooling
   Administrator's Augmented Block Report for all states into a SQLite3 database
@@ -38,6 +46,10 @@ parser.add_argument('-o', '--output', dest='output_path',
   default='../carrier_meta.sqlite3', type=str, help='''The path to which the
   imported database will be written. Any file at the path provided will be
   overwritten.''')
+parser.add_argument('--index-output', dest='index_output_path',
+  default='../carrier_meta.idx', type=str, help='''The path to which the
+  compiled lookup index derived from the imported database will be written.
+  Any file at the path provided will be overwritten.''')
 parser.add_argument('--npa', dest='npa_report_path',
   default=constants.DEFAULT_NPA_REPORT_PATH, type=str, help='''The path at which
   the NPA Database to import is located.''')
@@ -53,83 +65,374 @@ parser.add_argument('--manifest-out', dest='import_manifest_path',
 parser.add_argument('--prev-manifest', dest='prev_import_manifest_path',
   default=constants.DEFAULT_IMPORT_MANIFEST_PATH, type=str, help='''The path at
   which the most recent import manifest may be found.''')
+parser.add_argument('--incremental', action='store_true', help='''Patch a copy
+  of the database at the output path rather than rebuilding it. Reports whose
+  content hash matches the previous import are skipped, and the rows of any
+  other report are diffed against the existing table. Falls back to a full
+  import when there is no previous import, the database at the output path was
+  not produced by it, or a report's columns changed.''')
+
+# Secondary indexes created once all reports have been loaded, as (index name,
+# table, columns). Point lookups by locate_number are served by the clustered
+# primary keys of the WITHOUT ROWID tables, so only access paths that filter on
+# other columns need to be listed here.
+SECONDARY_INDEXES = [
+  # Reverse lookups (find_ranges) by each attribute of the resolution table
+  ('resolution_region', 'resolution', ['region']),
+  ('resolution_rate_center', 'resolution', ['rate_center']),
+  ('resolution_operating_company_number', 'resolution', ['operating_company_number']),
+  ('resolution_carrier', 'resolution', ['carrier']),
+]
+
+
+def parse_report(path, delimiter=',', has_file_date=False):
+  """Parse a report into its sanitized header and a list of rows padded or
+  truncated to the width of the header. Runs in a worker process so that the
+  reports can be parsed in parallel."""
+
+  started = time.perf_counter()
+  file_date = None
+  with open(path, 'r', newline='') as report:
+    if has_file_date:
+      # The first line reports the date the file was generated
+      # E.g., "File Date,03/01/2020"
+      (_, file_date) = next(report).split(',')
+      file_date = file_date.strip()
+
+    reader = csv.reader(report, delimiter=delimiter)
+    headers = [re.sub('\\W', '_', col.strip()) for col in next(reader)]
+    width = len(headers)
+    padding = (None,) * width
+    rows = [
+      tuple(col.strip() for col in row[:width]) + padding[len(row):]
+      for row in reader
+    ]
+
+  return {
+    'headers': headers,
+    'rows': rows,
+    'fileDate': file_date,
+    'parseSeconds': time.perf_counter() - started,
+  }
+
+
+def hash_file(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as report:
+    for chunk in iter(lambda: report.read(1024 * 1024), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def read_headers(path, delimiter=',', has_file_date=False):
+  """Read only the sanitized header of a report"""
+
+  with open(path, 'r', newline='') as report:
+    if has_file_date:
+      next(report)
+    return [
+      re.sub('\\W', '_', col.strip())
+      for col in next(csv.reader(report, delimiter=delimiter))
+    ]
+
 
-args = parser.parse_args()
+def apply_report_diff(carrier_meta, table_name, primary_key_columns, report):
+  """Patch an existing table so that it matches a parsed report, touching only
+  rows that were added, changed, or removed. Returns the primary keys of the
+  rows inserted, updated, and deleted.
 
-import_manifest = {}
-prev_manifest = {}
+  Rows are written with the same plain INSERT as load_report, so a report
+  that a full import would reject (e.g. one repeating a primary key) raises
+  the same sqlite3.IntegrityError here rather than keeping one of the rows."""
 
-print(f"Attempting to load previous manifest from {os.path.abspath(args.prev_import_manifest_path)}")
-try:
-  with open(args.prev_import_manifest_path, 'r') as prev_manifest_file:
-    prev_manifest = json.load(prev_manifest_file)
-except OSError as err:
-  print(f"Manifest could not be loaded from {args.prev_import_manifest_path}; proceeding with fresh import")
+  started = time.perf_counter()
+  headers = report['headers']
+  key_names = [re.sub('\\W', '_', col) for col in primary_key_columns]
+  key_positions = [headers.index(col) for col in key_names]
+  cols = ', '.join(headers)
 
-# Initialize the new manifest
-import_manifest['importDate'] = datetime.datetime.utcnow().isoformat()
-import_manifest['importId'] = str(uuid.uuid4())
-import_manifest['tablesImported'] = {}
+  def key_of(row):
+    return tuple(row[position] for position in key_positions)
 
-# Create an SQLite3 DB into which carrier metadata will be imported at a
-# temporary path
-temporary_db_path = args.output_path + '.' + import_manifest['importId']
-carrier_meta = sqlite3.connect(temporary_db_path)
+  existing = {
+    key_of(row): row
+    for row in carrier_meta.execute(f"SELECT {cols} FROM {table_name}")
+  }
 
-def import_report(fd, table_name, primary_key_columns, delimiter=','):
-  reader = csv.reader(fd, delimiter=delimiter)
+  inserted = []
+  updated = []
+  seen = set()
+  for row in report['rows']:
+    key = key_of(row)
+    if key in seen:
+      raise sqlite3.IntegrityError(
+        f"UNIQUE constraint failed: {', '.join(f'{table_name}.{col}' for col in key_names)}")
+    seen.add(key)
+    previous = existing.get(key)
+    if previous is None:
+      inserted.append(row)
+    elif previous != row:
+      updated.append(row)
+  deleted = [key for key in existing if key not in seen]
+
+  # Updated rows are deleted and inserted again rather than replaced, so that
+  # rows are only ever written by the statement the full import uses
   with carrier_meta:
-    headers = [re.sub('\\W', '_', col.strip()) for col in next(reader)]
-    import_manifest['tablesImported'][table_name] = headers
+    carrier_meta.executemany(
+      f"DELETE FROM {table_name} WHERE {' AND '.join(col + ' = ?' for col in key_names)}",
+      deleted + [key_of(row) for row in updated])
+    carrier_meta.executemany(
+      f"INSERT INTO {table_name} ({cols}) VALUES ({', '.join(['?'] * len(headers))})",
+      inserted + updated)
+
+  def describe(keys):
+    return ['-'.join(key) for key in keys]
+
+  return {
+    'inserted': describe(key_of(row) for row in inserted),
+    'updated': describe(key_of(row) for row in updated),
+    'deleted': describe(deleted),
+  }, time.perf_counter() - started
+
+
+def read_import_id(db_path):
+  """Read the importId recorded in a database built by this script, if any"""
+
+  conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+  try:
+    row = conn.execute(
+      "SELECT value FROM import_info WHERE key = 'importId'").fetchone()
+    return row[0] if row is not None else None
+  except sqlite3.Error:
+    return None
+  finally:
+    conn.close()
 
-    cols = ', '.join(headers)
-    key_cols = ', '.join([re.sub('\\W', '_', col) for col in primary_key_columns])
+
+def load_report(carrier_meta, table_name, primary_key_columns, report):
+  """Create a table for a parsed report and bulk insert its rows with a single
+  prepared statement inside one transaction"""
+
+  started = time.perf_counter()
+  headers = report['headers']
+  cols = ', '.join(headers)
+  key_cols = ', '.join([re.sub('\\W', '_', col) for col in primary_key_columns])
+  placeholders = ', '.join(['?'] * len(headers))
+  with carrier_meta:
     carrier_meta.execute(f"CREATE TABLE {table_name} ({cols}, PRIMARY KEY({key_cols})) WITHOUT ROWID")
-    for row in reader:
-      value_count = min(len(row), len(headers))
-      carrier_meta.execute(
-        f"INSERT INTO {table_name} ({', '.join(headers[:value_count])}) VALUES ({', '.join(['?' for x in range(0, value_count)])})",
-        [col.strip() for col in row[:value_count]]
-      )
-
-print(f'Importing NPA database from {os.path.abspath(args.npa_report_path)}')
-with open(args.npa_report_path, 'r') as npa_report:
-  # The first line reports the date the file was generated
-  # E.g., "File Date,03/01/2020"
-  (_, date_generated) = next(npa_report).split(',')
-  print(f'Importing NPA database generated on {date_generated.strip()}')
-
-  # The rest of the file is a standard CSV file
-  import_report(npa_report, 'npa', ['NPA_ID'])
-
-print(f'Importing Central Office Code assignment records from {os.path.abspath(args.npanxx_report_path)}')
-with open(args.npanxx_report_path, 'r') as nxx_report:
-  import_report(nxx_report, 'npa_nxx', ['NPA-NXX'], delimiter="\t")
-
-print(f'Importing pooling block assignment records from {os.path.abspath(args.block_report_path)}')
-with open(args.block_report_path, 'r') as block_report:
-  import_report(block_report, 'blocks', ['NPA', 'NXX', 'X'])
-
-carrier_meta.close()
-
-try:
-  os.replace(temporary_db_path, args.output_path)
-except OSError as err:
-  logging.error(err)
-  os.remove(temporary_db_path)
-
-for table, columns in import_manifest['tablesImported'].items():
-  prev_columns = prev_manifest.get('tablesImported', {}).get(table, [])
-  if sorted(columns) != sorted(prev_columns):
-    columns_added = [col for col in columns if col not in prev_columns]
-    columns_removed = [col for col in prev_columns if col not in columns]
-    print(f"WARNING: The structure of {table} does not match the last import.")
-    if len(columns_added) > 0:
-      print(f"         The following columns have been added: {', '.join(columns_added)}")
-    if len(columns_removed) > 0:
-      print(f"         The following columns have been removed: {', '.join(columns_removed)}")
-    print(f"         Any code reading from {table} may need to be adjusted to account for these changes")
-    print("")
-
-with open(args.import_manifest_path, 'w') as import_manifest_file:
-  json.dump(import_manifest, import_manifest_file, indent='  ')
+    carrier_meta.executemany(
+      f"INSERT INTO {table_name} ({cols}) VALUES ({placeholders})",
+      report['rows'])
+
+  return time.perf_counter() - started
+
+
+def timed(step, timings, key):
+  started = time.perf_counter()
+  step()
+  timings[key] = round(time.perf_counter() - started, 3)
+
+
+def main(argv=None):
+  args = parser.parse_args(argv)
+  build_started = time.perf_counter()
+
+  import_manifest = {}
+  prev_manifest = {}
+
+  print(f"Attempting to load previous manifest from {os.path.abspath(args.prev_import_manifest_path)}")
+  try:
+    with open(args.prev_import_manifest_path, 'r') as prev_manifest_file:
+      prev_manifest = json.load(prev_manifest_file)
+  except OSError as err:
+    print(f"Manifest could not be loaded from {args.prev_import_manifest_path}; proceeding with fresh import")
+
+  # Initialize the new manifest
+  import_manifest['importDate'] = datetime.datetime.utcnow().isoformat()
+  import_manifest['importId'] = str(uuid.uuid4())
+  import_manifest['tablesImported'] = {}
+  timings = {'tables': {}}
+  import_manifest['importTimings'] = timings
+  if 'downloads' in prev_manifest:
+    # Written by refresh_assets.py
+    import_manifest['downloads'] = prev_manifest['downloads']
+
+  reports = {
+    'npa': (args.npa_report_path, ',', True, ['NPA_ID'], 'NPA database'),
+    'npa_nxx': (args.npanxx_report_path, '\t', False, ['NPA-NXX'], 'Central Office Code assignment records'),
+    'blocks': (args.block_report_path, ',', False, ['NPA', 'NXX', 'X'], 'pooling block assignment records'),
+  }
+  import_manifest['sources'] = {
+    table_name: {'path': os.path.abspath(path), 'sha256': hash_file(path)}
+    for table_name, (path, *_) in reports.items()
+  }
+
+  incremental = args.incremental
+  if incremental and not os.path.exists(args.output_path):
+    print(f"No database found at {args.output_path}; proceeding with full import")
+    incremental = False
+  if incremental and read_import_id(args.output_path) != prev_manifest.get('importId'):
+    # Reports are diffed against, and unchanged reports skipped on the strength
+    # of, the database the previous manifest describes
+    print(f"The database at {args.output_path} was not produced by the previous import; proceeding with full import")
+    incremental = False
+  if incremental:
+    for table_name, (path, delimiter, has_file_date, *_) in reports.items():
+      prev_columns = prev_manifest.get('tablesImported', {}).get(table_name)
+      if read_headers(path, delimiter, has_file_date) != prev_columns:
+        print(f"The columns of {table_name} changed since the last import; proceeding with full import")
+        incremental = False
+        break
+
+  to_import = list(reports)
+  if incremental:
+    prev_sources = prev_manifest.get('sources', {})
+    to_import = [
+      table_name for table_name in reports
+      if import_manifest['sources'][table_name]['sha256'] != prev_sources.get(table_name, {}).get('sha256')
+    ]
+    for table_name in reports:
+      import_manifest['tablesImported'][table_name] = prev_manifest['tablesImported'][table_name]
+      if table_name not in to_import:
+        print(f"Skipping unchanged {reports[table_name][4]}")
+  import_manifest['importMode'] = 'incremental' if incremental else 'full'
+
+  # Create an SQLite3 DB into which carrier metadata will be imported at a
+  # temporary path. Incremental imports start from a copy of the live database,
+  # which is never modified in place. Nothing reads the file until it is moved
+  # into place, so crash safety is traded for speed: a failed import is simply
+  # rerun.
+  temporary_db_path = args.output_path + '.' + import_manifest['importId']
+  if incremental:
+    shutil.copyfile(args.output_path, temporary_db_path)
+  carrier_meta = sqlite3.connect(temporary_db_path)
+  carrier_meta.execute('PRAGMA journal_mode = OFF')
+  carrier_meta.execute('PRAGMA synchronous = OFF')
+  carrier_meta.execute('PRAGMA locking_mode = EXCLUSIVE')
+  carrier_meta.execute('PRAGMA cache_size = -262144')
+
+  # Parse the reports in parallel, loading each into the database as soon as it
+  # has been parsed. Manifest entries keep the order reports are listed.
+  if not incremental:
+    import_manifest['tablesImported'] = dict.fromkeys(reports)
+  else:
+    import_manifest['changes'] = {}
+  timings['tables'] = dict.fromkeys(to_import)
+  try:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(len(to_import), 1)) as executor:
+      futures = {}
+      for table_name in to_import:
+        (path, delimiter, has_file_date, _, description) = reports[table_name]
+        print(f'Importing {description} from {os.path.abspath(path)}')
+        futures[executor.submit(parse_report, path, delimiter, has_file_date)] = table_name
+
+      for future in concurrent.futures.as_completed(futures):
+        table_name = futures[future]
+        report = future.result()
+        if report['fileDate'] is not None:
+          print(f"Importing {reports[table_name][4]} generated on {report['fileDate']}")
+
+        import_manifest['tablesImported'][table_name] = report['headers']
+        if incremental:
+          changes, load_seconds = apply_report_diff(
+            carrier_meta, table_name, reports[table_name][3], report)
+          import_manifest['changes'][table_name] = changes
+        else:
+          load_seconds = load_report(
+            carrier_meta, table_name, reports[table_name][3], report)
+        timings['tables'][table_name] = {
+          'rows': len(report['rows']),
+          'parseSeconds': round(report['parseSeconds'], 3),
+          'loadSeconds': round(load_seconds, 3),
+        }
+  except BaseException:
+    # A report that failed to parse or load (in a worker process or here)
+    # leaves nothing behind; the import is simply rerun
+    carrier_meta.close()
+    os.remove(temporary_db_path)
+    raise
+
+  # Record which import produced the database, so that long-lived readers can
+  # tell which snapshot served a lookup
+  with carrier_meta:
+    carrier_meta.execute('DROP TABLE IF EXISTS import_info')
+    carrier_meta.execute('CREATE TABLE import_info (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+    carrier_meta.executemany(
+      'INSERT INTO import_info (key, value) VALUES (?, ?)',
+      [(key, import_manifest[key]) for key in ('importId', 'importDate', 'importMode')])
+
+  # The materialized resolution table is derived from all three reports, so it
+  # is rebuilt in full whenever any of them changed, including incremental
+  # imports
+  print('Materializing the resolution table')
+  timed(
+    lambda: phone2geo_build.write_resolution_table(carrier_meta),
+    timings,
+    'resolutionSeconds')
+
+  def create_indexes():
+    with carrier_meta:
+      for index_name, table_name, columns in SECONDARY_INDEXES:
+        carrier_meta.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({', '.join(columns)})")
+
+  timed(create_indexes, timings, 'indexSeconds')
+  timed(lambda: carrier_meta.execute('ANALYZE'), timings, 'analyzeSeconds')
+  timed(lambda: carrier_meta.execute('VACUUM'), timings, 'vacuumSeconds')
+  carrier_meta.close()
+
+  print('Validating the resolution table against the NPA, NXX, and block tables')
+  try:
+    timed(
+      lambda: phone2geo_build.validate_resolution_table(temporary_db_path),
+      timings,
+      'validateSeconds')
+  except ValueError:
+    os.remove(temporary_db_path)
+    raise
+
+  print(f'Compiling lookup index to {os.path.abspath(args.index_output_path)}')
+  temporary_index_path = args.index_output_path + '.' + import_manifest['importId']
+  timed(
+    lambda: phone2geo_build.write_compiled_index(temporary_db_path, temporary_index_path),
+    timings,
+    'compileIndexSeconds')
+
+  try:
+    os.replace(temporary_db_path, args.output_path)
+    os.replace(temporary_index_path, args.index_output_path)
+  except OSError as err:
+    logging.error(err)
+    for path in (temporary_db_path, temporary_index_path):
+      if os.path.exists(path):
+        os.remove(path)
+
+  timings['totalSeconds'] = round(time.perf_counter() - build_started, 3)
+
+  print('')
+  for table, table_timings in timings['tables'].items():
+    print(f"{table}: {table_timings['rows']} rows parsed in {table_timings['parseSeconds']}s and loaded in {table_timings['loadSeconds']}s")
+  for table, changes in import_manifest.get('changes', {}).items():
+    print(f"{table}: {len(changes['inserted'])} inserted, {len(changes['updated'])} updated, {len(changes['deleted'])} deleted")
+  for step in ('resolutionSeconds', 'indexSeconds', 'analyzeSeconds', 'vacuumSeconds', 'validateSeconds', 'compileIndexSeconds', 'totalSeconds'):
+    print(f"{step}: {timings[step]}s")
+  print('')
+
+  for table, columns in import_manifest['tablesImported'].items():
+    prev_columns = prev_manifest.get('tablesImported', {}).get(table, [])
+    if sorted(columns) != sorted(prev_columns):
+      columns_added = [col for col in columns if col not in prev_columns]
+      columns_removed = [col for col in prev_columns if col not in columns]
+      print(f"WARNING: The structure of {table} does not match the last import.")
+      if len(columns_added) > 0:
+        print(f"         The following columns have been added: {', '.join(columns_added)}")
+      if len(columns_removed) > 0:
+        print(f"         The following columns have been removed: {', '.join(columns_removed)}")
+      print(f"         Any code reading from {table} may need to be adjusted to account for these changes")
+      print("")
+
+  with open(args.import_manifest_path, 'w') as import_manifest_file:
+    json.dump(import_manifest, import_manifest_file, indent='  ')
+
+
+if __name__ == '__main__':
+  main()
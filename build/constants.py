@@ -4,3 +4,7 @@ DEFAULT_NPA_REPORT_PATH = os.path.join(os.path.dirname(__file__), 'npa_report.cs
 DEFAULT_NXX_LISTING_PATH = os.path.join(os.path.dirname(__file__), 'allutlzd.tsv')
 DEFAULT_BLOCKS_LISTING_PATH = os.path.join(os.path.dirname(__file__), 'AllBlocksAugmentedReport.csv')
 DEFAULT_IMPORT_MANIFEST_PATH = os.path.join(os.path.dirname(__file__), 'import_manifest.json')
+
+NPA_REPORT_URL = 'https://www.nationalnanpa.com/nanp1/npa_report.csv'
+NXX_LISTING_URL = 'https://www.nationalnanpa.com/nanp1/allutlzd.zip'
+BLOCKS_LISTING_URL = 'https://www.nationalpooling.com/reports/region/AllBlocksAugmentedReport.zip'
@@ -2,21 +2,12 @@
 # Numbering Plan Administrator) and one published the National Pooling
 # Administrator. All reports were freely downloadable by the public as of 28
 # February 2020.
-
-import constants
-import tempfile
-import urllib.request
-import zipfile
-
+#
 # The first, the NPA Database, contains the complete listing of NPA (area code)
 # assignments of all countries within the North American Numbering Plan as well
 # as the geography and intended usage associated with a given NPA. It can be
 # downloaded from https://www.nationalnanpa.com/nanp1/npa_report.csv
-npa_database_response = urllib.request.urlopen('https://www.nationalnanpa.com/nanp1/npa_report.csv')
-
-with open(constants.DEFAULT_NPA_REPORT_PATH, 'wb') as outfile:
-  outfile.write(npa_database_response.read())
-
+#
 # The second, Central Office Code Assignment Records, contains a listing of
 # NPA-NXX (area code + three digit exchange prefix) allocations and the
 # rate center and carrier with which an exchange is associated. In the case of a
@@ -24,30 +15,155 @@ with open(constants.DEFAULT_NPA_REPORT_PATH, 'wb') as outfile:
 # numbers within the exchange. It can be downloaded in zip archive form from
 # https://www.nationalnanpa.com/nanp1/allutlzd.zip. The relevant file will be at
 # the top level of the archive with the name allutlzd.txt
-nxx_listing_response = urllib.request.urlopen('https://www.nationalnanpa.com/nanp1/allutlzd.zip')
-
-with tempfile.TemporaryFile() as tmp:
-  tmp.write(nxx_listing_response.read())
-  tmp.seek(0)
-
-  with zipfile.ZipFile(tmp) as archive:
-    with archive.open('allutlzd.txt') as nxx_listing:
-      with open(constants.DEFAULT_NXX_LISTING_PATH, 'wb') as outfile:
-        outfile.write(nxx_listing.read())
-
+#
 # The third report, Block Report by Region, details the assignment of individual
 # thousands blocks within pooled exchanges. It can be downloaded in archive form
 # from
 # https://www.nationalpooling.com/reports/region/AllBlocksAugmentedReport.zip.
 # The relevant file will be at the top level of the archive with the name
 # AllBlocksAugmentedReport.txt
-blocks_listing_response = urllib.request.urlopen('https://www.nationalpooling.com/reports/region/AllBlocksAugmentedReport.zip')
+#
+# Downloads are streamed to disk rather than held in memory. The ETag,
+# Last-Modified date, and SHA-256 digest of each report are recorded in the
+# import manifest so that later refreshes can make conditional requests and
+# leave unchanged reports untouched.
+
+import argparse
+import constants
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+import zipfile
+
+# Bytes copied at a time while streaming downloads and archive members
+CHUNK_SIZE = 1024 * 1024
+
+parser = argparse.ArgumentParser(description='''Downloads the latest NANPA and
+  National Pooling Administrator reports consumed by build_npa_db.py, skipping
+  any report that has not changed since the last refresh.''')
+parser.add_argument('--npa-url', default=constants.NPA_REPORT_URL, type=str,
+  help='''The URL of the NPA Database report.''')
+parser.add_argument('--nxx-url', default=constants.NXX_LISTING_URL, type=str,
+  help='''The URL of the zipped Central Office Code assignment records.''')
+parser.add_argument('--blocks-url', default=constants.BLOCKS_LISTING_URL,
+  type=str, help='''The URL of the zipped Augmented Block report.''')
+parser.add_argument('--npa', dest='npa_report_path',
+  default=constants.DEFAULT_NPA_REPORT_PATH, type=str, help='''The path to
+  which the NPA Database will be written.''')
+parser.add_argument('--nxx', dest='npanxx_report_path',
+  default=constants.DEFAULT_NXX_LISTING_PATH, type=str, help='''The path to
+  which the NPA-NXX report will be written.''')
+parser.add_argument('--blocks', dest='block_report_path',
+  default=constants.DEFAULT_BLOCKS_LISTING_PATH, type=str, help='''The path to
+  which the Augmented Block report will be written.''')
+parser.add_argument('--manifest', dest='import_manifest_path',
+  default=constants.DEFAULT_IMPORT_MANIFEST_PATH, type=str, help='''The import
+  manifest in which download metadata is recorded.''')
+parser.add_argument('--force', action='store_true', help='''Download every
+  report unconditionally.''')
+
+
+def copy_and_hash(source, destination, digest):
+  """Stream source into destination, updating digest along the way"""
+
+  while True:
+    chunk = source.read(CHUNK_SIZE)
+    if not chunk:
+      return
+    digest.update(chunk)
+    destination.write(chunk)
+
+
+def fetch_report(url, destination_path, archive_member=None, previous=None):
+  """Download a report to destination_path, extracting archive_member if the
+  report is zipped. Returns the download metadata to record in the manifest,
+  including whether the report changed since the previous download."""
+
+  previous = previous or {}
+  checked_at = datetime.datetime.utcnow().isoformat()
+  request = urllib.request.Request(url)
+  if os.path.exists(destination_path):
+    if previous.get('etag'):
+      request.add_header('If-None-Match', previous['etag'])
+    if previous.get('lastModified'):
+      request.add_header('If-Modified-Since', previous['lastModified'])
+
+  try:
+    response = urllib.request.urlopen(request)
+  except urllib.error.HTTPError as err:
+    if err.code == 304:
+      return {**previous, 'checkedAt': checked_at, 'changed': False}
+    raise
+
+  digest = hashlib.sha256()
+  temporary_path = f"{destination_path}.download"
+  with response:
+    with open(temporary_path, 'wb') as outfile:
+      if archive_member is None:
+        copy_and_hash(response, outfile, digest)
+      else:
+        # Zip archives can only be read from a seekable file
+        with tempfile.TemporaryFile() as archive_file:
+          shutil.copyfileobj(response, archive_file, CHUNK_SIZE)
+          archive_file.seek(0)
+          with zipfile.ZipFile(archive_file) as archive:
+            with archive.open(archive_member) as report:
+              copy_and_hash(report, outfile, digest)
+
+    metadata = {
+      'url': url,
+      'etag': response.headers.get('ETag'),
+      'lastModified': response.headers.get('Last-Modified'),
+      'sha256': digest.hexdigest(),
+      'checkedAt': checked_at,
+    }
+
+  # A full download can still carry identical content, in which case the
+  # existing file is left alone
+  changed = (
+    metadata['sha256'] != previous.get('sha256')
+    or not os.path.exists(destination_path))
+  if changed:
+    os.replace(temporary_path, destination_path)
+  else:
+    os.remove(temporary_path)
+
+  return {**metadata, 'changed': changed}
+
+
+def main():
+  args = parser.parse_args()
+
+  manifest = {}
+  try:
+    with open(args.import_manifest_path, 'r') as manifest_file:
+      manifest = json.load(manifest_file)
+  except OSError:
+    print(f"Manifest could not be loaded from {args.import_manifest_path}; downloading all reports")
+
+  downloads = manifest.get('downloads', {})
+  reports = {
+    'npa': (args.npa_url, args.npa_report_path, None),
+    'npa_nxx': (args.nxx_url, args.npanxx_report_path, 'allutlzd.txt'),
+    'blocks': (args.blocks_url, args.block_report_path, 'AllBlocksAugmentedReport.txt'),
+  }
+
+  for name, (url, path, archive_member) in reports.items():
+    print(f"Fetching {url}")
+    previous = {} if args.force else downloads.get(name, {})
+    downloads[name] = fetch_report(url, path, archive_member, previous)
+    state = 'updated' if downloads[name]['changed'] else 'unchanged'
+    print(f"  {os.path.abspath(path)} {state}")
+
+  manifest['downloads'] = downloads
+  with open(args.import_manifest_path, 'w') as manifest_file:
+    json.dump(manifest, manifest_file, indent='  ')
 
-with tempfile.TemporaryFile() as tmp:
-  tmp.write(blocks_listing_response.read())
-  tmp.seek(0)
 
-  with zipfile.ZipFile(tmp) as archive:
-    with archive.open('AllBlocksAugmentedReport.txt') as nxx_listing:
-      with open(constants.DEFAULT_BLOCKS_LISTING_PATH, 'wb') as outfile:
-        outfile.write(nxx_listing.read())
+if __name__ == '__main__':
+  main()
@@ -1,14 +1,79 @@
+import abc
+import array
+import bisect
+import collections
 import contextlib
 import dataclasses
+import enum
+import itertools
+import mmap
 import os
+import pathlib
 import re
 import sqlite3
+import struct
+import sys
+import threading
+import time
 import typing
 
 PHONE_NUMBER_PATTERN = re.compile(r"^[2-9]\d{9}$")
 
+# The number of inputs resolved per SQL round-trip by the batch lookup API
+DEFAULT_BATCH_SIZE = 5000
+
+DEFAULT_DB_PATH = os.path.join(
+  os.path.dirname(os.path.abspath(__file__)),
+  'carrier_meta.sqlite3'
+)
+DEFAULT_INDEX_PATH = os.path.join(
+  os.path.dirname(os.path.abspath(__file__)),
+  'carrier_meta.idx'
+)
+
+# Tuning applied to every read-only SQLite connection. The database is small
+# enough that mapping it in full lets SQLite skip read() calls entirely.
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_SIZE_KIB = 16 * 1024
+
+# Default capacities of the SQLite backend's row caches. Every NPA fits in the
+# NPA cache; the others are sized for skewed traffic on hot exchanges.
+DEFAULT_NPA_CACHE_SIZE = 1000
+DEFAULT_NXX_CACHE_SIZE = 8192
+DEFAULT_BLOCK_CACHE_SIZE = 32768
+DEFAULT_RESOLUTION_CACHE_SIZE = 32768
+
+# How often, in seconds, the SQLite backend checks whether the database file
+# has been replaced
+DEFAULT_REPLACEMENT_CHECK_INTERVAL = 1.0
+
+# How often, in seconds, a reloading locator's background thread checks for a
+# new database snapshot, and how many recently looked up numbers it replays
+# against a new snapshot to warm its caches before swapping it in
+DEFAULT_RELOAD_CHECK_INTERVAL = 5.0
+DEFAULT_RELOAD_WARM_SIZE = 10000
+
+# The upper bounds, in seconds, of the buckets of each stage's latency histogram
+# when lookups are instrumented
+DEFAULT_LATENCY_BUCKETS = (
+  1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+  5e-3, 1e-2, float('inf'))
+
+# Backends accepted by number_locator
+SQLITE_BACKEND = 'sqlite'
+COMPILED_BACKEND = 'compiled'
+
 @dataclasses.dataclass(frozen=True)
 class MetadataRecord:
+  """The metadata located for a single number. Records are slotted rather than
+  given a per-instance __dict__, and the backends intern every field but the
+  phone number, so that large result sets share a single copy of each country,
+  time zone, region, rate center, OCN, and carrier string."""
+
+  __slots__ = (
+    'phone_number', 'country', 'time_zone', 'region', 'rate_center',
+    'operating_company_number', 'carrier')
+
   phone_number: str
   country: typing.Optional[str]
   time_zone: typing.Optional[str]
@@ -17,6 +82,43 @@ class MetadataRecord:
   operating_company_number: typing.Optional[str]
   carrier: typing.Optional[str]
 
+  # Frozen instances reject setattr, which the default pickling of slotted
+  # objects relies on, so state is saved and restored explicitly
+  def __getstate__(self):
+    return tuple(getattr(self, name) for name in self.__slots__)
+
+  def __setstate__(self, state):
+    phone_number, *fields = state
+    object.__setattr__(self, 'phone_number', phone_number)
+    for name, value in zip(self.__slots__[1:], fields):
+      object.__setattr__(self, name, _intern(value))
+
+
+def _intern(value: typing.Optional[str]) -> typing.Optional[str]:
+  return sys.intern(value) if value is not None else None
+
+
+def _interned_row(row: tuple) -> tuple:
+  return tuple(sys.intern(value) if type(value) is str else value for value in row)
+
+
+def _record(number: str, *fields: typing.Optional[str]) -> MetadataRecord:
+  """Build a record whose metadata fields are interned"""
+
+  return MetadataRecord(number, *map(_intern, fields))
+
+
+class LookupStatus(enum.IntEnum):
+  """The outcome of a lookup, for APIs that report failures as values rather
+  than raising. Each failure corresponds to one of the exceptions raised by
+  locate_number."""
+
+  OK = 0
+  INVALID_NUMBER = 1 # InvalidNumberError
+  INVALID_AREA_CODE = 2 # InvalidAreaCodeError
+  AREA_CODE_NOT_FOUND = 3 # AreaCodeNotFoundError
+  INVALID_EXCHANGE = 4 # InvalidExchangeError
+
 
 class InvalidNumberError(Exception):
   f"""An error raised when the number provided does not match the expected
@@ -60,176 +162,1765 @@ class InvalidExchangeError(Exception):
     self.exchange = exchange
 
 
-class __MetadataRepository:
-  """An interface into the carrier metadata database. Because SQLite uses
-  stateful connections and cursors, this class is designed to be used as a
-  context manager."""
+@dataclasses.dataclass(frozen=True)
+class LookupResult:
+  """The outcome of a non-raising lookup. The record is only set when the
+  status is OK; otherwise error holds the exception locate_number would have
+  raised."""
 
-  def __init__(self, db_path):
+  status: LookupStatus
+  record: typing.Optional[MetadataRecord] = None
+  error: typing.Optional[Exception] = None
+  # The importId of the database snapshot that served the lookup, as reported
+  # by reloading locators
+  import_id: typing.Optional[str] = None
+
+
+@dataclasses.dataclass(frozen=True)
+class NumberRange:
+  """An inclusive range of numbers that all resolve to the same metadata, as
+  returned by reverse lookups"""
+
+  first: str
+  last: str
+  country: typing.Optional[str]
+  time_zone: typing.Optional[str]
+  region: typing.Optional[str]
+  rate_center: typing.Optional[str]
+  operating_company_number: typing.Optional[str]
+  carrier: typing.Optional[str]
+
+
+class _SnapshotReplacedError(Exception):
+  """Raised when a repository pinned to one database snapshot would have to
+  connect to a file that has since replaced it"""
+
+  def __init__(self, db_path: str):
     self.db_path = db_path
 
+
+def _file_signature(path: str) -> tuple:
+  """Identify a version of a file. build/build_npa_db.py replaces the database
+  with a new file rather than modifying it in place, so any change means a new
+  snapshot."""
+
+  stat = os.stat(path)
+  return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _read_import_id(conn: sqlite3.Connection) -> typing.Optional[str]:
+  """Read the importId that build/build_npa_db.py recorded in a database"""
+
+  has_table = conn.execute(
+    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'import_info'"
+  ).fetchone() is not None
+  if not has_table:
+    return None
+
+  row = conn.execute(
+    "SELECT value FROM import_info WHERE key = 'importId'").fetchone()
+  return row[0] if row is not None else None
+
+
+def _normalize(number: str) -> typing.Optional[str]:
+  """Strip punctuation and whitespace from a number, returning None if what
+  remains is not a 10-digit NANP number. Only ASCII digits are accepted, as
+  every backend converts parts of the number with int(), which would also
+  accept digits from other scripts."""
+
+  number = re.sub(r'\W', '', number)
+  if not number.isascii() or PHONE_NUMBER_PATTERN.match(number) is None:
+    return None
+  return number
+
+
+@dataclasses.dataclass(frozen=True)
+class CacheStats:
+  hits: int
+  misses: int
+  evictions: int
+  size: int
+  maxsize: int
+
+
+class LRUCache:
+  """A bounded, thread-safe mapping that evicts its least recently used entry
+  when full and counts hits, misses, and evictions. A maxsize of 0 disables
+  caching.
+
+  Every entry is tagged with the generation of the data it was read from, and
+  is only returned to readers asking for that generation, so a value put by a
+  reader that started before the data changed is never served after."""
+
+  MISSING = object()
+
+  def __init__(self, maxsize: int):
+    self.maxsize = maxsize
+    self.__entries = collections.OrderedDict()
+    self.__lock = threading.Lock()
+    self.__hits = 0
+    self.__misses = 0
+    self.__evictions = 0
+
+  def get(self, key, generation: int = 0):
+    """Return the value cached for key from the given generation, or
+    LRUCache.MISSING"""
+
+    with self.__lock:
+      entry = self.__entries.get(key)
+      if entry is None or entry[0] != generation:
+        self.__misses += 1
+        return LRUCache.MISSING
+
+      self.__hits += 1
+      self.__entries.move_to_end(key)
+      return entry[1]
+
+  def put(self, key, value, generation: int = 0):
+    if self.maxsize <= 0:
+      return
+
+    with self.__lock:
+      self.__entries[key] = (generation, value)
+      self.__entries.move_to_end(key)
+      if len(self.__entries) > self.maxsize:
+        self.__entries.popitem(last=False)
+        self.__evictions += 1
+
+  def clear(self):
+    with self.__lock:
+      self.__entries.clear()
+
+  def stats(self) -> CacheStats:
+    with self.__lock:
+      return CacheStats(
+        self.__hits,
+        self.__misses,
+        self.__evictions,
+        len(self.__entries),
+        self.maxsize)
+
+
+@dataclasses.dataclass(frozen=True)
+class StageStats:
+  calls: int
+  total_seconds: float
+  # The number of calls taking at most each bucket's upper bound in seconds,
+  # and more than the previous bucket's
+  histogram: typing.Dict[float, int]
+
+
+@dataclasses.dataclass(frozen=True)
+class LookupStats:
+  # Latency of each lookup stage: normalize, then either resolution (a query
+  # against the materialized resolution table) or npa, nxx, and block for
+  # single lookups, and batch for each set-based query
+  stages: typing.Dict[str, StageStats]
+  # Lookups by outcome: pooled (resolved from a block), unpooled (resolved from
+  # an exchange), area_code_only (non-US), or the name of the error reported
+  outcomes: typing.Dict[str, int]
+
+
+class LookupInstrumentation:
+  """Per-stage latency histograms and outcome counters for a locator. Passed to
+  number_locator as the instrumentation option; lookups are not timed unless
+  it is. The callback, if any, is called as callback('stage', stage, seconds)
+  for every timed stage and callback('outcome', outcome, 1) for every lookup,
+  so measurements can be exported to another metrics system."""
+
+  def __init__(
+    self,
+    callback: typing.Optional[typing.Callable[[str, str, float], None]] = None,
+    buckets: typing.Sequence[float] = DEFAULT_LATENCY_BUCKETS
+  ):
+    self.callback = callback
+    self.buckets = tuple(buckets)
+    self.__lock = threading.Lock()
+    self.__stages = {}
+    self.__outcomes = collections.Counter()
+
+  def record_stage(self, stage: str, seconds: float):
+    bucket = bisect.bisect_left(self.buckets, seconds)
+    with self.__lock:
+      calls, total, histogram = self.__stages.get(stage, (0, 0.0, None))
+      if histogram is None:
+        histogram = [0] * (len(self.buckets) + 1)
+      histogram[bucket] += 1
+      self.__stages[stage] = (calls + 1, total + seconds, histogram)
+
+    if self.callback is not None:
+      self.callback('stage', stage, seconds)
+
+  def record_outcome(
+    self,
+    result: LookupResult,
+    pooled: typing.Optional[bool] = None
+  ):
+    """Count a lookup's outcome. pooled reports whether a block row was found,
+    and is None when the number's exchange was never consulted."""
+
+    if result.error is not None:
+      outcome = type(result.error).__name__
+    elif pooled is None:
+      outcome = 'area_code_only'
+    else:
+      outcome = 'pooled' if pooled else 'unpooled'
+
+    with self.__lock:
+      self.__outcomes[outcome] += 1
+
+    if self.callback is not None:
+      self.callback('outcome', outcome, 1)
+
+  def stats(self) -> LookupStats:
+    bounds = self.buckets + (float('inf'),)
+    with self.__lock:
+      stages = {
+        stage: StageStats(calls, total, {
+          bound: count for bound, count in zip(bounds, histogram) if count > 0
+        })
+        for stage, (calls, total, histogram) in self.__stages.items()
+      }
+      return LookupStats(stages, dict(self.__outcomes))
+
+  def reset(self):
+    with self.__lock:
+      self.__stages.clear()
+      self.__outcomes.clear()
+
+
+# Columns read from each table when resolving numbers in bulk. The first column
+# of each list is part of the table's primary key and is only NULL when no row
+# matched the number being resolved.
+_NPA_COLUMNS = (
+  'NPA_ID', 'ASSIGNABLE', 'EXPLANATION', 'IN_SERVICE', 'ASSIGNED', 'COUNTRY',
+  'TIME_ZONE', 'LOCATION')
+_NXX_COLUMNS = ('NPA_NXX', 'Use', 'State', 'RateCenter', 'OCN', 'Company')
+_BLOCK_COLUMNS = ('NPA', 'State', 'Rate_Center', 'OCN', 'Assigned_To')
+
+_NPA_QUERY = f"SELECT {', '.join(_NPA_COLUMNS)} FROM npa WHERE NPA_ID = ?"
+_NXX_QUERY = f"SELECT {', '.join(_NXX_COLUMNS)} FROM npa_nxx WHERE NPA_NXX = ?"
+_BLOCK_QUERY = (
+  f"SELECT {', '.join(_BLOCK_COLUMNS)} FROM blocks "
+  "WHERE NPA = ? AND NXX = ? AND X = ?")
+
+_BATCH_QUERY = f"""
+  SELECT
+    l.idx,
+    {', '.join('n.' + col for col in _NPA_COLUMNS)},
+    {', '.join('x.' + col for col in _NXX_COLUMNS)},
+    {', '.join('b.' + col for col in _BLOCK_COLUMNS)}
+  FROM temp.lookup_batch l
+  LEFT JOIN npa n ON n.NPA_ID = l.npa
+  LEFT JOIN npa_nxx x ON x.NPA_NXX = l.npa_nxx
+  LEFT JOIN blocks b ON b.NPA = l.npa AND b.NXX = l.nxx AND b.X = l.x
+"""
+
+# The materialized resolution table written by build/build_npa_db.py holds one
+# row per usable area code, per assignable US exchange, and per pooled block
+# within one. Keys are integers in disjoint ranges: NPA (3 digits), NPA * 1000
+# + NXX (6 digits), and NPA * 10000 + NXX * 10 + X (7 digits), so the row with
+# the greatest key among a number's three keys is the most specific one and
+# already has the NPA -> NXX -> block precedence applied. status holds a
+# LookupStatus: area code rows of US NPAs report INVALID_EXCHANGE, as they are
+# only matched when the number's exchange has no row of its own.
+RESOLUTION_COLUMNS = (
+  'key', 'status', 'country', 'time_zone', 'region', 'rate_center',
+  'operating_company_number', 'carrier', 'explanation')
+_EXCHANGE_KEY_MIN = 1000
+_BLOCK_KEY_MIN = 1000 * 1000
+
+_RESOLUTION_QUERY = (
+  f"SELECT {', '.join(RESOLUTION_COLUMNS)} FROM resolution "
+  "WHERE key IN (?, ?, ?) ORDER BY key DESC LIMIT 1")
+
+_RESOLUTION_BATCH_QUERY = f"""
+  SELECT
+    l.idx,
+    {', '.join('r.' + col for col in RESOLUTION_COLUMNS)}
+  FROM temp.resolution_batch l
+  LEFT JOIN resolution r ON r.key = (
+    SELECT key FROM resolution
+    WHERE key IN (l.block, l.block / 10, l.block / 10000)
+    ORDER BY key DESC LIMIT 1)
+"""
+
+
+class __NumberLocator(abc.ABC):
+  """Behavior shared by every metadata backend. Subclasses provide lookup,
+  reverse lookups, and the NPA and exchange checks behind the predicates, and
+  manage their resources as a context manager."""
+
   def __enter__(self):
-    self.conn = sqlite3.connect(self.db_path)
-    self.conn.row_factory = sqlite3.Row
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
-    self.conn.close()
-    del self.conn
+    pass
 
   def has_us_area_code(self, number: str) -> bool:
     """Determine whether the provided number belongs to an area code allocated
-    to the United States."""
+    to the United States. Only the area code is consulted."""
 
-    try:
-      return self.locate_number(number).country in ('US', None)
-    except InvalidExchangeError:
-      return True
-    except:
+    number = _normalize(number)
+    if number is None:
       return False
 
+    status, country = self._area_code_status(number[0:3])
+    return status == LookupStatus.OK and country in ('US', None)
+
   def is_potentially_valid_number(self, number: str) -> bool:
     """Determine whether the provided number belongs to an assignable exchange
     within an assignable area code. Does NOT indicate whether any number
-    actually has been assigned to a subscriber."""
+    actually has been assigned to a subscriber. Only the area code and
+    exchange are consulted."""
 
-    try:
-      self.locate_number(number)
-      return True
-    except:
+    number = _normalize(number)
+    if number is None:
       return False
 
+    status, country = self._area_code_status(number[0:3])
+    if status != LookupStatus.OK:
+      return False
+
+    return country != 'US' or self._has_assignable_exchange(number)
+
+  def filter_us_numbers(
+    self,
+    numbers: typing.Iterable[str]
+  ) -> typing.Iterator[str]:
+    """Yield the numbers for which has_us_area_code holds, in input order"""
+
+    return (number for number in numbers if self.has_us_area_code(number))
+
+  def filter_potentially_valid_numbers(
+    self,
+    numbers: typing.Iterable[str],
+    batch_size: int = DEFAULT_BATCH_SIZE
+  ) -> typing.Iterator[str]:
+    """Yield the numbers for which is_potentially_valid_number holds, in input
+    order"""
+
+    return (
+      number for number in numbers if self.is_potentially_valid_number(number)
+    )
+
+  @abc.abstractmethod
+  def lookup(self, number: str) -> LookupResult:
+    """Locate a number, reporting failure through the status of the result
+    instead of raising"""
+
+  def lookup_many(
+    self,
+    numbers: typing.Iterable[str],
+    batch_size: int = DEFAULT_BATCH_SIZE
+  ) -> typing.Iterator[LookupResult]:
+    """Look up many numbers, yielding a result for each in input order"""
+
+    return (self.lookup(number) for number in numbers)
+
   def locate_number(self, number: str) -> MetadataRecord:
+    """Build a metadata record for a number, raising if it cannot be located"""
+
+    result = self.lookup(number)
+    if result.error is not None:
+      raise result.error
+    return result.record
+
+  def locate_numbers(
+    self,
+    numbers: typing.Iterable[str],
+    batch_size: int = DEFAULT_BATCH_SIZE
+  ) -> typing.Iterator[typing.Union[MetadataRecord, Exception]]:
+    """Resolve many numbers, yielding in input order either the record
+    locate_number would have returned or the exception it would have raised."""
+
+    for result in self.lookup_many(numbers, batch_size):
+      yield result.record if result.error is None else result.error
+
+  @abc.abstractmethod
+  def find_ranges(
+    self,
+    region: typing.Optional[str] = None,
+    rate_center: typing.Optional[str] = None,
+    operating_company_number: typing.Optional[str] = None,
+    carrier: typing.Optional[str] = None
+  ) -> typing.List[NumberRange]:
+    """Enumerate the ranges of numbers whose metadata matches every attribute
+    given. Raises a ValueError if the backend cannot serve reverse lookups."""
+
+  @abc.abstractmethod
+  def _area_code_status(
+    self,
+    area_code: str
+  ) -> typing.Tuple[LookupStatus, typing.Optional[str]]:
+    """Report whether an area code is usable and, if so, its country"""
+
+  @abc.abstractmethod
+  def _has_assignable_exchange(self, number: str) -> bool:
+    """Report whether a normalized US number's exchange is assignable"""
+
+
+class __MetadataRepository(__NumberLocator):
+  """An interface into the carrier metadata database. Each thread reads through
+  its own read-only connection, which is opened on first use and reused (along
+  with its prepared statements) for every later lookup on that thread, so a
+  single repository may be shared between threads. When the outermost managed
+  context exits, the exiting thread's connection and those of threads that
+  have exited are closed; other threads may still be reading, so theirs are
+  left open until they exit or the repository is discarded.
+
+  NPA, NPA-NXX, and block rows (including the absence of a row) are kept in
+  LRU caches shared by all threads. When the database file is replaced, the
+  caches are cleared and each thread reconnects to the new file. Cached rows
+  are tagged with the file generation of the connection that read them, so
+  a row read from the old file by a thread that was mid-query when the file
+  was replaced is never served.
+
+  When the database has a materialized resolution table (and resolution_table
+  is not disabled), each number is instead resolved with a single primary key
+  query against it, and resolved rows are cached by block.
+
+  A pinned repository never follows a replacement: it keeps reading the file
+  that was in place when it first connected, and raises _SnapshotReplacedError
+  if a thread would have to connect after that file was replaced."""
+
+  def __init__(
+    self,
+    db_path,
+    npa_cache_size: int = DEFAULT_NPA_CACHE_SIZE,
+    nxx_cache_size: int = DEFAULT_NXX_CACHE_SIZE,
+    block_cache_size: int = DEFAULT_BLOCK_CACHE_SIZE,
+    replacement_check_interval: float = DEFAULT_REPLACEMENT_CHECK_INTERVAL,
+    instrumentation: typing.Optional[LookupInstrumentation] = None,
+    resolution_table: bool = True,
+    resolution_cache_size: int = DEFAULT_RESOLUTION_CACHE_SIZE,
+    pinned: bool = False
+  ):
+    self.db_path = db_path
+    self.replacement_check_interval = replacement_check_interval
+    self.instrumentation = instrumentation
+    self.resolution_table = resolution_table
+    self.pinned = pinned
+    self.__pinned_signature = None
+    self.__local = threading.local()
+    self.__lock = threading.Lock()
+    self.__connections = []
+    self.__depth = 0
+    # Bumped whenever connections must be reopened, and whenever the file is
+    # replaced, respectively
+    self.__generation = 0
+    self.__file_generation = 0
+    self.__file_signature = None
+    self.__next_replacement_check = 0.0
+    self.__npa_cache = LRUCache(npa_cache_size)
+    self.__nxx_cache = LRUCache(nxx_cache_size)
+    self.__block_cache = LRUCache(block_cache_size)
+    self.__resolution_cache = LRUCache(resolution_cache_size)
+
+  def __enter__(self):
+    with self.__lock:
+      self.__depth += 1
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    with self.__lock:
+      self.__depth -= 1
+      if self.__depth > 0:
+        return
+
+      current = threading.current_thread()
+      closing, live = [], []
+      for thread, conn in self.__connections:
+        if thread is current or not thread.is_alive():
+          closing.append(conn)
+        else:
+          live.append((thread, conn))
+      self.__connections = live
+
+    # Reconnect on the next lookup from this thread
+    self.__local.generation = None
+    for conn in closing:
+      conn.close()
+
+  def _close_all(self):
+    """Close every thread's connection. Only for owners that know no thread is
+    still reading, such as a reloading locator retiring an idle snapshot."""
+
+    with self.__lock:
+      connections = self.__connections
+      self.__connections = []
+      self.__generation += 1
+
+    for _, conn in connections:
+      conn.close()
+
+  def cache_stats(self) -> typing.Dict[str, CacheStats]:
+    """Report hit, miss, and eviction counts for each row cache"""
+
+    return {
+      'npa': self.__npa_cache.stats(),
+      'nxx': self.__nxx_cache.stats(),
+      'block': self.__block_cache.stats(),
+      'resolution': self.__resolution_cache.stats(),
+    }
+
+  def stats(self) -> typing.Optional[LookupStats]:
+    """Report per-stage latencies and outcome counts, or None if this locator
+    is not instrumented"""
+
+    if self.instrumentation is None:
+      return None
+    return self.instrumentation.stats()
+
+  def __check_for_replacement(self):
+    """Drop cached rows and connections if the database file has been replaced
+    since it was last checked. Checks are rate limited by
+    replacement_check_interval."""
+
+    now = time.monotonic()
+    if self.pinned or now < self.__next_replacement_check:
+      return
+    self.__next_replacement_check = now + self.replacement_check_interval
+
+    signature = _file_signature(self.db_path)
+    with self.__lock:
+      if signature == self.__file_signature:
+        return
+
+      replaced = self.__file_signature is not None
+      self.__file_signature = signature
+      if replaced:
+        # Connections still in use by other threads are left for the garbage
+        # collector once those threads reconnect
+        self.__connections = []
+        self.__generation += 1
+        self.__file_generation += 1
+
+    if replaced:
+      for cache in (
+          self.__npa_cache,
+          self.__nxx_cache,
+          self.__block_cache,
+          self.__resolution_cache):
+        cache.clear()
+
+  @property
+  def conn(self) -> sqlite3.Connection:
+    """The calling thread's connection to the database"""
+
+    local = self.__local
+    if getattr(local, 'generation', None) != self.__generation:
+      # Generations are read before connecting, so that if the file is
+      # replaced meanwhile the thread reconnects and the rows it reads are
+      # not served from the caches
+      with self.__lock:
+        generation, file_generation = self.__generation, self.__file_generation
+      local.conn = self.__connect()
+      local.resolution = self.resolution_table and local.conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'resolution'"
+      ).fetchone() is not None
+      local.import_id = _read_import_id(local.conn)
+      local.generation = generation
+      local.file_generation = file_generation
+    return local.conn
+
+  @property
+  def import_id(self) -> typing.Optional[str]:
+    """The importId recorded in the database read by the calling thread, if
+    build/build_npa_db.py recorded one"""
+
+    return self.__local.import_id if self.conn is not None else None
+
+  @property
+  def pinned_signature(self) -> typing.Optional[tuple]:
+    """The signature of the file a pinned repository reads, once connected"""
+
+    return self.__pinned_signature
+
+  @property
+  def uses_resolution_table(self) -> bool:
+    """Whether the calling thread resolves numbers through the materialized
+    resolution table. The table is detected whenever the thread connects."""
+
+    return self.__local.resolution if self.conn is not None else False
+
+  def __connect(self) -> sqlite3.Connection:
+    # The database is only ever replaced wholesale (never modified in place),
+    # so it can be opened as immutable and skip SQLite's file locking
+    before = _file_signature(self.db_path) if self.pinned else None
+    uri = pathlib.Path(os.path.abspath(self.db_path)).as_uri()
+    conn = sqlite3.connect(
+      f"{uri}?mode=ro&immutable=1",
+      uri=True,
+      check_same_thread=False,
+      cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KIB}")
+    conn.execute('PRAGMA temp_store = MEMORY')
+    if self.pinned:
+      self.__pin(conn, before)
+
+    with self.__lock:
+      # Connections owned by threads that have since exited are never used
+      # again, so close them rather than let them accumulate
+      live = []
+      for thread, other in self.__connections:
+        if thread.is_alive():
+          live.append((thread, other))
+        else:
+          other.close()
+      live.append((threading.current_thread(), conn))
+      self.__connections = live
+
+    return conn
+
+  def __pin(self, conn: sqlite3.Connection, before: tuple):
+    """Make sure a new connection reads the snapshot this repository is pinned
+    to, pinning the first connection's file. Files are only ever replaced, so
+    if the path still refers to the pinned file after connecting, it did when
+    the connection opened it."""
+
+    after = _file_signature(self.db_path)
+    with self.__lock:
+      if self.__pinned_signature is None and before == after:
+        self.__pinned_signature = after
+      pinned = self.__pinned_signature
+
+    if after != pinned:
+      conn.close()
+      raise _SnapshotReplacedError(self.db_path)
+
+  def lookup(self, number: str) -> LookupResult:
     """Build a metadata record from the various datasets in the repository"""
 
-    number = re.sub(r'\W', '', number)
-    if PHONE_NUMBER_PATTERN.match(number) is None:
-      raise InvalidNumberError
+    if self.instrumentation is not None:
+      return self.__instrumented_lookup(number, self.instrumentation)
+    return self.__lookup(number)
 
-    npa_record = self.__fetch_npa_metadata(number)
+  def _warm(self, numbers: typing.Iterable[str]):
+    """Look up numbers only to fill the row caches, without recording them in
+    the instrumentation"""
 
-    if npa_record.country != 'US':
-      # Further metadata tables are only available for US numbers, but NANPA
-      # also administers the numbering plan for Canada and a good chunk of the
-      # caribbean. If the number isn't from the US, return basic NANPA geodata
-      return npa_record
+    for number in numbers:
+      self.__lookup(number)
 
-    nxx_record = self.__fetch_nxx_metadata(npa_record)
-    return self.__fetch_block_metadata(nxx_record)
+  def __lookup(self, number: str) -> LookupResult:
+    normalized = _normalize(number)
+    if normalized is None:
+      return LookupResult(LookupStatus.INVALID_NUMBER, error=InvalidNumberError())
 
-  def __fetch_npa_metadata(self, number: str) -> MetadataRecord:
-    """Build a barebones record from NANPA's NPA database table. All area code
-    from 200-999 should have an entry in this table identifying the country,
-    region, and timezone of a given area code, as well as whether a given area
-    code is reserved for future expansion or otherwise unassignable."""
+    self.__check_for_replacement()
+    if self.uses_resolution_table:
+      return self.__resolve_materialized(
+        normalized,
+        self.__fetch_resolution_row(normalized))
 
-    area_code = number[0:3]
+    return self.__resolve(
+      normalized,
+      self.__fetch_npa_row(normalized[0:3]),
+      self.__fetch_nxx_row,
+      self.__fetch_block_row)
+
+  def __instrumented_lookup(
+    self,
+    number: str,
+    instrumentation: LookupInstrumentation
+  ) -> LookupResult:
+    """Perform the same lookup as lookup, timing each stage"""
+
+    clock = time.perf_counter
+    started = clock()
+    normalized = _normalize(number)
+    instrumentation.record_stage('normalize', clock() - started)
+    if normalized is None:
+      result = LookupResult(
+        LookupStatus.INVALID_NUMBER,
+        error=InvalidNumberError())
+      instrumentation.record_outcome(result)
+      return result
+
+    self.__check_for_replacement()
+    if self.uses_resolution_table:
+      started = clock()
+      resolution_data = self.__fetch_resolution_row(normalized)
+      instrumentation.record_stage('resolution', clock() - started)
+      result = self.__resolve_materialized(normalized, resolution_data)
+      instrumentation.record_outcome(result, self.__is_pooled(resolution_data))
+      return result
+
+    started = clock()
+    npa_data = self.__fetch_npa_row(normalized[0:3])
+    instrumentation.record_stage('npa', clock() - started)
+
+    def fetch_nxx_row(number):
+      started = clock()
+      nxx_data = self.__fetch_nxx_row(number)
+      instrumentation.record_stage('nxx', clock() - started)
+      return nxx_data
+
+    block_rows = []
+    def fetch_block_row(number):
+      started = clock()
+      block_rows.append(self.__fetch_block_row(number))
+      instrumentation.record_stage('block', clock() - started)
+      return block_rows[-1]
+
+    result = self.__resolve(normalized, npa_data, fetch_nxx_row, fetch_block_row)
+    instrumentation.record_outcome(
+      result,
+      block_rows[0] is not None if len(block_rows) > 0 else None)
+    return result
+
+  def lookup_many(
+    self,
+    numbers: typing.Iterable[str],
+    batch_size: int = DEFAULT_BATCH_SIZE
+  ) -> typing.Iterator[LookupResult]:
+    """Resolve many numbers using one set-based query per batch rather than up
+    to three queries per number, yielding a result for each in input order."""
+
+    numbers = iter(numbers)
+    while True:
+      batch = list(itertools.islice(numbers, batch_size))
+      if len(batch) == 0:
+        return
+
+      yield from self.__lookup_batch(batch)
+
+  def filter_potentially_valid_numbers(
+    self,
+    numbers: typing.Iterable[str],
+    batch_size: int = DEFAULT_BATCH_SIZE
+  ) -> typing.Iterator[str]:
+    """Yield the numbers for which is_potentially_valid_number holds, in input
+    order. Exchange rows that are not already cached are fetched with one
+    query per batch."""
+
+    numbers = iter(numbers)
+    while True:
+      batch = list(itertools.islice(numbers, batch_size))
+      if len(batch) == 0:
+        return
+
+      candidates = []
+      for number in batch:
+        normalized = _normalize(number)
+        if normalized is None:
+          continue
+
+        status, country = self._area_code_status(normalized[0:3])
+        if status == LookupStatus.OK:
+          candidates.append((number, normalized, country))
+
+      exchanges = self.__fetch_nxx_rows({
+        normalized[0:6]
+        for _, normalized, country in candidates
+        if country == 'US'
+      })
+      for number, normalized, country in candidates:
+        if country != 'US':
+          yield number
+          continue
+
+        nxx_data = exchanges[normalized[0:6]]
+        if nxx_data is not None and nxx_data['Use'] != 'UA':
+          yield number
+
+  def find_ranges(
+    self,
+    region: typing.Optional[str] = None,
+    rate_center: typing.Optional[str] = None,
+    operating_company_number: typing.Optional[str] = None,
+    carrier: typing.Optional[str] = None
+  ) -> typing.List[NumberRange]:
+    """Enumerate the ranges of numbers whose metadata matches every attribute
+    given, in numeric order. An exchange is reported less any blocks pooled
+    away from it, pooled blocks are reported on their own, and contiguous
+    blocks of an exchange with the same metadata are merged into one range.
+    Non-US area codes only match on region, and are reported whole. Served by
+    the secondary indexes build/build_npa_db.py creates on the resolution
+    table."""
+
+    filters = {
+      name: value for name, value in (
+        ('region', region),
+        ('rate_center', rate_center),
+        ('operating_company_number', operating_company_number),
+        ('carrier', carrier),
+      ) if value is not None
+    }
+    if len(filters) == 0:
+      raise ValueError('At least one attribute to match must be provided')
+
+    self.__check_for_replacement()
+    if not self.uses_resolution_table:
+      raise ValueError(
+        f"{self.db_path} has no resolution table; rebuild it with "
+        "build/build_npa_db.py to enable reverse lookups")
+
+    conditions = ' AND '.join(f"{name} = ?" for name in filters)
+    parameters = [LookupStatus.OK, *filters.values()]
+    matches = self.conn.execute(
+      f"SELECT {', '.join(RESOLUTION_COLUMNS)} FROM resolution "
+      f"WHERE status = ? AND {conditions}",
+      parameters).fetchall()
+    # The pooled blocks of every matching exchange, whether or not they match,
+    # found by a primary key range scan per exchange
+    with self.conn:
+      self.conn.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS range_exchanges ('
+        'key INTEGER PRIMARY KEY)')
+      self.conn.executemany(
+        'INSERT INTO temp.range_exchanges VALUES (?)',
+        [(row[0],) for row in matches if _EXCHANGE_KEY_MIN <= row[0] < _BLOCK_KEY_MIN])
+      pooled = self.conn.execute(
+        "SELECT b.key FROM temp.range_exchanges e "
+        "CROSS JOIN resolution b ON b.key BETWEEN e.key * 10 AND e.key * 10 + 9"
+      ).fetchall()
+      self.conn.execute('DELETE FROM temp.range_exchanges')
+
+    ranges = []
+    exchanges = {}
+    for row in sorted(matches, key=lambda row: row[0]):
+      key, fields = row[0], _interned_row(row[2:8])
+      if key < _EXCHANGE_KEY_MIN:
+        ranges.append(NumberRange(f"{key:03d}0000000", f"{key:03d}9999999", *fields))
+      elif key < _BLOCK_KEY_MIN:
+        exchanges[key] = [fields] * 10
+    for (key,) in pooled:
+      exchanges[key // 10][key % 10] = None
+    for row in matches:
+      key = row[0]
+      if key >= _BLOCK_KEY_MIN:
+        exchanges.setdefault(key // 10, [None] * 10)[key % 10] = _interned_row(row[2:8])
+
+    for exchange, blocks in exchanges.items():
+      x = 0
+      while x < 10:
+        if blocks[x] is None:
+          x += 1
+          continue
+
+        last = x
+        while last + 1 < 10 and blocks[last + 1] == blocks[x]:
+          last += 1
+        ranges.append(NumberRange(
+          f"{exchange:06d}{x}000",
+          f"{exchange:06d}{last}999",
+          *blocks[x]))
+        x = last + 1
+
+    ranges.sort(key=lambda number_range: number_range.first)
+    return ranges
+
+  def _area_code_status(
+    self,
+    area_code: str
+  ) -> typing.Tuple[LookupStatus, typing.Optional[str]]:
+    self.__check_for_replacement()
+    npa_data = self.__fetch_npa_row(area_code)
+    if npa_data is None:
+      return LookupStatus.AREA_CODE_NOT_FOUND, None
+
+    if (npa_data['ASSIGNABLE'] == 'No' or npa_data['IN_SERVICE'] == 'N'
+        or npa_data['ASSIGNED'] == 'No'):
+      return LookupStatus.INVALID_AREA_CODE, None
+
+    return LookupStatus.OK, npa_data['COUNTRY'] or None
+
+  def _has_assignable_exchange(self, number: str) -> bool:
+    nxx_data = self.__fetch_nxx_row(number)
+    return nxx_data is not None and nxx_data['Use'] != 'UA'
+
+  def __lookup_batch(self, batch: typing.List[str]) -> typing.List[LookupResult]:
+    """Resolve a single batch of numbers by loading them into a temporary table
+    and joining it against the npa, npa_nxx, and blocks tables (or the
+    resolution table) at once."""
+
+    results = [None] * len(batch)
+    normalized = {}
+    for idx, number in enumerate(batch):
+      number = _normalize(number)
+      if number is None:
+        results[idx] = LookupResult(
+          LookupStatus.INVALID_NUMBER,
+          error=InvalidNumberError())
+      else:
+        normalized[idx] = number
+
+    if len(normalized) == 0:
+      return results
+
+    self.__check_for_replacement()
+    instrumentation = self.instrumentation
+    started = time.perf_counter()
     cursor = self.conn.cursor()
+    cursor.row_factory = None
     try:
-      cursor.execute('SELECT * FROM npa WHERE NPA_ID = ?', [area_code])
-      npa_data = cursor.fetchone()
+      with self.conn:
+        if self.uses_resolution_table:
+          self.__lookup_batch_materialized(cursor, normalized, results)
+        else:
+          self.__lookup_batch_stepwise(cursor, normalized, results)
+    finally:
+      cursor.close()
 
-      if npa_data is None:
-        raise AreaCodeNotFoundError(area_code)
+    if instrumentation is not None:
+      instrumentation.record_stage('batch', time.perf_counter() - started)
+      for result in results:
+        if result.status == LookupStatus.INVALID_NUMBER:
+          instrumentation.record_outcome(result)
 
-      if npa_data['ASSIGNABLE'] == 'No':
-        raise InvalidAreaCodeError(area_code, npa_data['EXPLANATION'])
+    return results
+
+  def __lookup_batch_stepwise(self, cursor, normalized, results):
+    """Resolve normalized numbers by index with the NPA, NXX, and block rows
+    joined to each"""
+
+    instrumentation = self.instrumentation
+    npa_width = len(_NPA_COLUMNS)
+    nxx_width = len(_NXX_COLUMNS)
+    cursor.execute(
+      'CREATE TEMP TABLE IF NOT EXISTS lookup_batch ('
+      'idx INTEGER PRIMARY KEY, npa TEXT, npa_nxx TEXT, nxx TEXT, x TEXT)')
+    cursor.executemany(
+      'INSERT INTO temp.lookup_batch VALUES (?, ?, ?, ?, ?)',
+      [
+        (idx, n[0:3], f"{n[0:3]}-{n[3:6]}", n[3:6], n[6:7])
+        for idx, n in normalized.items()
+      ])
+    cursor.execute(_BATCH_QUERY)
+
+    for row in cursor:
+      idx = row[0]
+      npa_data = row[1:1 + npa_width]
+      nxx_data = row[1 + npa_width:1 + npa_width + nxx_width]
+      block_data = row[1 + npa_width + nxx_width:]
+      nxx_data = dict(zip(_NXX_COLUMNS, nxx_data)) if nxx_data[0] is not None else None
+      block_data = dict(zip(_BLOCK_COLUMNS, block_data)) if block_data[0] is not None else None
+      results[idx] = self.__resolve(
+        normalized[idx],
+        dict(zip(_NPA_COLUMNS, npa_data)) if npa_data[0] is not None else None,
+        lambda _: nxx_data,
+        lambda _: block_data)
+      if instrumentation is not None:
+        # Only US numbers consult their exchange and block
+        record = results[idx].record
+        instrumentation.record_outcome(
+          results[idx],
+          block_data is not None
+          if record is not None and record.country == 'US' else None)
+
+    cursor.execute('DELETE FROM temp.lookup_batch')
+
+  def __lookup_batch_materialized(self, cursor, normalized, results):
+    """Resolve normalized numbers by index with the most specific resolution
+    row joined to each"""
+
+    instrumentation = self.instrumentation
+    cursor.execute(
+      'CREATE TEMP TABLE IF NOT EXISTS resolution_batch ('
+      'idx INTEGER PRIMARY KEY, block INTEGER)')
+    cursor.executemany(
+      'INSERT INTO temp.resolution_batch VALUES (?, ?)',
+      [(idx, int(n[0:7])) for idx, n in normalized.items()])
+    cursor.execute(_RESOLUTION_BATCH_QUERY)
+
+    # Numbers in the same block or exchange share one interned row
+    rows = {None: None}
+    for row in cursor:
+      idx = row[0]
+      resolution_data = rows.get(row[1])
+      if resolution_data is None and row[1] is not None:
+        resolution_data = rows[row[1]] = _interned_row(row[1:])
+      results[idx] = self.__resolve_materialized(normalized[idx], resolution_data)
+      if instrumentation is not None:
+        instrumentation.record_outcome(
+          results[idx],
+          self.__is_pooled(resolution_data))
+
+    cursor.execute('DELETE FROM temp.resolution_batch')
+
+  def __resolve(
+    self,
+    number: str,
+    npa_data,
+    fetch_nxx_row: typing.Callable[[str], typing.Any],
+    fetch_block_row: typing.Callable[[str], typing.Any]
+  ) -> LookupResult:
+    """Apply the NPA -> NXX -> block precedence rules for a normalized number.
+    Exchange and block rows are only fetched once the rules call for them."""
+
+    area_code = number[0:3]
 
-      if npa_data['IN_SERVICE'] == 'N' or npa_data['ASSIGNED'] == 'No':
-        raise InvalidAreaCodeError(area_code, "Area code not in service")
+    if npa_data is None:
+      return LookupResult(
+        LookupStatus.AREA_CODE_NOT_FOUND,
+        error=AreaCodeNotFoundError(area_code))
 
-      # Some area codes have no or limited geographic affinity and should return
-      # sparser data
-      return MetadataRecord(
+    if npa_data['ASSIGNABLE'] == 'No':
+      return LookupResult(
+        LookupStatus.INVALID_AREA_CODE,
+        error=InvalidAreaCodeError(area_code, npa_data['EXPLANATION']))
+
+    if npa_data['IN_SERVICE'] == 'N' or npa_data['ASSIGNED'] == 'No':
+      return LookupResult(
+        LookupStatus.INVALID_AREA_CODE,
+        error=InvalidAreaCodeError(area_code, "Area code not in service"))
+
+    # Some area codes have no or limited geographic affinity and should return
+    # sparser data
+    country = npa_data['COUNTRY'] if npa_data['COUNTRY'] != '' else None
+    time_zone = npa_data['TIME_ZONE'] if npa_data['TIME_ZONE'] != '' else None
+
+    if country != 'US':
+      # Further metadata tables are only available for US numbers, but NANPA
+      # also administers the numbering plan for Canada and a good chunk of the
+      # caribbean. If the number isn't from the US, return basic NANPA geodata
+      return LookupResult(LookupStatus.OK, _record(
         number,
-        npa_data['COUNTRY'] if npa_data['COUNTRY'] != '' else None,
-        npa_data['TIME_ZONE'] if npa_data['TIME_ZONE'] != '' else None,
+        country,
+        time_zone,
         npa_data['LOCATION'] if npa_data['LOCATION'] != '' else None,
         None,
         None,
         None
-      )
-    finally:
-      cursor.close()
+      ))
+
+    nxx_data = fetch_nxx_row(number)
+    if nxx_data is None or nxx_data['Use'] == 'UA':
+      return LookupResult(
+        LookupStatus.INVALID_EXCHANGE,
+        error=InvalidExchangeError(area_code, number[3:6]))
+
+    block_data = fetch_block_row(number)
+    if block_data is None:
+      return LookupResult(LookupStatus.OK, _record(
+        number,
+        country,
+        time_zone,
+        nxx_data['State'],
+        nxx_data['RateCenter'],
+        nxx_data['OCN'],
+        nxx_data['Company']
+      ))
+
+    return LookupResult(LookupStatus.OK, _record(
+      number,
+      country,
+      time_zone,
+      block_data['State'],
+      block_data['Rate_Center'],
+      block_data['OCN'],
+      block_data['Assigned_To']
+    ))
+
+  def __resolve_materialized(self, number: str, resolution_data) -> LookupResult:
+    """Build the result for a normalized number from the most specific row of
+    the resolution table covering it, which must already be interned"""
+
+    if resolution_data is None:
+      return LookupResult(
+        LookupStatus.AREA_CODE_NOT_FOUND,
+        error=AreaCodeNotFoundError(number[0:3]))
+
+    status = LookupStatus(resolution_data[1])
+    if status == LookupStatus.OK:
+      return LookupResult(status, MetadataRecord(number, *resolution_data[2:8]))
+    if status == LookupStatus.INVALID_AREA_CODE:
+      return LookupResult(
+        status,
+        error=InvalidAreaCodeError(number[0:3], resolution_data[8]))
+    return LookupResult(
+      status,
+      error=InvalidExchangeError(number[0:3], number[3:6]))
+
+  @staticmethod
+  def __is_pooled(resolution_data) -> typing.Optional[bool]:
+    """Whether a resolution row came from a pooled block, or None if it is an
+    area code row"""
+
+    if resolution_data is None or resolution_data[0] < _EXCHANGE_KEY_MIN:
+      return None
+    return resolution_data[0] >= _BLOCK_KEY_MIN
+
+  def __fetch_resolution_row(self, number: str):
+    """Fetch the most specific row of the resolution table covering a number:
+    that of its block, else its exchange, else its area code."""
 
-  def __fetch_nxx_metadata(self, metadata: MetadataRecord) -> MetadataRecord:
-    """Build a MetadataRecord from NANPA's exchange assignment listing. This
+    block = number[0:7]
+    resolution_data = self.__resolution_cache.get(block, self.__file_generation)
+    if resolution_data is LRUCache.MISSING:
+      key = int(block)
+      resolution_data = self.conn.execute(
+        _RESOLUTION_QUERY,
+        [key, key // 10, key // 10000]
+      ).fetchone()
+      if resolution_data is not None:
+        resolution_data = _interned_row(resolution_data)
+      self.__resolution_cache.put(
+        block,
+        resolution_data,
+        self.__local.file_generation)
+
+    return resolution_data
+
+  def __fetch_npa_row(self, area_code: str):
+    """Fetch an area code's row from NANPA's NPA database table. All area code
+    from 200-999 should have an entry in this table identifying the country,
+    region, and timezone of a given area code, as well as whether a given area
+    code is reserved for future expansion or otherwise unassignable."""
+
+    npa_data = self.__npa_cache.get(area_code, self.__file_generation)
+    if npa_data is LRUCache.MISSING:
+      npa_data = self.conn.execute(_NPA_QUERY, [area_code]).fetchone()
+      self.__npa_cache.put(area_code, npa_data, self.__local.file_generation)
+
+    return npa_data
+
+  def __fetch_nxx_row(self, number: str):
+    """Fetch a number's row from NANPA's exchange assignment listing. This
     table identifies whether an exchange is assignable and provides a state,
     rate center, and carrier for any assignable exchange. Note: rate center and
     carrier may not be accurate if the exchange participates in number
     pooling."""
 
-    area_code = metadata.phone_number[0:3]
-    exchange = metadata.phone_number[3:6]
-    cursor = self.conn.cursor()
+    npa_nxx = f"{number[0:3]}-{number[3:6]}"
+    nxx_data = self.__nxx_cache.get(npa_nxx, self.__file_generation)
+    if nxx_data is LRUCache.MISSING:
+      nxx_data = self.conn.execute(_NXX_QUERY, [npa_nxx]).fetchone()
+      self.__nxx_cache.put(npa_nxx, nxx_data, self.__local.file_generation)
 
-    try:
-      cursor.execute(
-        'SELECT * FROM npa_nxx WHERE NPA_NXX = ?',
-        [f"{area_code}-{exchange}"])
-      nxx_data = cursor.fetchone()
-
-      if nxx_data is None or nxx_data['Use'] == 'UA':
-        raise InvalidExchangeError(area_code, exchange)
-
-      return MetadataRecord(
-        metadata.phone_number,
-        metadata.country,
-        metadata.time_zone,
-        nxx_data['State'],
-        nxx_data['RateCenter'],
-        nxx_data['OCN'],
-        nxx_data['Company']
-      )
-    finally:
-      cursor.close()
+    return nxx_data
+
+  def __fetch_nxx_rows(self, exchanges: typing.Set[str]) -> dict:
+    """Fetch the npa_nxx rows (or None) for a set of 6-digit NPA-NXX keys,
+    querying for all uncached keys at once"""
+
+    rows = {}
+    for exchange in exchanges:
+      nxx_data = self.__nxx_cache.get(
+        f"{exchange[0:3]}-{exchange[3:6]}",
+        self.__file_generation)
+      if nxx_data is not LRUCache.MISSING:
+        rows[exchange] = nxx_data
+
+    missing = [f"{exchange[0:3]}-{exchange[3:6]}" for exchange in exchanges if exchange not in rows]
+    if len(missing) == 0:
+      return rows
+
+    with self.conn:
+      self.conn.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS lookup_exchanges ('
+        'npa_nxx TEXT PRIMARY KEY)')
+      self.conn.executemany(
+        'INSERT INTO temp.lookup_exchanges VALUES (?)',
+        [(npa_nxx,) for npa_nxx in missing])
+      fetched = {
+        nxx_data['NPA_NXX']: nxx_data
+        for nxx_data in self.conn.execute(
+          f"SELECT {', '.join('x.' + col for col in _NXX_COLUMNS)} "
+          "FROM temp.lookup_exchanges k "
+          "JOIN npa_nxx x ON x.NPA_NXX = k.npa_nxx")
+      }
+      self.conn.execute('DELETE FROM temp.lookup_exchanges')
+
+    for npa_nxx in missing:
+      nxx_data = fetched.get(npa_nxx)
+      self.__nxx_cache.put(npa_nxx, nxx_data, self.__local.file_generation)
+      rows[npa_nxx.replace('-', '')] = nxx_data
+
+    return rows
 
-  def __fetch_block_metadata(self, metadata: MetadataRecord) -> MetadataRecord:
-    """Build a metadata record from the pooling block assignment table. Not all
+  def __fetch_block_row(self, number: str):
+    """Fetch a number's row from the pooling block assignment table. Not all
     valid exchanges are pooled, so numbers belonging to unpooled exchanges will
     return None from this method"""
 
-    cursor = self.conn.cursor()
+    block = number[0:7]
+    block_data = self.__block_cache.get(block, self.__file_generation)
+    if block_data is LRUCache.MISSING:
+      block_data = self.conn.execute(
+        _BLOCK_QUERY,
+        [block[0:3], block[3:6], block[6:7]]
+      ).fetchone()
+      self.__block_cache.put(block, block_data, self.__local.file_generation)
+
+    return block_data
+
+
+# Layout of the compiled index written by phone2geo_build.write_compiled_index
+# for build/build_npa_db.py. Every section
+# after the header is an array of little-endian uint32 values:
+#
+#   string offsets  [string count + 1] offsets into the UTF-8 string blob
+#   string blob     UTF-8 bytes, padded to a multiple of four bytes
+#   npa             [1000 * 5] status, country, time zone, location, explanation
+#   exchanges       [1000 * 1000] exchange record ID keyed by NPA * 1000 + NXX
+#   exchange recs   [n * 5] state, rate center, OCN, company, block group ID
+#   block groups    [n * 10] block record ID keyed by the X digit
+#   block recs      [n * 4] state, rate center, OCN, assigned to
+#
+# String ID 0 stands in for None, and record/group ID 0 means "no entry", so
+# the first entry of every record table is unused.
+INDEX_MAGIC = b'P2GIDX01'
+INDEX_HEADER = struct.Struct('<8s7I')
+INDEX_NPA_FIELDS = 5
+INDEX_EXCHANGE_FIELDS = 5
+INDEX_BLOCK_FIELDS = 4
+INDEX_NPA_MISSING = 0
+INDEX_NPA_VALID = 1
+INDEX_NPA_INVALID = 2
+
+
+class __CompiledMetadataRepository(__NumberLocator):
+  """An interface into the compiled carrier metadata index. The index is
+  memory-mapped while the context is open, so lookups are a handful of array
+  reads with no SQL involved. The mapping is read-only and may be shared
+  between threads; it is released when the outermost context exits."""
+
+  def __init__(self, index_path):
+    self.index_path = index_path
+    self.__lock = threading.Lock()
+    self.__depth = 0
+
+  def __enter__(self):
+    with self.__lock:
+      if self.__depth == 0:
+        self.__open()
+      self.__depth += 1
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    with self.__lock:
+      self.__depth -= 1
+      if self.__depth == 0:
+        self.__close()
 
+  def __open(self):
     try:
-      cursor.execute(
-        'SELECT * FROM blocks WHERE NPA = ? AND NXX = ? AND X = ?',
-        [
-          metadata.phone_number[0:3],
-          metadata.phone_number[3:6],
-          metadata.phone_number[6:7]
-        ]
-      )
-      block_record = cursor.fetchone()
-      if block_record is None:
-        return metadata
-
-      return MetadataRecord(
-        metadata.phone_number,
-        metadata.country,
-        metadata.time_zone,
-        block_record['State'],
-        block_record['Rate_Center'],
-        block_record['OCN'],
-        block_record['Assigned_To']
-      )
+      index_file = open(self.index_path, 'rb')
+    except FileNotFoundError:
+      raise FileNotFoundError(
+        f"No compiled index was found at {self.index_path}; run "
+        "build/build_npa_db.py to compile one") from None
+    with index_file:
+      self.__mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, *lengths = INDEX_HEADER.unpack_from(self.__mmap)
+    if magic != INDEX_MAGIC:
+      self.__mmap.close()
+      raise ValueError(f"{self.index_path} is not a compiled carrier index")
+
+    self.__views = []
+    sections = []
+    position = INDEX_HEADER.size
+    for length in lengths:
+      size = length if len(sections) == 1 else length * 4
+      view = memoryview(self.__mmap)[position:position + size]
+      self.__views.append(view)
+      if len(sections) != 1:
+        if sys.byteorder == 'little':
+          view = view.cast('I')
+          self.__views.append(view)
+        else:
+          # Big-endian hosts read a byte-swapped copy instead of the mapping
+          values = array.array('I')
+          values.frombytes(view)
+          values.byteswap()
+          view = values
+      sections.append(view)
+      position += size
+
+    offsets, blob = sections[0], sections[1]
+    self.__strings = [None] + [
+      sys.intern(bytes(blob[offsets[i]:offsets[i + 1]]).decode('utf-8'))
+      for i in range(1, len(offsets) - 1)
+    ]
+    (self.__npa, self.__exchanges, self.__exchange_records,
+      self.__block_groups, self.__block_records) = sections[2:]
+
+  def __close(self):
+    # Exported buffers must be released before the map can be closed
+    del self.__npa, self.__exchanges, self.__exchange_records
+    del self.__block_groups, self.__block_records
+    for view in reversed(self.__views):
+      view.release()
+    del self.__views
+    self.__mmap.close()
+    del self.__mmap
+
+  def lookup(self, number: str) -> LookupResult:
+    """Build a metadata record from the arrays in the compiled index"""
+
+    number = _normalize(number)
+    if number is None:
+      return LookupResult(LookupStatus.INVALID_NUMBER, error=InvalidNumberError())
+
+    strings = self.__strings
+    area_code = number[0:3]
+    npa = self.__npa
+    base = int(area_code) * INDEX_NPA_FIELDS
+    status = npa[base]
+    if status == INDEX_NPA_MISSING:
+      return LookupResult(
+        LookupStatus.AREA_CODE_NOT_FOUND,
+        error=AreaCodeNotFoundError(area_code))
+    if status == INDEX_NPA_INVALID:
+      return LookupResult(
+        LookupStatus.INVALID_AREA_CODE,
+        error=InvalidAreaCodeError(area_code, strings[npa[base + 4]]))
+
+    country = strings[npa[base + 1]]
+    time_zone = strings[npa[base + 2]]
+    if country != 'US':
+      return LookupResult(LookupStatus.OK, MetadataRecord(
+        number, country, time_zone, strings[npa[base + 3]], None, None, None))
+
+    exchange = self.__exchanges[int(number[0:6])]
+    if exchange == 0:
+      return LookupResult(
+        LookupStatus.INVALID_EXCHANGE,
+        error=InvalidExchangeError(area_code, number[3:6]))
+
+    records = self.__exchange_records
+    base = exchange * INDEX_EXCHANGE_FIELDS
+    group = records[base + 4]
+    if group != 0:
+      block = self.__block_groups[group * 10 + int(number[6])]
+      if block != 0:
+        records = self.__block_records
+        base = block * INDEX_BLOCK_FIELDS
+
+    return LookupResult(LookupStatus.OK, MetadataRecord(
+      number,
+      country,
+      time_zone,
+      strings[records[base]],
+      strings[records[base + 1]],
+      strings[records[base + 2]],
+      strings[records[base + 3]]
+    ))
+
+  def find_ranges(
+    self,
+    region: typing.Optional[str] = None,
+    rate_center: typing.Optional[str] = None,
+    operating_company_number: typing.Optional[str] = None,
+    carrier: typing.Optional[str] = None
+  ) -> typing.List[NumberRange]:
+    """Reverse lookups are served by the indexes on the SQLite resolution
+    table, which the compiled index has no equivalent of"""
+
+    raise ValueError(
+      f"{self.index_path} does not support reverse lookups; use the "
+      f"{SQLITE_BACKEND} backend with a database built by "
+      "build/build_npa_db.py")
+
+  def _area_code_status(
+    self,
+    area_code: str
+  ) -> typing.Tuple[LookupStatus, typing.Optional[str]]:
+    base = int(area_code) * INDEX_NPA_FIELDS
+    status = self.__npa[base]
+    if status == INDEX_NPA_MISSING:
+      return LookupStatus.AREA_CODE_NOT_FOUND, None
+    if status == INDEX_NPA_INVALID:
+      return LookupStatus.INVALID_AREA_CODE, None
+    return LookupStatus.OK, self.__strings[self.__npa[base + 1]]
+
+  def _has_assignable_exchange(self, number: str) -> bool:
+    return self.__exchanges[int(number[0:6])] != 0
+
+
+@dataclasses.dataclass
+class _Snapshot:
+  """A pinned repository served by a reloading locator, and the number of
+  lookups currently using it"""
+
+  repository: typing.Any
+  signature: tuple
+  import_id: typing.Optional[str]
+  users: int = 0
+  retired: bool = False
+
+
+class __ReloadingMetadataRepository(__NumberLocator):
+  """A SQLite locator for long-lived services that picks up a replaced database
+  without downtime. A background thread checks the database file every
+  reload_check_interval seconds. Once it has been replaced, the thread opens
+  the new snapshot, warms its caches by replaying recently looked up numbers,
+  and swaps it in. Lookups already under way finish on the snapshot they
+  started with, which is closed once the last of them is done. Every result
+  reports the importId of the snapshot that served it.
+
+  A lookup that finds the snapshot's file already replaced wakes the
+  background thread and waits for it to swap in the new snapshot, so loading
+  and warming never happen on the caller's thread."""
+
+  def __init__(
+    self,
+    open_snapshot: typing.Callable[[], typing.Any],
+    db_path: str,
+    reload_check_interval: float = DEFAULT_RELOAD_CHECK_INTERVAL,
+    warm_size: int = DEFAULT_RELOAD_WARM_SIZE
+  ):
+    self.db_path = db_path
+    self.reload_check_interval = reload_check_interval
+    self.__open_snapshot = open_snapshot
+    self.__lock = threading.Lock()
+    # Notified whenever a new snapshot is swapped in
+    self.__swapped = threading.Condition(self.__lock)
+    self.__reload_lock = threading.Lock()
+    # Held while entering or exiting, so that one thread's teardown never
+    # overlaps another thread's entry
+    self.__context_lock = threading.Lock()
+    self.__depth = 0
+    self.__snapshot = None
+    self.__recent = collections.deque(maxlen=warm_size)
+    self.__stopped = threading.Event()
+    self.__wake = threading.Event()
+    self.__watcher = None
+
+  def __enter__(self):
+    with self.__context_lock:
+      if self.__depth > 0:
+        self.__depth += 1
+        return self
+
+      # The context only counts as entered once it can serve lookups, so a
+      # failure here (e.g. a missing database) leaves it closed
+      snapshot = self.__prepare()
+      try:
+        self.__stopped.clear()
+        self.__wake.clear()
+        self.__watcher = threading.Thread(
+          target=self.__watch,
+          name='phone2geo-reloader',
+          daemon=True)
+        with self.__lock:
+          self.__snapshot = snapshot
+        self.__watcher.start()
+      except BaseException:
+        with self.__lock:
+          self.__snapshot = None
+        self.__retire(snapshot)
+        raise
+
+      self.__depth += 1
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    with self.__context_lock:
+      self.__depth -= 1
+      if self.__depth > 0:
+        return
+
+      self.__stopped.set()
+      self.__wake.set()
+      self.__watcher.join()
+      with self.__reload_lock:
+        with self.__swapped:
+          snapshot, self.__snapshot = self.__snapshot, None
+          self.__swapped.notify_all()
+        self.__retire(snapshot)
+
+  @property
+  def import_id(self) -> typing.Optional[str]:
+    """The importId of the snapshot new lookups are served from"""
+
+    return self.__snapshot.import_id
+
+  def cache_stats(self) -> typing.Dict[str, CacheStats]:
+    """Report the row cache statistics of the current snapshot"""
+
+    return self.__snapshot.repository.cache_stats()
+
+  def stats(self) -> typing.Optional[LookupStats]:
+    return self.__snapshot.repository.stats()
+
+  def reload(self) -> bool:
+    """Swap in the database file at db_path now if it is not the snapshot
+    being served, returning whether it was. The background thread calls this
+    periodically."""
+
+    with self.__reload_lock:
+      if self.__snapshot is None:
+        return False
+      if _file_signature(self.db_path) == self.__snapshot.signature:
+        return False
+
+      # Warm-up lookups are not real lookups, so they bypass instrumentation
+      snapshot = self.__prepare()
+      snapshot.repository._warm(list(self.__recent))
+
+      with self.__swapped:
+        previous, self.__snapshot = self.__snapshot, snapshot
+        self.__swapped.notify_all()
+      self.__retire(previous)
+      return True
+
+  def __watch(self):
+    while not self.__stopped.is_set():
+      self.__wake.wait(self.reload_check_interval)
+      self.__wake.clear()
+      if self.__stopped.is_set():
+        return
+
+      try:
+        self.reload()
+      except (OSError, sqlite3.Error):
+        # The new file may be missing or unreadable for a moment while it is
+        # being put in place; keep serving the current snapshot and retry at
+        # the next check
+        pass
+
+  def __prepare(self) -> _Snapshot:
+    """Open and pin a repository for the file currently at db_path"""
+
+    while True:
+      repository = self.__open_snapshot().__enter__()
+      try:
+        import_id = repository.import_id
+      except _SnapshotReplacedError:
+        # Replaced while connecting; open whatever replaced it instead
+        repository.__exit__(None, None, None)
+        continue
+      return _Snapshot(repository, repository.pinned_signature, import_id)
+
+  def __retire(self, snapshot: _Snapshot):
+    with self.__lock:
+      snapshot.retired = True
+      idle = snapshot.users == 0
+    if idle:
+      self.__close(snapshot)
+
+  def __acquire(self) -> _Snapshot:
+    """Claim the current snapshot for a lookup, making sure the calling thread
+    is connected to the snapshot's file rather than one that replaced it"""
+
+    while True:
+      with self.__lock:
+        snapshot = self.__snapshot
+        if snapshot is None:
+          raise ValueError(
+            'Lookups require the reloading locator to be entered as a managed '
+            'context')
+        snapshot.users += 1
+
+      try:
+        snapshot.repository.conn
+        return snapshot
+      except _SnapshotReplacedError:
+        self.__release(snapshot)
+        with self.__swapped:
+          self.__wake.set()
+          self.__swapped.wait_for(
+            lambda: self.__snapshot is not snapshot,
+            self.reload_check_interval)
+
+  def __release(self, snapshot: _Snapshot):
+    with self.__lock:
+      snapshot.users -= 1
+      idle = snapshot.retired and snapshot.users == 0
+    if idle:
+      self.__close(snapshot)
+
+  @staticmethod
+  def __close(snapshot: _Snapshot):
+    """Close an idle retired snapshot, including the connections other threads
+    opened to it, since none of them can use it again"""
+
+    snapshot.repository.__exit__(None, None, None)
+    snapshot.repository._close_all()
+
+  def lookup(self, number: str) -> LookupResult:
+    snapshot = self.__acquire()
+    try:
+      result = snapshot.repository.lookup(number)
     finally:
-      cursor.close()
+      self.__release(snapshot)
+
+    self.__recent.append(number)
+    return LookupResult(
+      result.status,
+      result.record,
+      result.error,
+      snapshot.import_id)
+
+  def lookup_many(
+    self,
+    numbers: typing.Iterable[str],
+    batch_size: int = DEFAULT_BATCH_SIZE
+  ) -> typing.Iterator[LookupResult]:
+    """Look up many numbers, all against the snapshot current when iteration
+    begins"""
+
+    snapshot = self.__acquire()
+    try:
+      for result in snapshot.repository.lookup_many(
+          self.__recorded(numbers),
+          batch_size):
+        yield LookupResult(
+          result.status,
+          result.record,
+          result.error,
+          snapshot.import_id)
+    finally:
+      self.__release(snapshot)
+
+  def __recorded(self, numbers: typing.Iterable[str]) -> typing.Iterator[str]:
+    """Pass numbers through, remembering them for warming the next snapshot"""
+
+    for number in numbers:
+      self.__recent.append(number)
+      yield number
+
+  def filter_potentially_valid_numbers(
+    self,
+    numbers: typing.Iterable[str],
+    batch_size: int = DEFAULT_BATCH_SIZE
+  ) -> typing.Iterator[str]:
+    snapshot = self.__acquire()
+    try:
+      yield from snapshot.repository.filter_potentially_valid_numbers(
+        numbers,
+        batch_size)
+    finally:
+      self.__release(snapshot)
+
+  def find_ranges(
+    self,
+    region: typing.Optional[str] = None,
+    rate_center: typing.Optional[str] = None,
+    operating_company_number: typing.Optional[str] = None,
+    carrier: typing.Optional[str] = None
+  ) -> typing.List[NumberRange]:
+    snapshot = self.__acquire()
+    try:
+      return snapshot.repository.find_ranges(
+        region,
+        rate_center,
+        operating_company_number,
+        carrier)
+    finally:
+      self.__release(snapshot)
 
+  def _area_code_status(
+    self,
+    area_code: str
+  ) -> typing.Tuple[LookupStatus, typing.Optional[str]]:
+    snapshot = self.__acquire()
+    try:
+      return snapshot.repository._area_code_status(area_code)
+    finally:
+      self.__release(snapshot)
 
-def number_locator() -> __MetadataRepository:
+  def _has_assignable_exchange(self, number: str) -> bool:
+    snapshot = self.__acquire()
+    try:
+      return snapshot.repository._has_assignable_exchange(number)
+    finally:
+      self.__release(snapshot)
+
+
+def number_locator(backend: str = SQLITE_BACKEND, **options) -> __NumberLocator:
   """Open a connection to the metadata repository as a managed context. Will
-  maintain an open connection until the context is exited."""
+  maintain an open connection until the context is exited. The compiled
+  backend reads the memory-mapped index emitted alongside the database by
+  build/build_npa_db.py instead of querying SQLite.
+
+  The SQLite backend accepts a db_path option to read a database other than
+  carrier_meta.sqlite3, npa_cache_size, nxx_cache_size, block_cache_size,
+  resolution_cache_size, and replacement_check_interval options to tune its
+  row caches, a resolution_table option that may be set to False to ignore the
+  materialized resolution table, and an instrumentation option (a
+  LookupInstrumentation) to time each lookup stage. The compiled backend only
+  accepts an index_path option to read an index other than carrier_meta.idx.
+  Raises a TypeError for any option the backend does not support."""
 
-  return __MetadataRepository(os.path.join(
-    os.path.dirname(os.path.abspath(__file__)),
-    'carrier_meta.sqlite3'
-  ))
+  if backend == SQLITE_BACKEND:
+    return __MetadataRepository(options.pop('db_path', DEFAULT_DB_PATH), **options)
+  if backend == COMPILED_BACKEND:
+    index_path = options.pop('index_path', DEFAULT_INDEX_PATH)
+    if len(options) > 0:
+      raise TypeError(
+        f"The {COMPILED_BACKEND} backend does not support the options: "
+        f"{', '.join(sorted(options))}")
+    return __CompiledMetadataRepository(index_path)
+
+  raise ValueError(f"Unknown metadata backend: {backend}")
+
+
+def reloading_locator(
+  db_path: str = DEFAULT_DB_PATH,
+  reload_check_interval: float = DEFAULT_RELOAD_CHECK_INTERVAL,
+  warm_size: int = DEFAULT_RELOAD_WARM_SIZE,
+  **options
+) -> __NumberLocator:
+  """Open a SQLite locator that swaps in a replaced database in the
+  background, as a managed context. Accepts the same options as the SQLite
+  backend of number_locator. warm_size bounds the number of recently looked up
+  numbers replayed against each new snapshot before it is swapped in."""
+
+  def open_snapshot():
+    return __MetadataRepository(db_path, pinned=True, **options)
+
+  return __ReloadingMetadataRepository(
+    open_snapshot,
+    db_path,
+    reload_check_interval,
+    warm_size)
+
+
+class __SharedMetadataRepository(__MetadataRepository):
+  """The process-wide SQLite locator. Its connections live as long as the
+  process, so entering and exiting it as a managed context does nothing and
+  user code can never close a connection another thread is reading from."""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    pass
+
+
+__shared_locator = None
+__shared_locator_lock = threading.Lock()
+
+
+def shared_locator() -> __NumberLocator:
+  """Return the process-wide SQLite locator used by the module-level lookup
+  functions. It keeps one pooled read-only connection per thread for the life
+  of the process and does not need to be entered as a managed context;
+  entering it does nothing."""
+
+  global __shared_locator
+  if __shared_locator is None:
+    with __shared_locator_lock:
+      if __shared_locator is None:
+        __shared_locator = __SharedMetadataRepository(DEFAULT_DB_PATH)
+  return __shared_locator
 
 
 def locate_number(number: str) -> MetadataRecord:
   """Fetch broad geolocation data for a number administered by the North
   American Numbering Plan Administrator."""
 
-  with number_locator() as locator:
-    return locator.locate_number(number)
+  return shared_locator().locate_number(number)
+
+
+def locate_numbers(
+  numbers: typing.Iterable[str]
+) -> typing.Iterator[typing.Union[MetadataRecord, Exception]]:
+  """Fetch broad geolocation data for many numbers at once. Yields, in input
+  order, a MetadataRecord for each number or the exception raised while
+  locating it."""
+
+  yield from shared_locator().locate_numbers(numbers)
+
+
+if __name__ == '__main__':
+  import phone2geo_cli
+  sys.exit(phone2geo_cli.main())
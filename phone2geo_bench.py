@@ -0,0 +1,454 @@
+import argparse
+import dataclasses
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import typing
+
+import phone2geo
+import phone2geo_build
+
+WORKLOADS = ('uniform', 'skewed', 'invalid', 'non_us')
+BACKENDS = (phone2geo.SQLITE_BACKEND, phone2geo.COMPILED_BACKEND)
+DEFAULT_SIZE = 20000
+DEFAULT_THRESHOLD = 0.25
+
+# Metrics whose names end with one of these suffixes are better when lower;
+# every other metric is a throughput and is better when higher
+LOWER_IS_BETTER = ('_us', '_seconds')
+
+DEFAULT_TRIALS = 5
+
+# The only metrics compared against a baseline: medians taken across repeated
+# trials. Tail latencies, means, and single runs vary too much from one run to
+# the next on an unchanged tree, so every other metric is reported for
+# information only.
+GATED_METRICS = ('p50_us', 'numbers_per_sec')
+
+# Measurements reported for information only, whatever their metrics. Both
+# are dominated by starting interpreters and opening files rather than by
+# lookups.
+INFORMATIONAL_MEASUREMENTS = ('cold_start', 'locate_number.new_context')
+
+# The exceptions locate_number raises for numbers that cannot be located
+LOOKUP_ERRORS = (
+  phone2geo.InvalidNumberError,
+  phone2geo.InvalidAreaCodeError,
+  phone2geo.AreaCodeNotFoundError,
+  phone2geo.InvalidExchangeError,
+)
+
+parser = argparse.ArgumentParser(
+  prog='python -m phone2geo_bench',
+  description='''Benchmarks phone2geo against synthetic workloads generated from
+  the carrier metadata database and writes the results as JSON. When a baseline
+  is provided, exits with a non-zero status if any metric regressed by more than
+  the threshold.''')
+parser.add_argument('-o', '--output', default='-', help='''The file to which
+  results will be written. Writes to stdout when omitted or "-".''')
+parser.add_argument('--baseline', help='''A results file from a previous run to
+  compare against.''')
+parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+  help='''The relative change (e.g. 0.25 for 25%%) beyond which a metric is
+  considered to have regressed.''')
+parser.add_argument('--size', type=int, default=DEFAULT_SIZE, help='''The
+  number of numbers in each workload.''')
+parser.add_argument('--seed', type=int, default=0, help='''The seed used to
+  generate workloads, so that runs can be compared.''')
+parser.add_argument('--backend', action='append', choices=BACKENDS, help='''A
+  backend to benchmark. May be repeated; defaults to every backend.''')
+parser.add_argument('--workload', action='append', choices=WORKLOADS,
+  help='''A workload to run. May be repeated; defaults to every workload.''')
+parser.add_argument('--trials', type=int, default=DEFAULT_TRIALS, help='''The
+  number of times each steady-state measurement is repeated. Only the medians
+  across trials are compared against a baseline.''')
+parser.add_argument('--cold-start-runs', type=int, default=5, help='''The
+  number of fresh interpreters started to measure cold-start time.''')
+
+
+@dataclasses.dataclass(frozen=True)
+class WorkloadSource:
+  """The exchanges and area codes from which synthetic numbers are drawn"""
+
+  # 6-digit NPA-NXX keys of assignable exchanges in US area codes
+  us_exchanges: typing.List[str]
+  # Usable area codes assigned outside of the US
+  non_us_area_codes: typing.List[str]
+
+
+def load_workload_source(
+  db_path: str = phone2geo.DEFAULT_DB_PATH
+) -> WorkloadSource:
+  """Read the exchanges and area codes used to build workloads from the
+  carrier metadata database"""
+
+  conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+  try:
+    us_area_codes = set()
+    non_us_area_codes = []
+    for (area_code, usable, _, country, _,
+        _) in phone2geo_build.scan_area_codes(conn):
+      if usable and country == 'US':
+        us_area_codes.add(area_code)
+      elif usable and country is not None:
+        non_us_area_codes.append(f"{area_code:03d}")
+
+    us_exchanges = [
+      f"{key:06d}"
+      for key, *_ in phone2geo_build.scan_exchanges(conn)
+      if key // 1000 in us_area_codes
+    ]
+  finally:
+    conn.close()
+
+  if len(us_exchanges) == 0:
+    raise ValueError(f"No assignable US exchanges were found in {db_path}")
+
+  return WorkloadSource(us_exchanges, non_us_area_codes)
+
+
+def __subscriber(rng: random.Random) -> str:
+  return f"{rng.randrange(10000):04d}"
+
+
+def __invalid_number(rng: random.Random, source: WorkloadSource) -> str:
+  number = rng.choice(source.us_exchanges) + __subscriber(rng)
+  mistake = rng.randrange(4)
+  if mistake == 0:
+    return number[:rng.randrange(1, 10)] # Too few digits
+  if mistake == 1:
+    return number + str(rng.randrange(10)) # Too many digits
+  if mistake == 2:
+    return str(rng.randrange(2)) + number[1:] # Area codes cannot start with 0/1
+  position = rng.randrange(10)
+  return number[:position] + 'o' + number[position + 1:] # Letters cannot be used
+
+
+def generate_workload(
+  name: str,
+  size: int,
+  source: WorkloadSource,
+  seed: int = 0
+) -> typing.List[str]:
+  """Generate a list of numbers for one of the named workloads:
+
+  uniform: valid US numbers drawn evenly from every assignable exchange
+  skewed: valid US numbers where 90% of traffic hits 1% of exchanges
+  invalid: numbers that are not formatted as NANP numbers
+  non_us: 90% numbers from non-US area codes and 10% uniform US numbers"""
+
+  rng = random.Random(f"{name}:{seed}")
+  exchanges = source.us_exchanges
+
+  if name == 'uniform':
+    return [rng.choice(exchanges) + __subscriber(rng) for _ in range(size)]
+
+  if name == 'skewed':
+    hot = rng.sample(exchanges, max(1, len(exchanges) // 100))
+    return [
+      rng.choice(hot if rng.random() < 0.9 else exchanges) + __subscriber(rng)
+      for _ in range(size)
+    ]
+
+  if name == 'invalid':
+    return [__invalid_number(rng, source) for _ in range(size)]
+
+  if name == 'non_us':
+    if len(source.non_us_area_codes) == 0:
+      raise ValueError('No non-US area codes are available')
+    return [
+      rng.choice(source.non_us_area_codes)
+      + f"{rng.randrange(200, 1000):03d}"
+      + __subscriber(rng)
+      if rng.random() < 0.9
+      else rng.choice(exchanges) + __subscriber(rng)
+      for _ in range(size)
+    ]
+
+  raise ValueError(f"Unknown workload: {name}")
+
+
+def latency_percentiles(
+  trials: typing.List[typing.List[int]]
+) -> typing.Dict[str, float]:
+  """Summarize per-call latencies, in nanoseconds, from one or more trials as
+  microsecond metrics. p50_us is the median of each trial's median; the other
+  percentiles are taken over the samples of every trial."""
+
+  samples = sorted(sample for trial in trials for sample in trial)
+
+  def percentile(p):
+    return samples[min(len(samples) - 1, int(p * len(samples)))] / 1000
+
+  return {
+    'p50_us': statistics.median(statistics.median(trial) for trial in trials) / 1000,
+    'p90_us': percentile(0.90),
+    'p99_us': percentile(0.99),
+    'max_us': samples[-1] / 1000,
+    'mean_us': statistics.fmean(samples) / 1000,
+  }
+
+
+def throughput(size: int, trials: typing.List[float]) -> typing.Dict[str, float]:
+  """Summarize the seconds taken to process size numbers in each trial. The
+  median trial is compared; the fastest is reported for information."""
+
+  return {
+    'numbers_per_sec': size / max(statistics.median(trials), 1e-9),
+    'best_numbers_per_sec': size / max(min(trials), 1e-9),
+  }
+
+
+def __time_calls(fn, numbers) -> typing.List[int]:
+  samples = []
+  clock = time.perf_counter_ns
+  for number in numbers:
+    started = clock()
+    try:
+      fn(number)
+    except LOOKUP_ERRORS:
+      pass
+    samples.append(clock() - started)
+  return samples
+
+
+def __time_batch(fn, numbers) -> float:
+  started = time.perf_counter()
+  fn(numbers)
+  return time.perf_counter() - started
+
+
+def measure_cold_start(backend: str, runs: int) -> typing.Dict[str, float]:
+  """Time fresh interpreters importing phone2geo, opening a locator, and
+  resolving a single number. The time taken by the interpreter itself is
+  measured separately and subtracted."""
+
+  script = (
+    'import phone2geo\n'
+    f"with phone2geo.number_locator({backend!r}) as locator:\n"
+    "  locator.is_potentially_valid_number('2128675309')\n")
+
+  def run(code):
+    started = time.perf_counter()
+    subprocess.run(
+      [sys.executable, '-c', code],
+      check=True,
+      cwd=os.path.dirname(os.path.abspath(phone2geo.__file__)))
+    return time.perf_counter() - started
+
+  interpreter = statistics.median(run('pass') for _ in range(runs))
+  total = statistics.median(run(script) for _ in range(runs))
+  return {'median_seconds': max(total - interpreter, 0.0)}
+
+
+def benchmark_backend(
+  backend: str,
+  workloads: typing.Dict[str, typing.List[str]],
+  cold_start_runs: int,
+  trials: int = DEFAULT_TRIALS
+) -> typing.Dict[str, typing.Dict[str, float]]:
+  """Run every measurement for one backend, returning metrics by name"""
+
+  results = {}
+  if cold_start_runs > 0:
+    results['cold_start'] = measure_cold_start(backend, cold_start_runs)
+
+  with phone2geo.number_locator(backend) as locator:
+    single = {'locate_number': locator.locate_number, 'lookup': locator.lookup}
+    batch = {
+      'locate_numbers': lambda numbers: list(locator.locate_numbers(numbers)),
+      'filter_potentially_valid_numbers':
+        lambda numbers: list(locator.filter_potentially_valid_numbers(numbers)),
+    }
+
+    for name, numbers in workloads.items():
+      # Warm the caches and page in the index before measuring steady state.
+      # Set-based queries bypass the row caches, so they are warmed one lookup
+      # at a time and every API is measured against the same cache state.
+      for number in numbers:
+        locator.lookup(number)
+
+      # Trials of each API are interleaved so that drift over the run affects
+      # them all alike
+      timings = {api: [] for api in (*single, *batch)}
+      for _ in range(trials):
+        for api, fn in single.items():
+          timings[api].append(__time_calls(fn, numbers))
+        for api, fn in batch.items():
+          timings[api].append(__time_batch(fn, numbers))
+
+      for api in single:
+        results[f"{api}.{name}"] = latency_percentiles(timings[api])
+      for api in batch:
+        results[f"{api}.{name}"] = throughput(len(numbers), timings[api])
+
+  # Opening a locator per lookup is what callers that do not reuse a managed
+  # context pay, so it is measured against a small sample only
+  sample = workloads[next(iter(workloads))][:1000]
+
+  def unpooled(number):
+    with phone2geo.number_locator(backend) as locator:
+      return locator.locate_number(number)
+
+  results['locate_number.new_context'] = latency_percentiles(
+    [__time_calls(unpooled, sample)])
+
+  return results
+
+
+def benchmark_vectorized(
+  workloads: typing.Dict[str, typing.List[str]],
+  trials: int = DEFAULT_TRIALS
+) -> typing.Dict[str, typing.Dict[str, float]]:
+  """Measure locate_array throughput when numpy is available"""
+
+  try:
+    import numpy as np
+    import phone2geo_vectorized
+  except ImportError:
+    return {}
+
+  tables = phone2geo_vectorized.load_tables()
+  results = {}
+  for name, numbers in workloads.items():
+    if name == 'invalid':
+      # locate_array takes integers, so malformed strings cannot be expressed
+      continue
+    array = np.array([int(number) for number in numbers], dtype=np.int64)
+    results[f"locate_array.{name}"] = throughput(len(array), [
+      __time_batch(
+        lambda batch: phone2geo_vectorized.locate_array(batch, tables), array)
+      for _ in range(trials)
+    ])
+  return results
+
+
+def run_benchmarks(
+  backends: typing.Iterable[str] = BACKENDS,
+  workload_names: typing.Iterable[str] = WORKLOADS,
+  size: int = DEFAULT_SIZE,
+  seed: int = 0,
+  cold_start_runs: int = 5,
+  trials: int = DEFAULT_TRIALS
+) -> dict:
+  """Run the benchmark suite, returning a JSON-serializable report"""
+
+  source = load_workload_source()
+  workloads = {
+    name: generate_workload(name, size, source, seed) for name in workload_names
+  }
+
+  results = {}
+  for backend in backends:
+    for name, metrics in benchmark_backend(
+        backend, workloads, cold_start_runs, trials).items():
+      results[f"{backend}.{name}"] = metrics
+  for name, metrics in benchmark_vectorized(workloads, trials).items():
+    results[f"vectorized.{name}"] = metrics
+
+  stat = os.stat(phone2geo.DEFAULT_DB_PATH)
+  return {
+    'environment': {
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'cpus': os.cpu_count(),
+      'database_size': stat.st_size,
+      'database_mtime': stat.st_mtime,
+    },
+    'parameters': {'size': size, 'seed': seed, 'trials': trials},
+    'results': results,
+  }
+
+
+def compare(
+  report: dict,
+  baseline: dict,
+  threshold: float = DEFAULT_THRESHOLD
+) -> typing.List[str]:
+  """Describe every gated metric in report that is worse than the same metric
+  in baseline by more than threshold. Metrics missing from either, and
+  informational measurements, are ignored."""
+
+  regressions = []
+  for name, metrics in sorted(report['results'].items()):
+    if name.endswith(INFORMATIONAL_MEASUREMENTS):
+      continue
+
+    for metric, value in sorted(metrics.items()):
+      if metric not in GATED_METRICS:
+        continue
+
+      previous = baseline['results'].get(name, {}).get(metric)
+      if previous is None or previous <= 0:
+        continue
+
+      change = (value - previous) / previous
+      if not metric.endswith(LOWER_IS_BETTER):
+        change = -change
+      if change > threshold:
+        regressions.append(
+          f"{name} {metric}: {previous:,.2f} -> {value:,.2f} "
+          f"({change:+.0%} worse)")
+
+  return regressions
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> int:
+  args = parser.parse_args(argv)
+  if args.size < 1:
+    parser.error('--size must be at least 1')
+  if args.trials < 1:
+    parser.error('--trials must be at least 1')
+
+  backends = args.backend
+  if backends is None:
+    # The compiled index is optional, so it is only benchmarked by default
+    # when it has been built
+    backends = [
+      backend for backend in BACKENDS
+      if backend != phone2geo.COMPILED_BACKEND
+      or os.path.exists(phone2geo.DEFAULT_INDEX_PATH)
+    ]
+    if len(backends) < len(BACKENDS):
+      sys.stderr.write(
+        f"Skipping the {phone2geo.COMPILED_BACKEND} backend, as "
+        f"{phone2geo.DEFAULT_INDEX_PATH} has not been compiled\n")
+  elif (phone2geo.COMPILED_BACKEND in backends
+      and not os.path.exists(phone2geo.DEFAULT_INDEX_PATH)):
+    parser.error(
+      f"{phone2geo.DEFAULT_INDEX_PATH} has not been compiled; run "
+      "build/build_npa_db.py first")
+
+  report = run_benchmarks(
+    backends,
+    args.workload or WORKLOADS,
+    args.size,
+    args.seed,
+    args.cold_start_runs,
+    args.trials)
+
+  text = json.dumps(report, indent=2, sort_keys=True) + '\n'
+  if args.output == '-':
+    sys.stdout.write(text)
+  else:
+    with open(args.output, 'w', encoding='utf-8') as outfile:
+      outfile.write(text)
+
+  if args.baseline is None:
+    return 0
+
+  with open(args.baseline, 'r', encoding='utf-8') as infile:
+    regressions = compare(report, json.load(infile), args.threshold)
+  for regression in regressions:
+    sys.stderr.write(f"Regression: {regression}\n")
+  return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,253 @@
+import array
+import sqlite3
+import sys
+import typing
+
+import phone2geo
+
+# Reads the npa, npa_nxx, and blocks tables of a carrier metadata database
+# imported by build/build_npa_db.py, and writes the structures derived from
+# them: the materialized resolution table and the compiled index. The scans
+# apply the same rules as locate_number, so that every structure derived from
+# them (including the vectorized lookup tables and benchmark workloads) agrees
+# with the lookups of the runtime module, which only ever reads.
+
+
+def scan_area_codes(conn: sqlite3.Connection) -> typing.Iterator[tuple]:
+  """Yield (NPA, usable, explanation, country, time zone, location) for every
+  well-formed row of the npa table, applying the same rules as locate_number.
+  The explanation is only meaningful for unusable area codes."""
+
+  cursor = conn.execute(
+    'SELECT NPA_ID, ASSIGNABLE, EXPLANATION, IN_SERVICE, ASSIGNED, COUNTRY, '
+    'TIME_ZONE, LOCATION FROM npa')
+  for (area_code, assignable, explanation, in_service, assigned, country,
+      time_zone, location) in cursor:
+    if not area_code.isdigit() or len(area_code) != 3:
+      continue
+
+    if assignable == 'No':
+      yield int(area_code), False, explanation, None, None, None
+    elif in_service == 'N' or assigned == 'No':
+      yield int(area_code), False, "Area code not in service", None, None, None
+    else:
+      yield (
+        int(area_code),
+        True,
+        None,
+        country if country != '' else None,
+        time_zone if time_zone != '' else None,
+        location if location != '' else None
+      )
+
+
+def scan_exchanges(conn: sqlite3.Connection) -> typing.Iterator[tuple]:
+  """Yield (NPA * 1000 + NXX, state, rate center, OCN, company) for every
+  assignable exchange in the npa_nxx table, in key order."""
+
+  cursor = conn.execute(
+    'SELECT NPA_NXX, Use, State, RateCenter, OCN, Company FROM npa_nxx '
+    'ORDER BY NPA_NXX')
+  for npa_nxx, use, state, rate_center, ocn, company in cursor:
+    key = npa_nxx.replace('-', '')
+    if use == 'UA' or not key.isdigit() or len(key) != 6:
+      continue
+
+    yield int(key), state, rate_center, ocn, company
+
+
+def scan_blocks(conn: sqlite3.Connection) -> typing.Iterator[tuple]:
+  """Yield (NPA * 1000 + NXX, X, state, rate center, OCN, assigned to) for every
+  well-formed row of the blocks table, in key order. Rows are not filtered by
+  the validity of their exchange."""
+
+  cursor = conn.execute(
+    'SELECT NPA, NXX, X, State, Rate_Center, OCN, Assigned_To FROM blocks '
+    'ORDER BY NPA, NXX, X')
+  for npa, nxx, x, state, rate_center, ocn, assigned_to in cursor:
+    key = npa + nxx
+    if not (key + x).isdigit() or len(key) != 6 or len(x) != 1:
+      continue
+
+    yield int(key), int(x), state, rate_center, ocn, assigned_to
+
+
+def write_compiled_index(db_path: str, index_path: str):
+  """Compile the npa, npa_nxx, and blocks tables of a carrier metadata
+  database into the dense array format read by the compiled backend."""
+
+  strings = {None: 0}
+
+  def string_id(value):
+    if value not in strings:
+      strings[value] = len(strings)
+    return strings[value]
+
+  conn = sqlite3.connect(db_path)
+  try:
+    npa = array.array('I', bytes(1000 * phone2geo.INDEX_NPA_FIELDS * 4))
+    for area_code, usable, explanation, *geography in scan_area_codes(conn):
+      base = area_code * phone2geo.INDEX_NPA_FIELDS
+      if usable:
+        npa[base] = phone2geo.INDEX_NPA_VALID
+        for offset, value in enumerate(geography, 1):
+          npa[base + offset] = string_id(value)
+      else:
+        npa[base] = phone2geo.INDEX_NPA_INVALID
+        npa[base + 4] = string_id(explanation)
+
+    exchanges = array.array('I', bytes(1000 * 1000 * 4))
+    exchange_records = array.array('I', [0] * phone2geo.INDEX_EXCHANGE_FIELDS)
+    for key, *values in scan_exchanges(conn):
+      exchanges[key] = len(exchange_records) // phone2geo.INDEX_EXCHANGE_FIELDS
+      exchange_records.extend([string_id(value) for value in values] + [0])
+
+    block_groups = array.array('I', [0] * 10)
+    block_records = array.array('I', [0] * phone2geo.INDEX_BLOCK_FIELDS)
+    for key, x, *values in scan_blocks(conn):
+      exchange = exchanges[key]
+      if exchange == 0:
+        # Blocks are only consulted for valid exchanges
+        continue
+
+      group_field = exchange * phone2geo.INDEX_EXCHANGE_FIELDS + 4
+      if exchange_records[group_field] == 0:
+        exchange_records[group_field] = len(block_groups) // 10
+        block_groups.extend([0] * 10)
+
+      block_groups[exchange_records[group_field] * 10 + x] = \
+        len(block_records) // phone2geo.INDEX_BLOCK_FIELDS
+      block_records.extend([string_id(value) for value in values])
+  finally:
+    conn.close()
+
+  blob = bytearray()
+  offsets = array.array('I', [0])
+  for value in sorted(strings, key=strings.get):
+    blob.extend(value.encode('utf-8') if value is not None else b'')
+    offsets.append(len(blob))
+  blob.extend(bytes(-len(blob) % 4))
+
+  sections = [offsets, blob, npa, exchanges, exchange_records, block_groups,
+    block_records]
+  with open(index_path, 'wb') as index_file:
+    index_file.write(phone2geo.INDEX_HEADER.pack(
+      phone2geo.INDEX_MAGIC, *[len(section) for section in sections]))
+    for section in sections:
+      if isinstance(section, array.array) and sys.byteorder != 'little':
+        section = array.array('I', section)
+        section.byteswap()
+      index_file.write(section)
+
+
+def write_resolution_table(conn: sqlite3.Connection):
+  """(Re)build the materialized resolution table from the npa, npa_nxx, and
+  blocks tables of a writable carrier metadata database"""
+
+  rows = []
+  us_time_zones = {}
+  for (area_code, usable, explanation, country, time_zone,
+      location) in scan_area_codes(conn):
+    if not usable:
+      rows.append((
+        area_code, phone2geo.LookupStatus.INVALID_AREA_CODE,
+        None, None, None, None, None, None, explanation))
+    elif country == 'US':
+      us_time_zones[area_code] = time_zone
+      rows.append((
+        area_code, phone2geo.LookupStatus.INVALID_EXCHANGE,
+        None, None, None, None, None, None, None))
+    else:
+      rows.append((
+        area_code, phone2geo.LookupStatus.OK,
+        country, time_zone, location, None, None, None, None))
+
+  # Exchanges and blocks are only consulted for US numbers, and blocks only
+  # within an assignable exchange
+  exchanges = set()
+  for key, *geography in scan_exchanges(conn):
+    if key // 1000 in us_time_zones:
+      exchanges.add(key)
+      rows.append((
+        key, phone2geo.LookupStatus.OK,
+        'US', us_time_zones[key // 1000], *geography, None))
+
+  for key, x, *geography in scan_blocks(conn):
+    if key in exchanges:
+      rows.append((
+        key * 10 + x, phone2geo.LookupStatus.OK,
+        'US', us_time_zones[key // 1000], *geography, None))
+
+  columns = phone2geo.RESOLUTION_COLUMNS
+  with conn:
+    conn.execute('DROP TABLE IF EXISTS resolution')
+    conn.execute(
+      'CREATE TABLE resolution (key INTEGER PRIMARY KEY, status INTEGER NOT '
+      f"NULL, {', '.join(col + ' TEXT' for col in columns[2:])})")
+    conn.executemany(
+      f"INSERT INTO resolution ({', '.join(columns)}) "
+      f"VALUES ({', '.join(['?'] * len(columns))})",
+      rows)
+
+
+def validate_resolution_table(db_path: str) -> int:
+  """Check that the resolution table resolves a number from every area code,
+  exchange, and block of the database exactly as the NPA -> NXX -> block
+  lookups do. Exchanges are checked with a block that is not pooled, if any.
+  Raises a ValueError describing the first disagreement and returns the
+  number of numbers checked otherwise."""
+
+  def describe(result):
+    error = result.error
+    return (
+      result.status,
+      result.record,
+      type(error).__name__ if error is not None else None,
+      vars(error) if error is not None else None)
+
+  with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+    area_codes = [
+      area_code for (area_code,) in conn.execute('SELECT NPA_ID FROM npa')
+      if phone2geo.PHONE_NUMBER_PATTERN.match(f"{area_code}0000000")
+    ]
+    pooled = {}
+    for npa, nxx, x in conn.execute('SELECT NPA, NXX, X FROM blocks'):
+      pooled.setdefault(f"{npa}{nxx}", set()).add(x)
+    exchanges = [
+      npa_nxx.replace('-', '')
+      for (npa_nxx,) in conn.execute('SELECT NPA_NXX FROM npa_nxx')
+    ]
+  conn.close()
+
+  numbers = [f"{area_code}0000000" for area_code in area_codes]
+  for exchange in exchanges:
+    unpooled = [x for x in '0123456789' if x not in pooled.get(exchange, ())]
+    if len(unpooled) > 0:
+      numbers.append(f"{exchange}{unpooled[0]}000")
+  for exchange, blocks in pooled.items():
+    numbers.extend(f"{exchange}{x}000" for x in sorted(blocks))
+  numbers = [
+    number for number in numbers
+    if number.isascii() and phone2geo.PHONE_NUMBER_PATTERN.match(number)
+  ]
+
+  stepwise = phone2geo.number_locator(
+    phone2geo.SQLITE_BACKEND,
+    db_path=db_path,
+    resolution_table=False)
+  materialized = phone2geo.number_locator(
+    phone2geo.SQLITE_BACKEND,
+    db_path=db_path)
+  with stepwise, materialized:
+    if not materialized.uses_resolution_table:
+      raise ValueError(f"{db_path} has no resolution table")
+
+    for number in numbers:
+      expected = describe(stepwise.lookup(number))
+      actual = describe(materialized.lookup(number))
+      if actual != expected:
+        raise ValueError(
+          f"The resolution table resolves {number} as {actual} rather than "
+          f"{expected}")
+
+  return len(numbers)
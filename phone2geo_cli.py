@@ -0,0 +1,399 @@
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import dataclasses
+import io
+import itertools
+import json
+import os
+import sys
+import time
+import typing
+
+import phone2geo
+
+FORMATS = ('csv', 'tsv', 'jsonl')
+DELIMITERS = {'csv': ',', 'tsv': '\t'}
+DEFAULT_CHUNK_SIZE = 10000
+
+# The name of the column added to each row identifying the error, if any,
+# raised while locating its number
+ERROR_COLUMN = 'error'
+
+parser = argparse.ArgumentParser(
+  prog='python -m phone2geo',
+  description='''Enriches a CSV, TSV, or JSONL stream with the geographic and
+  carrier metadata of the phone number in one of its columns. Rows are read,
+  enriched, and written in chunks, so inputs of any size can be processed in
+  bounded memory. Input that cannot be written without losing values (a
+  CSV/TSV row with more fields than the header, a JSONL record with a key the
+  CSV/TSV output header lacks, or an input column named like an appended
+  column) stops the tool with an error.''')
+parser.add_argument('input', nargs='?', default='-', help='''The file to
+  enrich. Reads from stdin when omitted or "-".''')
+parser.add_argument('-o', '--output', default='-', help='''The file to which
+  enriched rows will be written. Writes to stdout when omitted or "-".''')
+parser.add_argument('-c', '--column', required=True, help='''The name of the
+  column (or JSON key) holding the phone number.''')
+parser.add_argument('-f', '--format', choices=FORMATS, help='''The format of the
+  input. Inferred from the input file extension when omitted, defaulting to
+  csv.''')
+parser.add_argument('--output-format', choices=FORMATS, help='''The format of
+  the output. Defaults to the input format.''')
+parser.add_argument('--prefix', default='', help='''A prefix added to the name
+  of every column this tool appends, to avoid collisions with input columns.''')
+parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+  help='''The number of rows enriched at a time.''')
+parser.add_argument('--workers', type=int, default=0, help='''The number of
+  worker processes across which chunks are spread. Output order is preserved.
+  Chunks are enriched in this process when 0.''')
+parser.add_argument('--backend', default=phone2geo.SQLITE_BACKEND,
+  choices=(phone2geo.SQLITE_BACKEND, phone2geo.COMPILED_BACKEND),
+  help='''The metadata backend used to locate numbers.''')
+parser.add_argument('-q', '--quiet', action='store_true', help='''Suppress
+  progress reporting on stderr.''')
+
+
+RECORD_FIELDS = [
+  field.name for field in dataclasses.fields(phone2geo.MetadataRecord)
+]
+
+
+class MalformedRowError(Exception):
+  """An error raised when a row of the input cannot be enriched and written
+  without losing some of its values"""
+  pass
+
+
+def enrichment_columns(prefix: str = '') -> typing.List[str]:
+  """The names of the columns appended to every row"""
+
+  return [prefix + name for name in RECORD_FIELDS] + [prefix + ERROR_COLUMN]
+
+
+def output_columns(fields: typing.Iterable[str], prefix: str = '') -> typing.List[str]:
+  """The header written for rows with the given fields once enriched"""
+
+  return list(fields) + enrichment_columns(prefix)
+
+
+def colliding_columns(
+  fields: typing.Iterable[str],
+  prefix: str = ''
+) -> typing.List[str]:
+  """The appended columns that the given fields already have, and that
+  enriching them would overwrite"""
+
+  fields = set(fields)
+  return [name for name in enrichment_columns(prefix) if name in fields]
+
+
+def __collision_message(collisions: typing.List[str]) -> str:
+  return (
+    f"already has the columns {', '.join(collisions)}; pass --prefix to name "
+    "the appended columns apart")
+
+
+__locators = contextlib.ExitStack()
+__open_locators = {}
+
+
+def __locator(backend: str):
+  # Each process keeps its locator open across chunks
+  if backend not in __open_locators:
+    __open_locators[backend] = __locators.enter_context(
+      phone2geo.number_locator(backend))
+  return __open_locators[backend]
+
+
+def enrich_chunk(
+  rows: typing.List[dict],
+  column: str,
+  prefix: str = '',
+  backend: str = phone2geo.SQLITE_BACKEND
+) -> typing.List[dict]:
+  """Append metadata columns to each row in a chunk. Run in worker processes
+  when --workers is set, so it must remain importable at module level. Raises
+  a ValueError if a row already has one of the appended columns."""
+
+  columns = enrichment_columns(prefix)
+  names = set(columns)
+  for row in rows:
+    if not names.isdisjoint(row):
+      collisions = colliding_columns(row, prefix)
+      raise ValueError(f"A row {__collision_message(collisions)}")
+  numbers = [
+    str(row.get(column)) if row.get(column) is not None else '' for row in rows
+  ]
+  results = __locator(backend).locate_numbers(numbers)
+
+  enriched = []
+  for row, result in zip(rows, results):
+    if isinstance(result, Exception):
+      values = [None] * (len(columns) - 1) + [type(result).__name__]
+    else:
+      values = [getattr(result, name) for name in RECORD_FIELDS] + [None]
+    enriched.append({**row, **dict(zip(columns, values))})
+
+  return enriched
+
+
+def __infer_format(path: str) -> str:
+  extension = os.path.splitext(path)[1].lower().lstrip('.')
+  if extension in FORMATS:
+    return extension
+  if extension == 'json' or extension == 'ndjson':
+    return 'jsonl'
+  return 'csv'
+
+
+@dataclasses.dataclass(frozen=True)
+class __ChunkSpec:
+  """Everything a worker needs to turn a raw chunk of input into output text"""
+
+  input_format: str
+  output_format: str
+  column: str
+  prefix: str
+  backend: str
+  # The input header, for CSV/TSV input
+  input_fields: typing.Optional[typing.List[str]]
+  # The output header, for CSV/TSV output
+  output_fields: typing.Optional[typing.List[str]]
+
+
+def __parse_record(line: str, row_number: int) -> dict:
+  try:
+    record = json.loads(line)
+  except ValueError:
+    raise MalformedRowError(f"Line {row_number} of the input is not valid JSON")
+  if not isinstance(record, dict):
+    raise MalformedRowError(f"Line {row_number} of the input is not a JSON object")
+  return record
+
+
+def __render_chunk(
+  chunk: list,
+  spec: __ChunkSpec,
+  first_row: int = 1
+) -> typing.Tuple[typing.List[str], str, int]:
+  """Parse, enrich, and serialize one chunk of input. Chunks hold raw lines for
+  JSONL input and lists of values for CSV/TSV input, so that the parent process
+  only has to split the input and write the text returned. first_row is the
+  number of the chunk's first line (JSONL) or row after the header (CSV/TSV),
+  for error messages. Returns the output header, the serialized rows, and the
+  number of rows.
+
+  CSV/TSV rows with fewer fields than the header are padded with empty values,
+  but a row with more fields, a record with a key missing from the output
+  header, or a record that already has an appended column, raises a
+  MalformedRowError rather than losing values."""
+
+  if spec.input_format == 'jsonl':
+    numbered = [
+      (row_number, __parse_record(line, row_number))
+      for row_number, line in enumerate(chunk, first_row)
+      if line.strip() != ''
+    ]
+    location = 'Line'
+    # CSV/TSV headers are checked once up front, but every record has its own
+    for row_number, row in numbered:
+      collisions = colliding_columns(row, spec.prefix)
+      if len(collisions) > 0:
+        raise MalformedRowError(
+          f"Line {row_number} of the input {__collision_message(collisions)}")
+  else:
+    width = len(spec.input_fields)
+    for row_number, values in enumerate(chunk, first_row):
+      if len(values) > width:
+        raise MalformedRowError(
+          f"Row {row_number} of the input has {len(values)} fields, but the "
+          f"header only has {width}")
+    numbered = [
+      (row_number, dict(zip(spec.input_fields, values)))
+      for row_number, values in enumerate(chunk, first_row)
+    ]
+    location = 'Row'
+  rows = [row for _, row in numbered]
+
+  enriched = enrich_chunk(rows, spec.column, spec.prefix, spec.backend)
+  if spec.output_format == 'jsonl':
+    return [], ''.join(json.dumps(row) + '\n' for row in enriched), len(rows)
+
+  fields = spec.output_fields
+  buffer = io.StringIO()
+  writer = csv.DictWriter(
+    buffer,
+    fieldnames=fields,
+    delimiter=DELIMITERS[spec.output_format])
+  known = set(fields)
+  for (row_number, _), row in zip(numbered, enriched):
+    unknown = [key for key in row if key not in known]
+    if len(unknown) > 0:
+      raise MalformedRowError(
+        f"{location} {row_number} of the input has keys missing from the "
+        f"output header, which is taken from the first record: "
+        f"{', '.join(unknown)}")
+    writer.writerow(row)
+  return fields, buffer.getvalue(), len(rows)
+
+
+class __Progress:
+  """Reports the number of rows processed and the rate at which they are being
+  processed on stderr, at most once per second."""
+
+  def __init__(self, enabled: bool):
+    self.enabled = enabled
+    self.rows = 0
+    self.started = time.monotonic()
+    self.last_report = self.started
+
+  def update(self, rows: int):
+    self.rows += rows
+    now = time.monotonic()
+    if self.enabled and now - self.last_report >= 1:
+      self.last_report = now
+      self.__report(now)
+
+  def finish(self):
+    if self.enabled:
+      self.__report(time.monotonic())
+      sys.stderr.write('\n')
+
+  def __report(self, now: float):
+    rate = self.rows / max(now - self.started, 1e-9)
+    sys.stderr.write(f"\r{self.rows:,} rows, {rate:,.0f} rows/sec")
+    sys.stderr.flush()
+
+
+def __chunks(rows: typing.Iterator, size: int):
+  while True:
+    chunk = list(itertools.islice(rows, size))
+    if len(chunk) == 0:
+      return
+    yield chunk
+
+
+def __numbered(chunks: typing.Iterator[list]):
+  """Pair each chunk with the number of its first row"""
+
+  first_row = 1
+  for chunk in chunks:
+    yield first_row, chunk
+    first_row += len(chunk)
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> int:
+  args = parser.parse_args(argv)
+  if args.chunk_size < 1:
+    parser.error('--chunk-size must be at least 1')
+  if (args.backend == phone2geo.COMPILED_BACKEND
+      and not os.path.exists(phone2geo.DEFAULT_INDEX_PATH)):
+    parser.error(
+      f"{phone2geo.DEFAULT_INDEX_PATH} has not been compiled; run "
+      "build/build_npa_db.py or use the SQLite backend")
+
+  input_format = args.format or __infer_format(args.input)
+  output_format = args.output_format or (
+    __infer_format(args.output) if args.output != '-' else input_format)
+
+  with contextlib.ExitStack() as stack:
+    if args.input == '-':
+      infile = stack.enter_context(open(
+        sys.stdin.fileno(), 'r', newline='', encoding='utf-8', closefd=False))
+    else:
+      infile = stack.enter_context(
+        open(args.input, 'r', newline='', encoding='utf-8'))
+
+    input_fields = None
+    output_fields = None
+    if input_format == 'jsonl':
+      rows = infile
+      if output_format != 'jsonl':
+        # A CSV/TSV header must be written before any record has been
+        # enriched, so it is taken from the keys of the first record
+        leading = []
+        for line in infile:
+          leading.append(line)
+          if line.strip() != '':
+            break
+        if len(leading) == 0 or leading[-1].strip() == '':
+          return 0
+        try:
+          first = __parse_record(leading[-1], len(leading))
+        except MalformedRowError as err:
+          sys.stderr.write(f"{err}\n")
+          return 1
+        output_fields = output_columns(first, args.prefix)
+        rows = itertools.chain(leading, infile)
+    else:
+      rows = csv.reader(infile, delimiter=DELIMITERS[input_format])
+      input_fields = next(rows, None)
+      if input_fields is None:
+        return 0
+      if args.column not in input_fields:
+        parser.error(f"Column {args.column} was not found in the input")
+      collisions = colliding_columns(input_fields, args.prefix)
+      if len(collisions) > 0:
+        parser.error(f"The input {__collision_message(collisions)}")
+      output_fields = output_columns(input_fields, args.prefix)
+
+    if args.output == '-':
+      outfile = stack.enter_context(open(
+        sys.stdout.fileno(), 'w', newline='', encoding='utf-8', closefd=False))
+    else:
+      outfile = stack.enter_context(
+        open(args.output, 'w', newline='', encoding='utf-8'))
+
+    spec = __ChunkSpec(
+      input_format,
+      output_format,
+      args.column,
+      args.prefix,
+      args.backend,
+      input_fields,
+      output_fields)
+    progress = __Progress(not args.quiet)
+    header_written = output_format == 'jsonl'
+
+    def write(rendered):
+      nonlocal header_written
+      fields, text, count = rendered
+      if not header_written and len(fields) > 0:
+        csv.writer(outfile, delimiter=DELIMITERS[output_format]).writerow(fields)
+        header_written = True
+      outfile.write(text)
+      progress.update(count)
+
+    chunks = __numbered(__chunks(rows, args.chunk_size))
+    try:
+      if args.workers > 0:
+        executor = stack.enter_context(
+          concurrent.futures.ProcessPoolExecutor(max_workers=args.workers))
+        # Bound the number of chunks in flight so memory stays flat no matter
+        # how far the reader could get ahead of the workers
+        pending = collections.deque()
+        for first_row, chunk in chunks:
+          pending.append(executor.submit(__render_chunk, chunk, spec, first_row))
+          if len(pending) >= args.workers * 2:
+            write(pending.popleft().result())
+        while pending:
+          write(pending.popleft().result())
+      else:
+        for first_row, chunk in chunks:
+          write(__render_chunk(chunk, spec, first_row))
+    except MalformedRowError as err:
+      # Rows already written are left in place; the output is incomplete
+      progress.finish()
+      sys.stderr.write(f"{err}\n")
+      return 1
+    except BrokenPipeError:
+      # The consumer (e.g. head) stopped reading; there is nobody to report to
+      os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+      return 1
+
+    progress.finish()
+
+  return 0
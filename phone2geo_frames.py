@@ -0,0 +1,245 @@
+import typing
+
+import phone2geo
+
+# numpy, pandas, pyarrow, and phone2geo_vectorized are imported by the
+# functions that need them, so that importing this module stays cheap and each
+# dependency is only required by the API that uses it
+
+# The number of values normalized and resolved at a time, which bounds the
+# memory used by intermediate arrays regardless of the size of the column
+DEFAULT_CHUNK_SIZE = 1000 * 1000
+
+# The dictionary-encoded columns appended, named after MetadataRecord fields
+METADATA_COLUMNS = (
+  'country',
+  'time_zone',
+  'region',
+  'rate_center',
+  'operating_company_number',
+  'carrier',
+)
+# The column of LookupStatus values appended alongside them
+STATUS_COLUMN = 'status'
+
+# Normalization in bulk mirrors phone2geo._normalize. The regular expression
+# engines behind pandas and pyarrow agree with re on ASCII strings, so any
+# other string is normalized by _normalize itself, which rejects digits outside
+# ASCII just as every lookup path does.
+__NON_WORD_PATTERN = r'\W'
+__NON_ASCII_PATTERN = r'[^\x00-\x7f]'
+
+
+def enrichment_columns(prefix: str = '') -> typing.List[str]:
+  """The names of the columns appended to every frame or table"""
+
+  return [prefix + name for name in METADATA_COLUMNS] + [prefix + STATUS_COLUMN]
+
+
+def enrich_frame(
+  frame,
+  column: str,
+  prefix: str = '',
+  chunk_size: int = DEFAULT_CHUNK_SIZE,
+  tables=None
+):
+  """Return a copy of a pandas DataFrame with the metadata of the phone numbers
+  in one of its columns appended as categorical columns, plus a column of
+  LookupStatus values. The numbers may be strings in any format accepted by
+  locate_number, or integers. Existing columns are not copied."""
+
+  import numpy as np
+  import pandas as pd
+
+  tables = __tables(tables)
+  size = len(frame)
+  status, codes = __allocate(size)
+  series = frame[column]
+  for start in range(0, size, __checked(chunk_size)):
+    stop = min(start + chunk_size, size)
+    __locate_chunk(
+      __pandas_numbers(series.iloc[start:stop]),
+      status[start:stop],
+      {name: column_codes[start:stop] for name, column_codes in codes.items()},
+      tables)
+
+  enriched = frame.copy(deep=False)
+  names = __output_names(enriched.columns, prefix)
+  for name in METADATA_COLUMNS:
+    enriched[names[name]] = pd.Categorical.from_codes(
+      codes[name],
+      dtype=pd.CategoricalDtype(list(tables.categories[name])))
+  enriched[names[STATUS_COLUMN]] = pd.Series(status, index=frame.index, dtype=np.uint8)
+  return enriched
+
+
+def enrich_table(
+  table,
+  column: str,
+  prefix: str = '',
+  chunk_size: int = DEFAULT_CHUNK_SIZE,
+  tables=None
+):
+  """Return a pyarrow Table with the metadata of the phone numbers in one of
+  its columns appended as dictionary-encoded columns, plus a column of
+  LookupStatus values. The numbers may be strings in any format accepted by
+  locate_number, or integers. The appended columns share the chunking of the
+  input column, split further into chunks of at most chunk_size values, and
+  the existing columns are not copied."""
+
+  import pyarrow as pa
+
+  tables = __tables(tables)
+  chunk_size = __checked(chunk_size)
+  dictionaries = {
+    name: pa.array(tables.categories[name], type=pa.string())
+    for name in METADATA_COLUMNS
+  }
+  chunks = {name: [] for name in METADATA_COLUMNS + (STATUS_COLUMN,)}
+  for array in table.column(column).chunks:
+    for start in range(0, len(array), chunk_size):
+      piece = array.slice(start, chunk_size)
+      status, codes = __allocate(len(piece))
+      __locate_chunk(__arrow_numbers(piece), status, codes, tables)
+
+      chunks[STATUS_COLUMN].append(pa.array(status, type=pa.uint8()))
+      for name in METADATA_COLUMNS:
+        chunks[name].append(pa.DictionaryArray.from_arrays(
+          pa.array(codes[name], mask=codes[name] < 0),
+          dictionaries[name]))
+
+  names = __output_names(table.column_names, prefix)
+  dictionary_type = pa.dictionary(pa.int32(), pa.string())
+  for name in METADATA_COLUMNS:
+    table = table.append_column(
+      names[name],
+      pa.chunked_array(chunks[name], type=dictionary_type))
+  return table.append_column(
+    names[STATUS_COLUMN],
+    pa.chunked_array(chunks[STATUS_COLUMN], type=pa.uint8()))
+
+
+def __checked(chunk_size: int) -> int:
+  if chunk_size < 1:
+    raise ValueError('chunk_size must be at least 1')
+  return chunk_size
+
+
+def __output_names(existing, prefix: str) -> typing.Dict[str, str]:
+  names = dict(zip(METADATA_COLUMNS + (STATUS_COLUMN,), enrichment_columns(prefix)))
+  existing = set(existing)
+  collisions = [name for name in names.values() if name in existing]
+  if len(collisions) > 0:
+    raise ValueError(
+      f"Columns {', '.join(collisions)} already exist; pass a prefix to "
+      "name the appended columns apart")
+  return names
+
+
+def __tables(tables):
+  if tables is None:
+    import phone2geo_vectorized
+    tables = phone2geo_vectorized.load_tables()
+  return tables
+
+
+def __allocate(size: int):
+  """Output arrays for size numbers: LookupStatus values, and codes into the
+  lookup tables' categories for each metadata column"""
+
+  import numpy as np
+
+  status = np.empty(size, dtype=np.uint8)
+  codes = {name: np.empty(size, dtype=np.int32) for name in METADATA_COLUMNS}
+  return status, codes
+
+
+def __locate_chunk(numbers, status, codes: dict, tables):
+  """Resolve a chunk of normalized numbers into slices of the output arrays"""
+
+  import phone2geo_vectorized
+
+  located = phone2geo_vectorized.locate_array(numbers, tables)
+  status[:] = located.status
+  for name in METADATA_COLUMNS:
+    codes[name][:] = getattr(located, name).codes
+
+
+def __integral_numbers(values):
+  """Integers for an array of floats, or -1 (an invalid number) for values that
+  are missing, fractional, or out of range"""
+
+  import numpy as np
+
+  integral = np.isfinite(values) & (values >= 0) & (values < 1e10)
+  integral[integral] &= values[integral] == np.floor(values[integral])
+  return np.where(integral, values, -1).astype(np.int64)
+
+
+def __pandas_numbers(series):
+  """Normalize a chunk of a pandas Series into an int64 array of numbers, with
+  -1 in place of anything locate_number would reject as malformed"""
+
+  import numpy as np
+  import pandas as pd
+
+  if pd.api.types.is_bool_dtype(series.dtype):
+    return np.full(len(series), -1, dtype=np.int64)
+  if pd.api.types.is_integer_dtype(series.dtype):
+    return series.to_numpy(dtype=np.int64, na_value=-1)
+  if pd.api.types.is_float_dtype(series.dtype):
+    return __integral_numbers(series.to_numpy(dtype=np.float64, na_value=np.nan))
+
+  strings = series.astype(str)
+  cleaned = strings.str.replace(__NON_WORD_PATTERN, '', regex=True)
+  valid = cleaned.str.match(
+    phone2geo.PHONE_NUMBER_PATTERN.pattern,
+    na=False).to_numpy(dtype=bool)
+  numbers = np.full(len(series), -1, dtype=np.int64)
+  numbers[valid] = cleaned[valid].astype(np.int64).to_numpy()
+
+  non_ascii = strings.str.contains(__NON_ASCII_PATTERN, regex=True, na=False)
+  for position in np.nonzero(non_ascii.to_numpy(dtype=bool))[0]:
+    numbers[position] = __normalized(strings.iloc[position])
+  # Missing values are invalid, whatever astype(str) made of them
+  numbers[series.isna().to_numpy(dtype=bool)] = -1
+  return numbers
+
+
+def __arrow_numbers(array):
+  """Normalize a pyarrow Array into an int64 numpy array of numbers, with -1 in
+  place of anything locate_number would reject as malformed"""
+
+  import numpy as np
+  import pyarrow as pa
+  import pyarrow.compute as pc
+
+  if pa.types.is_dictionary(array.type):
+    array = array.dictionary_decode()
+  if pa.types.is_integer(array.type):
+    return pc.fill_null(pc.cast(array, pa.int64()), -1).to_numpy(zero_copy_only=False)
+  if pa.types.is_floating(array.type):
+    return __integral_numbers(pc.fill_null(
+      pc.cast(array, pa.float64()),
+      float('nan')).to_numpy(zero_copy_only=False))
+  if not (pa.types.is_string(array.type) or pa.types.is_large_string(array.type)):
+    array = pc.cast(array, pa.string())
+
+  cleaned = pc.replace_substring_regex(array, __NON_WORD_PATTERN, '')
+  valid = pc.fill_null(
+    pc.match_substring_regex(cleaned, phone2geo.PHONE_NUMBER_PATTERN.pattern),
+    False)
+  numbers = pc.cast(pc.if_else(valid, cleaned, '-1'), pa.int64())
+  numbers = pc.fill_null(numbers, -1).to_numpy(zero_copy_only=False).copy()
+
+  non_ascii = pc.fill_null(pc.invert(pc.string_is_ascii(array)), False)
+  for position in np.nonzero(non_ascii.to_numpy(zero_copy_only=False))[0]:
+    numbers[position] = __normalized(array[position].as_py())
+  return numbers
+
+
+def __normalized(number: str) -> int:
+  """Normalize a single non-ASCII string exactly as locate_number would"""
+
+  number = phone2geo._normalize(number)
+  return int(number) if number is not None else -1
@@ -0,0 +1,563 @@
+import argparse
+import asyncio
+import concurrent.futures
+import dataclasses
+import http.client
+import json
+import os
+import signal
+import sys
+import time
+import typing
+import urllib.parse
+
+import phone2geo
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8053
+# How long the first lookup submitted to an empty batch waits for others to
+# join it, in seconds. Bounds the latency micro-batching adds to any request.
+DEFAULT_BATCH_WINDOW = 0.001
+# Batches are resolved as soon as they hold this many numbers
+DEFAULT_MAX_BATCH_SIZE = 512
+# Numbers accepted but not yet resolved, beyond which requests are rejected
+# with 503 rather than queued, so that a backlog cannot grow without bound
+DEFAULT_MAX_PENDING = 100000
+DEFAULT_WORKERS = 2
+# Limits on what a single request may submit
+MAX_REQUEST_BYTES = 8 * 1024 * 1024
+MAX_NUMBERS_PER_REQUEST = 10000
+
+RECORD_FIELDS = [
+  field.name for field in dataclasses.fields(phone2geo.MetadataRecord)
+]
+
+parser = argparse.ArgumentParser(
+  prog='python -m phone2geo_server',
+  description='''Serves phone2geo lookups over HTTP. Lookups from concurrent
+  requests are coalesced into batches, so that one process can serve many
+  thousands of lookups per second over a single locator.''')
+parser.add_argument('--host', default=DEFAULT_HOST, help='''The address on
+  which to listen.''')
+parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='''The port
+  on which to listen.''')
+parser.add_argument('--backend', default=phone2geo.SQLITE_BACKEND,
+  choices=(phone2geo.SQLITE_BACKEND, phone2geo.COMPILED_BACKEND),
+  help='''The metadata backend used to locate numbers.''')
+parser.add_argument('--reload', action='store_true', help='''Pick up a
+  database replaced by build/build_npa_db.py without restarting. Only supported
+  by the SQLite backend.''')
+parser.add_argument('--instrument', action='store_true', help='''Time each
+  lookup stage and report the results on /stats. Only supported by the SQLite
+  backend.''')
+parser.add_argument('--batch-window-ms', type=float,
+  default=DEFAULT_BATCH_WINDOW * 1000, help='''How long a lookup may wait for
+  others to be batched with it, in milliseconds.''')
+parser.add_argument('--max-batch-size', type=int,
+  default=DEFAULT_MAX_BATCH_SIZE, help='''The number of numbers at which a
+  batch is resolved without waiting out the batch window.''')
+parser.add_argument('--max-pending', type=int, default=DEFAULT_MAX_PENDING,
+  help='''The number of unresolved numbers beyond which requests are rejected
+  with 503.''')
+parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+  help='''The number of threads resolving batches.''')
+
+
+class ServerOverloadedError(Exception):
+  """An error raised when a lookup is submitted while the number of unresolved
+  numbers is at its limit"""
+
+  pending: int # The number of numbers awaiting resolution
+
+  def __init__(self, pending: int):
+    self.pending = pending
+
+
+def result_fields(result: phone2geo.LookupResult) -> dict:
+  """The JSON representation of a lookup: the fields of its MetadataRecord
+  (None when the lookup failed), the name of its LookupStatus, the name of the
+  error locate_number would have raised, if any, and the importId of the
+  database that served it, when known."""
+
+  record = result.record
+  fields = {
+    name: getattr(record, name) if record is not None else None
+    for name in RECORD_FIELDS
+  }
+  fields['status'] = result.status.name
+  fields['error'] = type(result.error).__name__ if result.error is not None else None
+  fields['import_id'] = result.import_id
+  return fields
+
+
+class LookupBatcher:
+  """Coalesces the lookups of concurrent requests into batches resolved by
+  lookup_many on a small thread pool. A batch is resolved once it holds
+  max_batch_size numbers or batch_window seconds after its first lookup was
+  submitted, whichever comes first. Must be used from a single event loop."""
+
+  def __init__(
+    self,
+    locator,
+    batch_window: float = DEFAULT_BATCH_WINDOW,
+    max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    max_pending: int = DEFAULT_MAX_PENDING,
+    workers: int = DEFAULT_WORKERS
+  ):
+    self.locator = locator
+    self.batch_window = batch_window
+    self.max_batch_size = max_batch_size
+    self.max_pending = max_pending
+    self.instrumentation = phone2geo.LookupInstrumentation()
+    self.__executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=workers,
+      thread_name_prefix='phone2geo-batch')
+    # (numbers, future) for each submission in the batch being gathered
+    self.__gathering = []
+    self.__gathered = 0
+    self.__flush_handle = None
+    self.__pending = 0
+    self.__submissions = 0
+    self.__batches = 0
+    self.__numbers = 0
+    self.__rejected = 0
+
+  async def lookup_many(
+    self,
+    numbers: typing.List[str]
+  ) -> typing.List[phone2geo.LookupResult]:
+    """Resolve numbers along with those submitted concurrently. Raises
+    ServerOverloadedError rather than queueing past max_pending."""
+
+    if len(numbers) == 0:
+      return []
+    if self.__pending + len(numbers) > self.max_pending:
+      self.__rejected += len(numbers)
+      raise ServerOverloadedError(self.__pending)
+
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    self.__gathering.append((numbers, future))
+    self.__gathered += len(numbers)
+    self.__pending += len(numbers)
+    self.__submissions += 1
+
+    if self.__gathered >= self.max_batch_size:
+      self.__flush()
+    elif self.__flush_handle is None:
+      self.__flush_handle = loop.call_later(self.batch_window, self.__flush)
+    return await future
+
+  def stats(self) -> dict:
+    lookup_stats = self.instrumentation.stats()
+    return {
+      'submissions': self.__submissions,
+      'batches': self.__batches,
+      'numbers': self.__numbers,
+      'mean_batch_size': self.__numbers / self.__batches if self.__batches > 0 else 0.0,
+      'pending': self.__pending,
+      'rejected': self.__rejected,
+      'stages': {
+        stage: dataclasses.asdict(stage_stats)
+        for stage, stage_stats in lookup_stats.stages.items()
+      },
+    }
+
+  def close(self):
+    if self.__flush_handle is not None:
+      self.__flush_handle.cancel()
+      self.__flush()
+    self.__executor.shutdown(wait=True)
+
+  def __flush(self):
+    if self.__flush_handle is not None:
+      self.__flush_handle.cancel()
+      self.__flush_handle = None
+
+    submissions = self.__gathering
+    self.__gathering = []
+    self.__gathered = 0
+    numbers = [number for submitted, _ in submissions for number in submitted]
+    self.__batches += 1
+    self.__numbers += len(numbers)
+
+    resolved = asyncio.get_running_loop().run_in_executor(
+      self.__executor,
+      self.__resolve,
+      numbers)
+    resolved.add_done_callback(
+      lambda resolved: self.__distribute(submissions, len(numbers), resolved))
+
+  def __resolve(
+    self,
+    numbers: typing.List[str]
+  ) -> typing.List[phone2geo.LookupResult]:
+    started = time.perf_counter()
+    results = list(self.locator.lookup_many(numbers, max(len(numbers), 1)))
+    self.instrumentation.record_stage('batch', time.perf_counter() - started)
+    return results
+
+  def __distribute(self, submissions, count: int, resolved: asyncio.Future):
+    self.__pending -= count
+    if resolved.cancelled() or resolved.exception() is not None:
+      for _, future in submissions:
+        if not future.done():
+          if resolved.cancelled():
+            future.cancel()
+          else:
+            future.set_exception(resolved.exception())
+      return
+
+    results = resolved.result()
+    start = 0
+    for submitted, future in submissions:
+      end = start + len(submitted)
+      if not future.done():
+        future.set_result(results[start:end])
+      start = end
+
+
+class _RequestError(Exception):
+  """An error answered with an HTTP error status"""
+
+  def __init__(self, status: int, message: str):
+    self.status = status
+    self.message = message
+
+
+class LookupServer:
+  """A minimal HTTP/1.1 server over a LookupBatcher. Serves
+
+  * GET /locate?number=...: the lookup of a single number
+  * POST /locate with a JSON list of numbers, or an object whose numbers
+    member holds one: {"results": [...]}, in input order
+  * GET /stats: batching statistics, the locator's cache statistics, and its
+    lookup statistics when instrumented
+
+  Lookups are represented as described by result_fields. Connections are kept
+  alive unless the client asks otherwise."""
+
+  def __init__(
+    self,
+    locator,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    **batcher_options
+  ):
+    self.locator = locator
+    self.host = host
+    self.port = port
+    self.batcher = LookupBatcher(locator, **batcher_options)
+    self.__server = None
+    self.__connections = set()
+
+  async def start(self):
+    """Start listening. When constructed with port 0, port is updated to the
+    port assigned."""
+
+    self.__server = await asyncio.start_server(
+      self.__handle,
+      self.host,
+      self.port)
+    self.port = self.__server.sockets[0].getsockname()[1]
+
+  async def serve_forever(self):
+    if self.__server is None:
+      await self.start()
+    await self.__server.serve_forever()
+
+  async def stop(self):
+    if self.__server is not None:
+      self.__server.close()
+      # Idle kept-alive connections would otherwise hold the server open
+      for writer in list(self.__connections):
+        writer.close()
+      await self.__server.wait_closed()
+    self.batcher.close()
+
+  def stats(self) -> dict:
+    stats = {'server': self.batcher.stats()}
+    if hasattr(self.locator, 'import_id'):
+      stats['import_id'] = self.locator.import_id
+    if hasattr(self.locator, 'cache_stats'):
+      stats['caches'] = {
+        name: dataclasses.asdict(cache_stats)
+        for name, cache_stats in self.locator.cache_stats().items()
+      }
+    lookup_stats = self.locator.stats() if hasattr(self.locator, 'stats') else None
+    if lookup_stats is not None:
+      stats['lookups'] = dataclasses.asdict(lookup_stats)
+    return stats
+
+  async def __handle(
+    self,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter
+  ):
+    self.__connections.add(writer)
+    try:
+      keep_alive = True
+      while keep_alive:
+        try:
+          head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+          return
+        except asyncio.LimitOverrunError:
+          await self.__respond(writer, 431, {'error': 'Request header too large'}, False)
+          return
+
+        try:
+          method, target, version, headers = self.__parse_head(head)
+        except ValueError:
+          await self.__respond(writer, 400, {'error': 'Malformed request'}, False)
+          return
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+          keep_alive = connection == 'keep-alive'
+        else:
+          keep_alive = connection != 'close'
+
+        try:
+          body = await self.__read_body(reader, headers)
+        except _RequestError as err:
+          # The rest of the request was not read, so the connection cannot be
+          # reused
+          await self.__respond(writer, err.status, {'error': err.message}, False)
+          return
+
+        try:
+          status, payload = await self.__dispatch(method, target, body)
+        except _RequestError as err:
+          status, payload = err.status, {'error': err.message}
+        except ServerOverloadedError as err:
+          status, payload = 503, {'error': f"{err.pending} numbers are already pending"}
+        except Exception as err:
+          # A failure of the locator itself (e.g. a sqlite3.Error) fails the
+          # request rather than the connection
+          sys.stderr.write(f"Failed to serve {method} {target}: {err!r}\n")
+          status, payload = 500, {'error': f"Lookup failed: {type(err).__name__}"}
+        await self.__respond(writer, status, payload, keep_alive)
+    except ConnectionError:
+      pass
+    finally:
+      self.__connections.discard(writer)
+      writer.close()
+
+  @staticmethod
+  def __parse_head(head: bytes):
+    request_line, *header_lines = head.decode('latin-1').split('\r\n')
+    method, target, version = request_line.split(' ')
+    headers = {}
+    for line in header_lines:
+      if line == '':
+        continue
+      name, separator, value = line.partition(':')
+      if separator == '':
+        raise ValueError(f"Malformed header: {line}")
+      headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+  @staticmethod
+  async def __read_body(reader: asyncio.StreamReader, headers: dict) -> bytes:
+    if 'transfer-encoding' in headers:
+      raise _RequestError(411, 'Chunked request bodies are not supported')
+    try:
+      length = int(headers.get('content-length', '0'))
+    except ValueError:
+      raise _RequestError(400, 'Invalid Content-Length')
+    if length < 0:
+      raise _RequestError(400, 'Invalid Content-Length')
+    if length > MAX_REQUEST_BYTES:
+      raise _RequestError(413, f"Request bodies are limited to {MAX_REQUEST_BYTES} bytes")
+    return await reader.readexactly(length) if length > 0 else b''
+
+  async def __dispatch(
+    self,
+    method: str,
+    target: str,
+    body: bytes
+  ) -> typing.Tuple[int, typing.Any]:
+    url = urllib.parse.urlsplit(target)
+    if url.path == '/locate' and method == 'GET':
+      numbers = urllib.parse.parse_qs(url.query).get('number')
+      if numbers is None:
+        raise _RequestError(400, 'The number query parameter is required')
+      (result,) = await self.batcher.lookup_many(numbers[:1])
+      return 200, result_fields(result)
+
+    if url.path == '/locate' and method == 'POST':
+      try:
+        payload = json.loads(body)
+      except ValueError:
+        raise _RequestError(400, 'The request body is not valid JSON')
+      numbers = payload.get('numbers') if isinstance(payload, dict) else payload
+      if not isinstance(numbers, list):
+        raise _RequestError(400, 'Expected a list of numbers')
+      if len(numbers) > MAX_NUMBERS_PER_REQUEST:
+        raise _RequestError(
+          413,
+          f"Requests are limited to {MAX_NUMBERS_PER_REQUEST} numbers")
+      results = await self.batcher.lookup_many([str(number) for number in numbers])
+      return 200, {'results': [result_fields(result) for result in results]}
+
+    if url.path == '/stats' and method == 'GET':
+      return 200, self.stats()
+
+    if url.path in ('/locate', '/stats'):
+      raise _RequestError(405, f"{method} is not supported by {url.path}")
+    raise _RequestError(404, f"{url.path} was not found")
+
+  @staticmethod
+  async def __respond(
+    writer: asyncio.StreamWriter,
+    status: int,
+    payload: typing.Any,
+    keep_alive: bool
+  ):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(
+      f"HTTP/1.1 {status} {http.client.responses.get(status, '')}\r\n"
+      "Content-Type: application/json\r\n"
+      f"Content-Length: {len(body)}\r\n"
+      f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+      "\r\n".encode('latin-1') + body)
+    await writer.drain()
+
+
+class LookupServiceError(Exception):
+  """An error raised by LookupClient when the service answers with an error
+  status"""
+
+  status: int # The HTTP status of the response
+  message: str # The error reported by the service
+
+  def __init__(self, status: int, message: str):
+    super().__init__(f"{status}: {message}")
+    self.status = status
+    self.message = message
+
+
+class LookupClient:
+  """A blocking client for a LookupServer, holding one keep-alive connection.
+  Lookups are returned as the dicts described by result_fields. Not safe to
+  share between threads; open one client per thread."""
+
+  def __init__(
+    self,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    timeout: float = 10.0
+  ):
+    self.__connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    self.__connection.close()
+
+  def lookup(self, number: str) -> dict:
+    query = urllib.parse.urlencode({'number': number})
+    return self.__request('GET', f"/locate?{query}")
+
+  def lookup_many(self, numbers: typing.Iterable[str]) -> typing.List[dict]:
+    """Look up numbers in requests of at most MAX_NUMBERS_PER_REQUEST numbers,
+    returning one result per number in input order"""
+
+    numbers = list(numbers)
+    results = []
+    for start in range(0, len(numbers), MAX_NUMBERS_PER_REQUEST):
+      batch = numbers[start:start + MAX_NUMBERS_PER_REQUEST]
+      results.extend(self.__request('POST', '/locate', batch)['results'])
+    return results
+
+  def stats(self) -> dict:
+    return self.__request('GET', '/stats')
+
+  def __request(self, method: str, path: str, payload=None):
+    body = json.dumps(payload).encode('utf-8') if payload is not None else None
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    for attempt in range(2):
+      try:
+        self.__connection.request(method, path, body, headers)
+        response = self.__connection.getresponse()
+        data = json.loads(response.read())
+        break
+      except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        # The server closed the kept-alive connection; reconnect once
+        self.__connection.close()
+        if attempt == 1:
+          raise
+
+    if response.status != 200:
+      raise LookupServiceError(response.status, data.get('error', ''))
+    return data
+
+
+async def serve(server: LookupServer):
+  """Serve until SIGINT or SIGTERM is received"""
+
+  loop = asyncio.get_running_loop()
+  stopping = asyncio.Event()
+  for signum in (signal.SIGINT, signal.SIGTERM):
+    try:
+      loop.add_signal_handler(signum, stopping.set)
+    except NotImplementedError:
+      # Signal handlers are not supported by every event loop (e.g. Windows)
+      pass
+
+  await server.start()
+  sys.stderr.write(f"Serving phone2geo lookups on http://{server.host}:{server.port}\n")
+  serving = asyncio.ensure_future(server.serve_forever())
+  try:
+    await stopping.wait()
+  finally:
+    serving.cancel()
+    await server.stop()
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> int:
+  args = parser.parse_args(argv)
+  if args.max_batch_size < 1:
+    parser.error('--max-batch-size must be at least 1')
+  if args.workers < 1:
+    parser.error('--workers must be at least 1')
+  if args.backend != phone2geo.SQLITE_BACKEND and (args.reload or args.instrument):
+    parser.error('--reload and --instrument require the SQLite backend')
+  if (args.backend == phone2geo.COMPILED_BACKEND
+      and not os.path.exists(phone2geo.DEFAULT_INDEX_PATH)):
+    parser.error(
+      f"{phone2geo.DEFAULT_INDEX_PATH} has not been compiled; run "
+      "build/build_npa_db.py or use the SQLite backend")
+
+  options = {}
+  if args.instrument:
+    options['instrumentation'] = phone2geo.LookupInstrumentation()
+  if args.reload:
+    locator = phone2geo.reloading_locator(**options)
+  else:
+    locator = phone2geo.number_locator(args.backend, **options)
+
+  with locator:
+    server = LookupServer(
+      locator,
+      args.host,
+      args.port,
+      batch_window=args.batch_window_ms / 1000,
+      max_batch_size=args.max_batch_size,
+      max_pending=args.max_pending,
+      workers=args.workers)
+    try:
+      asyncio.run(serve(server))
+    except KeyboardInterrupt:
+      pass
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,17 +1,64 @@
+import asyncio
+import contextlib
+import csv
+import dataclasses
+import hashlib
+import http.client
+import http.server
+import io
+import json
 import os
 import phone2geo
+import phone2geo_bench
+import phone2geo_build
+import phone2geo_cli
+import phone2geo_server
+import pickle
 import sqlite3
+import sys
 import tempfile
+import threading
 import unittest
+import unittest.mock
 import uuid
+import zipfile
+
+# The build scripts import their sibling modules as top-level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build'))
+import build_npa_db
+import refresh_assets
+
+try:
+  import numpy
+  import phone2geo_vectorized
+except ImportError:
+  numpy = None
+
+try:
+  import pandas
+  import phone2geo_frames
+except ImportError:
+  pandas = None
+
+try:
+  import pyarrow
+except ImportError:
+  pyarrow = None
 
 class DatasetIntegrationTest(unittest.TestCase):
+  backend = phone2geo.SQLITE_BACKEND
+  options = {}
+
+  def locate_number(self, number):
+    with phone2geo.number_locator(self.backend, **self.options) as locator:
+      return locator.locate_number(number)
+
   def test_provides_full_metadata_for_potentially_valid_us_number(self):
     """Uses a stable test case to potentially catch changes in the way the NPA
     database reports data elements"""
 
     number = '2128675309' # Hi, Jenny!
-    record = phone2geo.locate_number(number)
+    record = self.locate_number(number)
     self.assertEqual(record.phone_number, number)
     self.assertEqual(record.country, 'US')
     self.assertEqual(record.region, 'NY')
@@ -19,13 +66,14 @@ class DatasetIntegrationTest(unittest.TestCase):
     self.assertEqual(record.rate_center, 'NWYRCYZN01') # Metro NYC rate center
     self.assertIsNotNone(record.operating_company_number)
     self.assertIsNotNone(record.carrier)
+    self.assertEqual(record, phone2geo.locate_number(number))
 
   def test_raises_error_on_invalid_format(self):
     """Tests an invalid number (1 in first digit of NPA) to ensure basic pattern
     matching is working appropriately."""
 
     try:
-      phone2geo.locate_number('1555555555')
+      self.locate_number('1555555555')
       self.fail('An exception should have been raised.')
     except phone2geo.InvalidNumberError:
       pass
@@ -35,7 +83,7 @@ class DatasetIntegrationTest(unittest.TestCase):
     exception is raised."""
 
     try:
-      phone2geo.locate_number('9115555555')
+      self.locate_number('9115555555')
       self.fail('An exception should have been raised.')
     except phone2geo.InvalidAreaCodeError:
       pass
@@ -45,11 +93,129 @@ class DatasetIntegrationTest(unittest.TestCase):
     exception is raised."""
 
     try:
-      phone2geo.locate_number('2129115555')
+      self.locate_number('2129115555')
       self.fail('An exception should have been raised.')
     except phone2geo.InvalidExchangeError:
       pass
 
+  def test_lookup_reports_status_instead_of_raising(self):
+    test_cases = {
+      '(212) 867-5309': phone2geo.LookupStatus.OK,
+      '1555555555': phone2geo.LookupStatus.INVALID_NUMBER,
+      '9115555555': phone2geo.LookupStatus.INVALID_AREA_CODE,
+      '2129115555': phone2geo.LookupStatus.INVALID_EXCHANGE,
+    }
+
+    with phone2geo.number_locator(self.backend, **self.options) as locator:
+      for number, status in test_cases.items():
+        result = locator.lookup(number)
+        self.assertEqual(result.status, status)
+        self.assertEqual(result.record is None, status != phone2geo.LookupStatus.OK)
+        self.assertEqual(result.error is None, status == phone2geo.LookupStatus.OK)
+
+      self.assertEqual(
+        locator.lookup('2128675309').record,
+        locator.locate_number('2128675309'))
+      self.assertEqual(
+        [result.status for result in locator.lookup_many(test_cases)],
+        list(test_cases.values()))
+
+  def test_rejects_digits_outside_ascii(self):
+    """int() accepts digits from any script, so numbers using them must be
+    rejected up front to resolve the same way on every lookup path"""
+
+    test_cases = [
+      '212٨675309', # Arabic-Indic eight
+      '212８６７５３０９', # Fullwidth digits
+      '٢١٢' + '8675309', # Arabic-Indic area code
+    ]
+
+    with phone2geo.number_locator(self.backend, **self.options) as locator:
+      for number in test_cases:
+        self.assertEqual(
+          locator.lookup(number).status,
+          phone2geo.LookupStatus.INVALID_NUMBER,
+          number)
+        self.assertFalse(locator.has_us_area_code(number))
+        self.assertFalse(locator.is_potentially_valid_number(number))
+      self.assertEqual(
+        [result.status for result in locator.lookup_many(test_cases)],
+        [phone2geo.LookupStatus.INVALID_NUMBER] * len(test_cases))
+      self.assertEqual(
+        list(locator.filter_potentially_valid_numbers(test_cases)), [])
+
+  def test_records_are_compact_and_share_field_values(self):
+    with phone2geo.number_locator(self.backend, **self.options) as locator:
+      records = [
+        locator.locate_number('2128675309'),
+        locator.locate_number('2128675310'),
+        *locator.locate_numbers(['2128675311', '2128675312']),
+      ]
+
+    self.assertFalse(hasattr(records[0], '__dict__'))
+    with self.assertRaises(dataclasses.FrozenInstanceError):
+      records[0].carrier = 'Someone else'
+    for record in records[1:]:
+      self.assertIs(record.carrier, records[0].carrier)
+      self.assertIs(record.rate_center, records[0].rate_center)
+
+    copy = pickle.loads(pickle.dumps(records[0]))
+    self.assertEqual(copy, records[0])
+    self.assertEqual(hash(copy), hash(records[0]))
+    self.assertIs(copy.carrier, records[0].carrier)
+
+  def test_batch_lookup_matches_single_lookups_in_input_order(self):
+    """Resolves a mix of valid and invalid numbers in bulk and compares each
+    result against the equivalent single-number lookup."""
+
+    numbers = [
+      '2128675309',
+      '1555555555',
+      '(212) 867-5309',
+      '9115555555',
+      '2129115555',
+      '2048675309',
+    ]
+
+    with phone2geo.number_locator(self.backend, **self.options) as locator:
+      results = list(locator.locate_numbers(numbers))
+      self.assertEqual(len(results), len(numbers))
+
+      for number, result in zip(numbers, results):
+        try:
+          self.assertEqual(result, locator.locate_number(number))
+        except Exception as err:
+          self.assertIs(type(result), type(err))
+          self.assertEqual(vars(result), vars(err))
+
+  def test_locator_can_be_shared_between_threads(self):
+    """Each thread entering and exiting the same locator should neither close
+    another thread's connection nor see another thread's results."""
+
+    numbers = ['2128675309', '2048675309', '8005551212']
+    errors = []
+
+    with phone2geo.number_locator(self.backend, **self.options) as locator:
+      expected = [locator.locate_number(number) for number in numbers]
+
+      def lookup():
+        try:
+          for _ in range(50):
+            with locator:
+              self.assertEqual(
+                [locator.locate_number(number) for number in numbers],
+                expected)
+        except Exception as err:
+          errors.append(err)
+
+      threads = [threading.Thread(target=lookup) for _ in range(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+
+    self.assertEqual(errors, [])
+
   def test_identifies_invalid_numbers(self):
     test_cases = [
       '212867530', # Too few digits
@@ -61,10 +227,30 @@ class DatasetIntegrationTest(unittest.TestCase):
       '2129115555', # 911 is not an assignable exchange in any area code
     ]
 
-    with phone2geo.number_locator() as locator:
+    with phone2geo.number_locator(self.backend, **self.options) as locator:
       for case in test_cases:
         self.assertFalse(locator.is_potentially_valid_number(case))
 
+  def test_filters_batches_in_input_order(self):
+    numbers = [
+      '2128675309',
+      '9115555555', # N11 area codes are reserved and not assignable
+      '4165550100', # Toronto
+      '2129115555', # 911 is not an assignable exchange in any area code
+      'not a number',
+      '9075550100',
+    ]
+
+    with phone2geo.number_locator(self.backend, **self.options) as locator:
+      self.assertEqual(
+        list(locator.filter_us_numbers(numbers)),
+        [n for n in numbers if locator.has_us_area_code(n)])
+      self.assertEqual(
+        list(locator.filter_potentially_valid_numbers(numbers, batch_size=2)),
+        [n for n in numbers if locator.is_potentially_valid_number(n)])
+      self.assertNotIn('2129115555', locator.filter_potentially_valid_numbers(numbers))
+      self.assertIn('2129115555', locator.filter_us_numbers(numbers))
+
   def test_identifies_us_numbers(self):
     """Area codes assigned by NANPA to non-US territories can be identified"""
 
@@ -169,7 +355,7 @@ class DatasetIntegrationTest(unittest.TestCase):
       '905', # CANADA
     ]
 
-    with phone2geo.number_locator() as locator:
+    with phone2geo.number_locator(self.backend, **self.options) as locator:
       for case in positive_test_cases:
         self.assertTrue(
           locator.has_us_area_code(case + '8675309'),
@@ -182,5 +368,1128 @@ class DatasetIntegrationTest(unittest.TestCase):
           f"Area code {case} should have been recognized as not within US geo"
         )
 
+
+@unittest.skipUnless(
+  os.path.exists(phone2geo.DEFAULT_INDEX_PATH),
+  'carrier_meta.idx has not been compiled by build/build_npa_db.py')
+class CompiledIndexIntegrationTest(DatasetIntegrationTest):
+  """Runs the dataset tests against the memory-mapped compiled index emitted by
+  build/build_npa_db.py"""
+
+  backend = phone2geo.COMPILED_BACKEND
+
+  def test_matches_sqlite_backend(self):
+    numbers = ['2128675309', '9115555555', '2129115555', '2048675309']
+
+    with phone2geo.number_locator(phone2geo.SQLITE_BACKEND) as sqlite_locator:
+      with phone2geo.number_locator(self.backend) as compiled_locator:
+        self.assertEqual(
+          [type(result) for result in sqlite_locator.locate_numbers(numbers)],
+          [type(result) for result in compiled_locator.locate_numbers(numbers)])
+        self.assertEqual(
+          sqlite_locator.locate_number(numbers[0]),
+          compiled_locator.locate_number(numbers[0]))
+
+class CompiledIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.workdir = tempfile.TemporaryDirectory()
+    self.index_path = os.path.join(self.workdir.name, 'carrier_meta.idx')
+
+  def tearDown(self):
+    self.workdir.cleanup()
+
+  def test_reads_index_written_in_either_byte_order(self):
+    numbers = ['2128675309', '9115555555', '2129115555', '2048675309']
+    with phone2geo.number_locator() as sqlite_locator:
+      expected = [
+        (result.status, result.record)
+        for result in sqlite_locator.lookup_many(numbers)
+      ]
+
+    for byteorder in ('little', 'big'):
+      with unittest.mock.patch.object(phone2geo.sys, 'byteorder', byteorder):
+        phone2geo_build.write_compiled_index(phone2geo.DEFAULT_DB_PATH, self.index_path)
+        with phone2geo.number_locator(
+            phone2geo.COMPILED_BACKEND,
+            index_path=self.index_path) as locator:
+          self.assertEqual(
+            [(result.status, result.record) for result in locator.lookup_many(numbers)],
+            expected,
+            byteorder)
+
+  def test_does_not_support_reverse_lookups(self):
+    phone2geo_build.write_compiled_index(phone2geo.DEFAULT_DB_PATH, self.index_path)
+    with phone2geo.number_locator(
+        phone2geo.COMPILED_BACKEND,
+        index_path=self.index_path) as locator:
+      with self.assertRaises(ValueError):
+        locator.find_ranges(rate_center='NWYRCYZN01')
+
+  def test_rejects_unsupported_options(self):
+    with self.assertRaises(TypeError):
+      phone2geo.number_locator(phone2geo.COMPILED_BACKEND, db_path=self.index_path)
+
+  def test_reports_missing_index(self):
+    locator = phone2geo.number_locator(
+      phone2geo.COMPILED_BACKEND,
+      index_path=self.index_path)
+    with self.assertRaises(FileNotFoundError):
+      with locator:
+        pass
+
+
+class StepwiseIntegrationTest(DatasetIntegrationTest):
+  """Runs the dataset tests against the NPA, NXX, and block lookups even when
+  the database has a materialized resolution table"""
+
+  options = {'resolution_table': False}
+
+
+class SQLiteLocatorTest(unittest.TestCase):
+  """Tests of features only the SQLite backend has, run once rather than for
+  every backend"""
+
+  def test_caches_rows_including_missing_exchanges(self):
+    """Repeated lookups, including ones for unassignable exchanges, should be
+    served from the row caches."""
+
+    with phone2geo.number_locator(
+        phone2geo.SQLITE_BACKEND,
+        resolution_table=False) as locator:
+      for _ in range(2):
+        locator.locate_number('2128675309')
+        with self.assertRaises(phone2geo.InvalidExchangeError):
+          locator.locate_number('2129115555')
+
+      stats = locator.cache_stats()
+      self.assertEqual(stats['npa'].hits, 3)
+      self.assertEqual(stats['npa'].misses, 1)
+      self.assertEqual(stats['nxx'].hits, 2)
+      self.assertEqual(stats['nxx'].misses, 2)
+      self.assertEqual(stats['block'].hits + stats['block'].misses, 2)
+
+  def test_instruments_lookup_stages_and_outcomes(self):
+    events = []
+    instrumentation = phone2geo.LookupInstrumentation(
+      callback=lambda kind, name, value: events.append((kind, name)))
+    numbers = ['2128675309', '1555555555', '9115555555', '2129115555']
+
+    with phone2geo.number_locator(phone2geo.SQLITE_BACKEND) as locator:
+      self.assertIsNone(locator.stats())
+
+    with phone2geo.number_locator(
+        phone2geo.SQLITE_BACKEND,
+        instrumentation=instrumentation,
+        resolution_table=False) as locator:
+      for number in numbers:
+        locator.lookup(number)
+      list(locator.lookup_many(numbers))
+
+      stats = locator.stats()
+      self.assertEqual(stats.stages['normalize'].calls, 4)
+      self.assertEqual(stats.stages['npa'].calls, 3)
+      self.assertEqual(stats.stages['nxx'].calls, 2)
+      self.assertEqual(stats.stages['block'].calls, 1)
+      self.assertEqual(stats.stages['batch'].calls, 1)
+      self.assertEqual(sum(stats.stages['npa'].histogram.values()), 3)
+      self.assertEqual(stats.outcomes['InvalidNumberError'], 2)
+      self.assertEqual(stats.outcomes['InvalidAreaCodeError'], 2)
+      self.assertEqual(stats.outcomes['InvalidExchangeError'], 2)
+      self.assertEqual(
+        stats.outcomes.get('pooled', 0) + stats.outcomes.get('unpooled', 0), 2)
+      self.assertEqual(events.count(('stage', 'npa')), 3)
+      self.assertEqual(len([e for e in events if e[0] == 'outcome']), 8)
+
+  def test_exiting_leaves_other_threads_connections_open(self):
+    """Another thread may be mid-query when the last context exits, so only
+    the exiting thread's connection is closed"""
+
+    connected, exited = threading.Event(), threading.Event()
+    connections = []
+    errors = []
+
+    def lookup():
+      try:
+        connections.append(locator.conn)
+        locator.locate_number('2128675309')
+        connected.set()
+        exited.wait()
+        connections.append(locator.conn)
+        locator.locate_number('2128675309')
+      except Exception as err:
+        errors.append(err)
+      finally:
+        connected.set()
+
+    locator = phone2geo.number_locator(phone2geo.SQLITE_BACKEND)
+    thread = threading.Thread(target=lookup)
+    thread.start()
+    connected.wait()
+    with locator:
+      own = locator.conn
+    exited.set()
+    thread.join()
+
+    self.assertEqual(errors, [])
+    self.assertIs(connections[0], connections[1])
+    self.assertIsNot(locator.conn, own)
+
+  def test_shared_locator_cannot_be_closed(self):
+    """Threads reading through the shared locator should never have their
+    connections closed by another thread entering and exiting it"""
+
+    numbers = ['2128675309', '2048675309', '9115555555']
+    expected = list(phone2geo.locate_numbers(numbers))
+    stopped = threading.Event()
+    errors = []
+
+    def lookup():
+      try:
+        while not stopped.is_set():
+          self.assertEqual(phone2geo.locate_number(numbers[0]), expected[0])
+          self.assertEqual(
+            [str(r) for r in phone2geo.locate_numbers(numbers)],
+            [str(r) for r in expected])
+      except Exception as err:
+        errors.append(err)
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    try:
+      conn = phone2geo.shared_locator().conn
+      for _ in range(200):
+        with phone2geo.shared_locator() as locator:
+          locator.locate_number(numbers[0])
+      self.assertIs(phone2geo.shared_locator().conn, conn)
+    finally:
+      stopped.set()
+      for thread in threads:
+        thread.join()
+
+    self.assertEqual(errors, [])
+
+
+class LRUCacheTest(unittest.TestCase):
+  def test_evicts_least_recently_used_entries(self):
+    cache = phone2geo.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', None)
+    self.assertEqual(cache.get('a'), 1)
+    cache.put('c', 3)
+
+    self.assertIs(cache.get('b'), phone2geo.LRUCache.MISSING)
+    self.assertEqual(cache.stats(), phone2geo.CacheStats(1, 1, 1, 2, 2))
+
+  def test_never_serves_entries_from_another_generation(self):
+    """A reader that queried the old database before it was replaced may put
+    its row after the cache was cleared for the new one"""
+
+    cache = phone2geo.LRUCache(10)
+    cache.put('2128675309', 'new row', generation=1)
+    cache.clear()
+    cache.put('2128675309', 'old row', generation=0)
+
+    self.assertIs(cache.get('2128675309', generation=1), phone2geo.LRUCache.MISSING)
+    cache.put('2128675309', 'new row', generation=1)
+    self.assertEqual(cache.get('2128675309', generation=1), 'new row')
+
+
+class ResolutionTableTest(unittest.TestCase):
+  def setUp(self):
+    """Copy the database with a freshly materialized resolution table"""
+
+    self.workdir = tempfile.TemporaryDirectory()
+    self.db_path = os.path.join(self.workdir.name, 'carrier_meta.sqlite3')
+    with sqlite3.connect(phone2geo.DEFAULT_DB_PATH) as source:
+      with sqlite3.connect(self.db_path) as copy:
+        source.backup(copy)
+        phone2geo_build.write_resolution_table(copy)
+      copy.close()
+    source.close()
+
+  def tearDown(self):
+    self.workdir.cleanup()
+
+  def test_matches_stepwise_lookups(self):
+    self.assertGreater(phone2geo_build.validate_resolution_table(self.db_path), 0)
+
+    numbers = ['2128675309', '9115555555', '2129115555', '2048675309', '0']
+    instrumentation = phone2geo.LookupInstrumentation()
+    with phone2geo.number_locator(
+        db_path=self.db_path,
+        instrumentation=instrumentation) as locator:
+      self.assertTrue(locator.uses_resolution_table)
+      results = [locator.lookup(number) for number in numbers]
+      self.assertEqual(
+        [result.status for result in results],
+        [result.status for result in locator.lookup_many(numbers)])
+      self.assertEqual(results[0].record, phone2geo.locate_number(numbers[0]))
+      self.assertEqual(results[1].error.explanation,
+        self.__explanation(numbers[1]))
+      self.assertEqual(locator.stats().stages['resolution'].calls, 4)
+
+  def test_finds_effective_ranges_by_attribute(self):
+    record = phone2geo.locate_number('2128675309')
+    with phone2geo.number_locator(db_path=self.db_path) as locator:
+      with self.assertRaises(ValueError):
+        locator.find_ranges()
+
+      ranges = locator.find_ranges(
+        rate_center=record.rate_center,
+        operating_company_number=record.operating_company_number)
+      self.assertTrue(any(
+        number_range.first <= '2128675309' <= number_range.last
+        for number_range in ranges))
+      for number_range in ranges:
+        for number in (number_range.first, number_range.last):
+          found = locator.locate_number(number)
+          self.assertEqual(found.rate_center, record.rate_center)
+          self.assertEqual(found.carrier, number_range.carrier)
+
+      # Every block of an exchange is covered exactly once across carriers
+      exchange = [
+        number_range
+        for carrier in {
+          locator.locate_number(f"212867{x}000").carrier for x in range(10)
+        }
+        for number_range in locator.find_ranges(carrier=carrier)
+        if number_range.first.startswith('212867')
+      ]
+      self.assertEqual(
+        sum(int(r.last[6]) - int(r.first[6]) + 1 for r in exchange), 10)
+
+    with phone2geo.number_locator(resolution_table=False) as locator:
+      with self.assertRaises(ValueError):
+        locator.find_ranges(carrier=record.carrier)
+
+  def test_validation_reports_disagreements(self):
+    with sqlite3.connect(self.db_path) as conn:
+      conn.execute("DELETE FROM resolution WHERE key = 212")
+    conn.close()
+
+    with self.assertRaises(ValueError):
+      phone2geo_build.validate_resolution_table(self.db_path)
+
+  @staticmethod
+  def __explanation(number):
+    try:
+      phone2geo.locate_number(number)
+    except phone2geo.InvalidAreaCodeError as err:
+      return err.explanation
+
+
+class ReloadingLocatorTest(unittest.TestCase):
+  def setUp(self):
+    self.workdir = tempfile.TemporaryDirectory()
+    self.db_path = os.path.join(self.workdir.name, 'carrier_meta.sqlite3')
+    self.publish('first')
+
+  def tearDown(self):
+    self.workdir.cleanup()
+
+  def publish(self, import_id):
+    """Replace the database the way build/build_npa_db.py does"""
+
+    staging_path = f"{self.db_path}.{import_id}"
+    with sqlite3.connect(phone2geo.DEFAULT_DB_PATH) as source:
+      with sqlite3.connect(staging_path) as staging:
+        source.backup(staging)
+        staging.execute('DROP TABLE IF EXISTS import_info')
+        staging.execute('CREATE TABLE import_info (key TEXT PRIMARY KEY, value TEXT)')
+        staging.execute("INSERT INTO import_info VALUES ('importId', ?)", [import_id])
+      staging.close()
+    source.close()
+    os.replace(staging_path, self.db_path)
+
+  def test_swaps_in_replaced_database(self):
+    with phone2geo.reloading_locator(
+        self.db_path,
+        reload_check_interval=3600) as locator:
+      self.assertEqual(locator.lookup('2128675309').import_id, 'first')
+      self.assertFalse(locator.reload())
+
+      in_flight = locator.lookup_many(['2128675309'] * 3, batch_size=1)
+      self.assertEqual(next(in_flight).import_id, 'first')
+
+      self.publish('second')
+      self.assertTrue(locator.reload())
+      self.assertEqual(locator.import_id, 'second')
+
+      second = locator.lookup('2128675309')
+      self.assertEqual(second.import_id, 'second')
+      self.assertEqual(second.record, phone2geo.locate_number('2128675309'))
+      # The new snapshot was warmed by replaying the earlier lookup
+      self.assertEqual(locator.cache_stats()['npa'].misses
+        + locator.cache_stats()['resolution'].misses, 1)
+
+      # Lookups already under way finish on the snapshot they started with
+      self.assertEqual([r.import_id for r in in_flight], ['first', 'first'])
+
+  def test_threads_never_read_a_replacement_through_the_old_snapshot(self):
+    with phone2geo.reloading_locator(
+        self.db_path,
+        reload_check_interval=3600) as locator:
+      locator.lookup('2128675309')
+      self.publish('second')
+
+      results = []
+      reloads = []
+      reload = locator.reload
+      def record_reload():
+        reloads.append(threading.current_thread().name)
+        return reload()
+      locator.reload = record_reload
+
+      thread = threading.Thread(
+        target=lambda: results.append(locator.lookup('2128675309')))
+      thread.start()
+      thread.join()
+
+      self.assertEqual(results[0].import_id, 'second')
+      self.assertEqual(locator.import_id, 'second')
+      # The new snapshot was loaded by the background thread, not the caller
+      self.assertEqual(set(reloads), {'phone2geo-reloader'})
+
+  def test_warms_with_batch_lookups_without_counting_them(self):
+    instrumentation = phone2geo.LookupInstrumentation()
+    with phone2geo.reloading_locator(
+        self.db_path,
+        reload_check_interval=3600,
+        instrumentation=instrumentation) as locator:
+      list(locator.lookup_many(['2128675309', '2048675309']))
+      self.publish('second')
+      self.assertTrue(locator.reload())
+
+      misses = locator.cache_stats()['resolution'].misses
+      self.assertEqual(misses, 2)
+      self.assertEqual(locator.lookup('2048675309').import_id, 'second')
+      self.assertEqual(locator.cache_stats()['resolution'].misses, misses)
+      self.assertEqual(sum(locator.stats().outcomes.values()), 3)
+
+  def test_threads_can_enter_and_exit_concurrently(self):
+    locator = phone2geo.reloading_locator(self.db_path, reload_check_interval=0.01)
+    errors = []
+
+    def lookup():
+      try:
+        for _ in range(50):
+          with locator:
+            self.assertEqual(locator.lookup('2128675309').import_id, 'first')
+      except Exception as err:
+        errors.append(err)
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(errors, [])
+    with self.assertRaises(ValueError):
+      locator.lookup('2128675309')
+
+  def test_stays_closed_when_opening_fails(self):
+    missing_path = os.path.join(self.workdir.name, 'missing.sqlite3')
+    locator = phone2geo.reloading_locator(missing_path, reload_check_interval=3600)
+    with self.assertRaises(OSError):
+      with locator:
+        self.fail('The context should not have been entered')
+
+    os.replace(self.db_path, missing_path)
+    with locator:
+      self.assertEqual(locator.lookup('2128675309').import_id, 'first')
+
+  def test_background_thread_detects_new_snapshot(self):
+    with phone2geo.reloading_locator(
+        self.db_path,
+        reload_check_interval=0.01) as locator:
+      self.publish('second')
+      for _ in range(500):
+        if locator.import_id == 'second':
+          break
+        threading.Event().wait(0.01)
+
+      self.assertEqual(locator.lookup('2128675309').import_id, 'second')
+
+
+class CommandLineTest(unittest.TestCase):
+  numbers = ['2128675309', '(212) 867-5309', '9115555555', 'not a number']
+
+  def setUp(self):
+    self.workdir = tempfile.TemporaryDirectory()
+    self.input_path = os.path.join(self.workdir.name, 'input.csv')
+    with open(self.input_path, 'w', newline='') as input_file:
+      writer = csv.writer(input_file)
+      writer.writerow(['id', 'phone'])
+      for idx, number in enumerate(self.numbers):
+        writer.writerow([idx, number])
+
+  def tearDown(self):
+    self.workdir.cleanup()
+
+  def run_cli(self, *args):
+    output_path = os.path.join(self.workdir.name, f"{uuid.uuid4()}.out")
+    phone2geo_cli.main(
+      [self.input_path, '-c', 'phone', '-o', output_path, '-q', *args])
+    with open(output_path, newline='') as output_file:
+      return output_file.read()
+
+  def test_enriches_csv_rows_in_input_order(self):
+    rows = list(csv.DictReader(self.run_cli('--chunk-size', '3').splitlines()))
+
+    self.assertEqual([row['id'] for row in rows], ['0', '1', '2', '3'])
+    self.assertEqual(rows[0]['rate_center'], 'NWYRCYZN01')
+    self.assertEqual(rows[1]['phone_number'], '2128675309')
+    self.assertEqual(rows[0]['error'], '')
+    self.assertEqual(rows[2]['error'], 'InvalidAreaCodeError')
+    self.assertEqual(rows[3]['error'], 'InvalidNumberError')
+
+  def test_worker_pool_preserves_output(self):
+    self.assertEqual(
+      self.run_cli('--chunk-size', '1'),
+      self.run_cli('--chunk-size', '1', '--workers', '2'))
+
+  def test_writes_jsonl(self):
+    lines = self.run_cli('--output-format', 'jsonl').splitlines()
+    records = [json.loads(line) for line in lines]
+
+    self.assertEqual(len(records), len(self.numbers))
+    self.assertEqual(records[0]['region'], 'NY')
+    self.assertIsNone(records[3]['region'])
+
+  def write_input(self, name, text):
+    self.input_path = os.path.join(self.workdir.name, name)
+    with open(self.input_path, 'w', newline='') as input_file:
+      input_file.write(text)
+
+  def run_failing_cli(self, *args):
+    output_path = os.path.join(self.workdir.name, f"{uuid.uuid4()}.out")
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+      status = phone2geo_cli.main(
+        [self.input_path, '-c', 'phone', '-o', output_path, '-q', *args])
+    return status, stderr.getvalue()
+
+  def test_rejects_rows_longer_than_the_header(self):
+    self.write_input('long.csv', 'id,phone\n0,2128675309\n1,2128675309,x\n')
+    status, message = self.run_failing_cli()
+
+    self.assertEqual(status, 1)
+    self.assertIn('Row 2 of the input has 3 fields', message)
+
+  def test_pads_rows_shorter_than_the_header(self):
+    self.write_input('short.csv', 'id,phone,note\n0,2128675309\n')
+    rows = list(csv.DictReader(self.run_cli().splitlines()))
+
+    self.assertEqual(rows[0]['note'], '')
+    self.assertEqual(rows[0]['region'], 'NY')
+
+  def test_takes_csv_header_from_first_record(self):
+    records = [{'phone': number, 'id': idx}
+               for idx, number in enumerate(self.numbers)]
+    self.write_input(
+      'input.jsonl', ''.join(json.dumps(record) + '\n' for record in records))
+    rows = list(csv.DictReader(self.run_cli(
+      '-f', 'jsonl', '--output-format', 'csv', '--chunk-size', '1').splitlines()))
+
+    self.assertEqual(list(rows[0])[:2], ['phone', 'id'])
+    self.assertEqual([row['id'] for row in rows], ['0', '1', '2', '3'])
+    self.assertEqual(rows[0]['region'], 'NY')
+
+  def test_rejects_records_with_keys_missing_from_header(self):
+    self.write_input(
+      'input.jsonl',
+      '{"phone": "2128675309"}\n\n{"phone": "2128675309", "note": "x"}\n')
+    status, message = self.run_failing_cli(
+      '-f', 'jsonl', '--output-format', 'csv')
+
+    self.assertEqual(status, 1)
+    self.assertIn('Line 3 of the input has keys missing', message)
+    self.assertIn('note', message)
+
+  def test_rejects_input_columns_named_like_appended_columns(self):
+    self.write_input('region.csv', 'region,phone\nNY,2128675309\n')
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+      with self.assertRaises(SystemExit):
+        self.run_cli()
+    self.assertIn(
+      'already has the columns region; pass --prefix',
+      stderr.getvalue())
+
+    rows = list(csv.DictReader(self.run_cli('--prefix', 'geo_').splitlines()))
+    self.assertEqual(rows[0]['region'], 'NY')
+    self.assertEqual(rows[0]['geo_region'], 'NY')
+
+    self.write_input(
+      'error.jsonl',
+      '{"phone": "2128675309"}\n{"phone": "", "error": "x"}\n')
+    status, message = self.run_failing_cli('-f', 'jsonl')
+    self.assertEqual(status, 1)
+    self.assertIn('Line 2 of the input already has the columns error', message)
+
+  def test_rejects_records_that_are_not_objects(self):
+    self.write_input('input.jsonl', '{"phone": "2128675309"}\n[1, 2]\n')
+    status, message = self.run_failing_cli('-f', 'jsonl')
+
+    self.assertEqual(status, 1)
+    self.assertIn('Line 2', message)
+
+
+class ServerTest(unittest.TestCase):
+  numbers = ['2128675309', '(212) 867-5309', '9115555555', 'not a number']
+
+  def test_coalesces_concurrent_lookups(self):
+    async def lookup_concurrently(locator):
+      batcher = phone2geo_server.LookupBatcher(locator, batch_window=0.05)
+      try:
+        results = await asyncio.gather(*(
+          batcher.lookup_many([number]) for number in self.numbers))
+        return [result for (result,) in results], batcher.stats()
+      finally:
+        batcher.close()
+
+    with phone2geo.number_locator() as locator:
+      results, stats = asyncio.run(lookup_concurrently(locator))
+      expected = [locator.lookup(number) for number in self.numbers]
+    self.assertEqual(
+      [(result.status, result.record) for result in results],
+      [(result.status, result.record) for result in expected])
+    self.assertEqual(stats['submissions'], 4)
+    self.assertEqual(stats['batches'], 1)
+    self.assertEqual(stats['pending'], 0)
+
+  def test_rejects_lookups_past_max_pending(self):
+    async def lookup_concurrently(locator):
+      batcher = phone2geo_server.LookupBatcher(locator, max_pending=3)
+      try:
+        return await asyncio.gather(
+          batcher.lookup_many(self.numbers[:3]),
+          batcher.lookup_many(self.numbers[3:]),
+          return_exceptions=True)
+      finally:
+        batcher.close()
+
+    with phone2geo.number_locator() as locator:
+      results = asyncio.run(lookup_concurrently(locator))
+    self.assertEqual(len(results[0]), 3)
+    self.assertIsInstance(results[1], phone2geo_server.ServerOverloadedError)
+
+  def test_serves_lookups_over_http(self):
+    def request(port):
+      with phone2geo_server.LookupClient(port=port) as client:
+        single = client.lookup(self.numbers[0])
+        many = client.lookup_many(self.numbers)
+        with self.assertRaises(phone2geo_server.LookupServiceError) as context:
+          client.lookup('')
+        return single, many, context.exception.status, client.stats()
+
+    async def serve(locator):
+      server = phone2geo_server.LookupServer(locator, port=0)
+      await server.start()
+      try:
+        return await asyncio.get_running_loop().run_in_executor(
+          None, request, server.port)
+      finally:
+        await server.stop()
+
+    with phone2geo.number_locator() as locator:
+      single, many, status, stats = asyncio.run(serve(locator))
+
+    self.assertEqual(single['rate_center'], 'NWYRCYZN01')
+    self.assertIsNone(single['error'])
+    self.assertEqual(many[1], single)
+    self.assertEqual(many[2]['error'], 'InvalidAreaCodeError')
+    self.assertEqual(many[3]['status'], 'INVALID_NUMBER')
+    self.assertIsNone(many[3]['carrier'])
+    self.assertEqual(status, 400)
+    self.assertEqual(stats['server']['numbers'], 5)
+
+
+  def test_answers_failures_with_error_statuses(self):
+    def request(port):
+      with phone2geo_server.LookupClient(port=port) as client:
+        with self.assertRaises(phone2geo_server.LookupServiceError) as context:
+          client.lookup(self.numbers[0])
+        # The connection survives a failed lookup
+        stats = client.stats()
+
+      connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+      try:
+        connection.putrequest('POST', '/locate')
+        connection.putheader('Content-Length', 'many')
+        connection.endheaders()
+        response = connection.getresponse()
+        response.read()
+      finally:
+        connection.close()
+      return context.exception.status, stats, response.status
+
+    async def serve(locator):
+      server = phone2geo_server.LookupServer(locator, port=0)
+      await server.start()
+      try:
+        return await asyncio.get_running_loop().run_in_executor(
+          None, request, server.port)
+      finally:
+        await server.stop()
+
+    with phone2geo.number_locator() as locator:
+      failure = sqlite3.OperationalError('disk I/O error')
+      with unittest.mock.patch.object(locator, 'lookup_many', side_effect=failure), \
+          contextlib.redirect_stderr(io.StringIO()):
+        lookup_status, stats, length_status = asyncio.run(serve(locator))
+
+    self.assertEqual(lookup_status, 500)
+    self.assertEqual(stats['server']['numbers'], 1)
+    self.assertEqual(length_status, 400)
+
+
+class BenchmarkTest(unittest.TestCase):
+  def test_generates_workloads_from_dataset(self):
+    source = phone2geo_bench.load_workload_source()
+    workloads = {
+      name: phone2geo_bench.generate_workload(name, 200, source, seed=1)
+      for name in phone2geo_bench.WORKLOADS
+    }
+
+    self.assertEqual(
+      workloads['uniform'],
+      phone2geo_bench.generate_workload('uniform', 200, source, seed=1))
+    with phone2geo.number_locator() as locator:
+      for number in workloads['uniform'] + workloads['skewed']:
+        self.assertEqual(locator.lookup(number).status, phone2geo.LookupStatus.OK)
+      for number in workloads['invalid']:
+        self.assertEqual(
+          locator.lookup(number).status,
+          phone2geo.LookupStatus.INVALID_NUMBER)
+      self.assertGreater(
+        sum(not locator.has_us_area_code(n) for n in workloads['non_us']), 100)
+
+  def test_reports_regressions_beyond_threshold(self):
+    baseline = {'results': {
+      'sqlite.lookup.uniform': {'p50_us': 10.0, 'p99_us': 50.0, 'mean_us': 10.0},
+      'sqlite.locate_numbers.uniform': {
+        'numbers_per_sec': 1000.0, 'best_numbers_per_sec': 2000.0},
+      'sqlite.locate_number.new_context': {'p50_us': 100.0},
+      'sqlite.cold_start': {'median_seconds': 0.1},
+    }}
+    # Only medians across trials are gated
+    report = {'results': {
+      'sqlite.lookup.uniform': {'p50_us': 12.0, 'p99_us': 500.0, 'mean_us': 50.0},
+      'sqlite.locate_numbers.uniform': {
+        'numbers_per_sec': 500.0, 'best_numbers_per_sec': 100.0},
+      'sqlite.locate_number.new_context': {'p50_us': 1000.0},
+      'sqlite.cold_start': {'median_seconds': 1.0},
+      'compiled.lookup.uniform': {'p50_us': 1.0},
+    }}
+
+    self.assertEqual(len(phone2geo_bench.compare(report, baseline, 0.25)), 1)
+    self.assertEqual(len(phone2geo_bench.compare(report, baseline, 0.1)), 2)
+
+class ReportHandler(http.server.BaseHTTPRequestHandler):
+  """Serves the report in server.report, honoring If-None-Match unless the
+  report says not to, and records the headers of every request"""
+
+  def do_GET(self):
+    report = self.server.report
+    self.server.requests.append(dict(self.headers))
+    if report['conditional'] and self.headers.get('If-None-Match') == report['etag']:
+      self.send_response(304)
+      self.end_headers()
+      return
+
+    self.send_response(200)
+    self.send_header('ETag', report['etag'])
+    self.send_header('Content-Length', str(len(report['body'])))
+    self.end_headers()
+    self.wfile.write(report['body'])
+
+  def log_message(self, format, *args):
+    pass
+
+
+class RefreshAssetsTest(unittest.TestCase):
+  def setUp(self):
+    self.workdir = tempfile.TemporaryDirectory()
+    self.destination = os.path.join(self.workdir.name, 'npa_report.csv')
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ReportHandler)
+    self.server.report = {
+      'body': b'NPA_ID,COUNTRY\n212,US\n',
+      'etag': '"v1"',
+      'conditional': True,
+    }
+    self.server.requests = []
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url = f"http://127.0.0.1:{self.server.server_address[1]}/report"
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.workdir.cleanup()
+
+  def read_destination(self):
+    with open(self.destination, 'rb') as report:
+      return report.read()
+
+  def test_skips_reports_that_have_not_changed(self):
+    body = self.server.report['body']
+    first = refresh_assets.fetch_report(self.url, self.destination)
+    self.assertTrue(first['changed'])
+    self.assertEqual(first['etag'], '"v1"')
+    self.assertEqual(first['sha256'], hashlib.sha256(body).hexdigest())
+    self.assertEqual(self.read_destination(), body)
+    self.assertNotIn('If-None-Match', self.server.requests[-1])
+
+    # The server answers a conditional request with 304 Not Modified
+    second = refresh_assets.fetch_report(self.url, self.destination, previous=first)
+    self.assertFalse(second['changed'])
+    self.assertEqual(second['sha256'], first['sha256'])
+    self.assertEqual(self.server.requests[-1]['If-None-Match'], '"v1"')
+
+    # A full download of identical content leaves the existing file alone
+    self.server.report['conditional'] = False
+    modified = os.stat(self.destination).st_mtime_ns
+    third = refresh_assets.fetch_report(self.url, self.destination, previous=second)
+    self.assertFalse(third['changed'])
+    self.assertEqual(os.stat(self.destination).st_mtime_ns, modified)
+    self.assertEqual(os.listdir(self.workdir.name), ['npa_report.csv'])
+
+    self.server.report.update(body=b'NPA_ID,COUNTRY\n212,US\n907,US\n', etag='"v2"')
+    fourth = refresh_assets.fetch_report(self.url, self.destination, previous=third)
+    self.assertTrue(fourth['changed'])
+    self.assertEqual(fourth['etag'], '"v2"')
+    self.assertEqual(self.read_destination(), self.server.report['body'])
+
+  def test_extracts_archive_member(self):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zipped:
+      zipped.writestr('README.txt', b'Not this one')
+      zipped.writestr('allutlzd.txt', b'NPA-NXX\tUse\n212-867\tAS\n')
+    self.server.report['body'] = archive.getvalue()
+
+    metadata = refresh_assets.fetch_report(
+      self.url,
+      self.destination,
+      archive_member='allutlzd.txt')
+    self.assertTrue(metadata['changed'])
+    self.assertEqual(self.read_destination(), b'NPA-NXX\tUse\n212-867\tAS\n')
+    self.assertEqual(
+      metadata['sha256'],
+      hashlib.sha256(self.read_destination()).hexdigest())
+
+
+class ImportTestCase(unittest.TestCase):
+  """Builds databases from small reports written to a temporary directory"""
+
+  nxx_headers = ['State', 'NPA-NXX', 'OCN', 'Company', 'RateCenter', 'Use']
+  block_headers = ['NPA', 'NXX', 'X', 'State', 'Rate Center', 'OCN', 'Assigned To']
+
+  def setUp(self):
+    self.workdir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.workdir.cleanup()
+
+  def path(self, name):
+    return os.path.join(self.workdir.name, name)
+
+  def write_report(self, name, headers, rows, delimiter=','):
+    with open(self.path(name), 'w', newline='') as report:
+      writer = csv.writer(report, delimiter=delimiter)
+      writer.writerow(headers)
+      writer.writerows(rows)
+    return self.path(name)
+
+  def build(self, output, nxx_rows, block_rows, prev_manifest, *args):
+    nxx_path = self.write_report(f"{output}.tsv", self.nxx_headers, nxx_rows, '\t')
+    blocks_path = self.write_report(f"{output}.csv", self.block_headers, block_rows)
+    with contextlib.redirect_stdout(io.StringIO()):
+      build_npa_db.main([
+        '--output', self.path(f"{output}.sqlite3"),
+        '--index-output', self.path(f"{output}.idx"),
+        '--nxx', nxx_path,
+        '--blocks', blocks_path,
+        '--prev-manifest', self.path(prev_manifest),
+        '--manifest-out', self.path(f"{output}.json"),
+        *args,
+      ])
+    with open(self.path(f"{output}.json")) as manifest:
+      return json.load(manifest)
+
+  def tables(self, db_path):
+    with sqlite3.connect(db_path) as conn:
+      tables = {
+        table: sorted(conn.execute(f"SELECT * FROM {table}"))
+        for table in ('npa', 'npa_nxx', 'blocks', 'resolution')
+      }
+    conn.close()
+    return tables
+
+
+class BulkLoadTest(ImportTestCase):
+  npa_headers = [
+    'NPA_ID', 'ASSIGNABLE', 'EXPLANATION', 'IN_SERVICE', 'ASSIGNED', 'COUNTRY',
+    'TIME_ZONE', 'LOCATION']
+  npa_rows = [
+    ['212', 'Yes', '', 'Y', 'Yes', 'US', 'E', 'NY'],
+    ['907', 'Yes', '', 'Y', 'Yes', 'US', 'Z', 'AK'],
+    ['911', 'No', 'Easily recognizable code', '', '', '', '', ''],
+  ]
+  nxx_rows = [
+    ['NY', '212-867', '9104', 'Carrier A', 'NWYRCYZN01', 'AS'],
+    ['AK', '907-555', '9106', 'Carrier C', 'ANCHORAGE', 'AS'],
+  ]
+  block_rows = [['212', '867', '0', 'NY', 'NWYRCYZN01', '9107', 'Carrier D']]
+
+  def write_npa_report(self, file_date_line):
+    with open(self.path('npa.csv'), 'w', newline='') as report:
+      report.write(file_date_line)
+      writer = csv.writer(report)
+      writer.writerow(self.npa_headers)
+      writer.writerows(self.npa_rows)
+
+  def test_parallel_load_matches_serial_load(self):
+    """Reports parsed in worker processes should load exactly as they do when
+    parsed and loaded one after another in this process"""
+
+    self.write_npa_report('File Date,03/01/2020\n')
+    self.build(
+      'parallel', self.nxx_rows, self.block_rows, 'missing.json',
+      '--npa', self.path('npa.csv'))
+
+    serial = sqlite3.connect(':memory:')
+    self.addCleanup(serial.close)
+    for table_name, name, delimiter, has_file_date, key_columns in (
+        ('npa', 'npa.csv', ',', True, ['NPA_ID']),
+        ('npa_nxx', 'parallel.tsv', '\t', False, ['NPA-NXX']),
+        ('blocks', 'parallel.csv', ',', False, ['NPA', 'NXX', 'X'])):
+      report = build_npa_db.parse_report(self.path(name), delimiter, has_file_date)
+      build_npa_db.load_report(serial, table_name, key_columns, report)
+
+    parallel = self.tables(self.path('parallel.sqlite3'))
+    for table_name in ('npa', 'npa_nxx', 'blocks'):
+      self.assertEqual(
+        parallel[table_name],
+        sorted(serial.execute(f"SELECT * FROM {table_name}")))
+    self.assertEqual(len(parallel['npa']), len(self.npa_rows))
+
+  def test_propagates_worker_errors(self):
+    """A report that fails to parse in a worker process should fail the build
+    without publishing a database"""
+
+    # The first line of the NPA database must carry the file date
+    self.write_npa_report('File Date 03/01/2020\n')
+    with self.assertRaises(ValueError):
+      self.build(
+        'failed', self.nxx_rows, self.block_rows, 'missing.json',
+        '--npa', self.path('npa.csv'))
+
+    # Only the reports remain; not even the temporary database is left behind
+    self.assertEqual(
+      sorted(os.listdir(self.workdir.name)),
+      ['failed.csv', 'failed.tsv', 'npa.csv'])
+
+
+class IncrementalImportTest(ImportTestCase):
+  def test_applies_inserted_updated_and_deleted_rows(self):
+    conn = sqlite3.connect(':memory:')
+    self.addCleanup(conn.close)
+    headers = ['NPA', 'NXX', 'X', 'Assigned_To']
+    build_npa_db.load_report(conn, 'blocks', ['NPA', 'NXX', 'X'], {
+      'headers': headers,
+      'rows': [('212', '867', '0', 'A'), ('212', '867', '1', 'B'), ('212', '867', '2', 'C')],
+    })
+
+    rows = [('212', '867', '0', 'A'), ('212', '867', '1', 'Z'), ('212', '867', '3', 'D')]
+    changes, _ = build_npa_db.apply_report_diff(
+      conn, 'blocks', ['NPA', 'NXX', 'X'], {'headers': headers, 'rows': rows})
+
+    self.assertEqual(changes, {
+      'inserted': ['212-867-3'],
+      'updated': ['212-867-1'],
+      'deleted': ['212-867-2'],
+    })
+    self.assertEqual(sorted(conn.execute('SELECT * FROM blocks')), rows)
+
+  def test_rejects_repeated_keys_like_full_import(self):
+    """A report repeating a primary key fails an incremental import just as it
+    fails a full one, whether or not the key is already in the table"""
+
+    headers = ['NPA', 'NXX', 'X', 'Assigned_To']
+    key_columns = ['NPA', 'NXX', 'X']
+    existing = [('212', '867', '0', 'A')]
+    for repeated in (('212', '867', '0', 'B'), ('212', '867', '1', 'B')):
+      report = {'headers': headers, 'rows': existing + [repeated] * 2}
+
+      full = sqlite3.connect(':memory:')
+      self.addCleanup(full.close)
+      with self.assertRaises(sqlite3.IntegrityError) as full_error:
+        build_npa_db.load_report(full, 'blocks', key_columns, report)
+
+      patched = sqlite3.connect(':memory:')
+      self.addCleanup(patched.close)
+      build_npa_db.load_report(
+        patched, 'blocks', key_columns, {'headers': headers, 'rows': existing})
+      with self.assertRaises(sqlite3.IntegrityError) as patch_error:
+        build_npa_db.apply_report_diff(patched, 'blocks', key_columns, report)
+
+      self.assertEqual(str(patch_error.exception), str(full_error.exception))
+      self.assertEqual(list(patched.execute('SELECT * FROM blocks')), existing)
+
+  def test_incremental_import_matches_full_import(self):
+    nxx_rows = [
+      ['NY', '212-867', '9104', 'Carrier A', 'NWYRCYZN01', 'AS'],
+      ['NY', '212-868', '9104', 'Carrier A', 'NWYRCYZN01', 'AS'],
+      ['NY', '212-869', '9105', 'Carrier B', 'NWYRCYZN01', 'UA'],
+      ['AK', '907-555', '9106', 'Carrier C', 'ANCHORAGE', 'AS'],
+    ]
+    block_rows = [
+      ['212', '867', '0', 'NY', 'NWYRCYZN01', '9107', 'Carrier D'],
+      ['212', '867', '5', 'NY', 'NWYRCYZN01', '9107', 'Carrier D'],
+    ]
+    self.build('first', nxx_rows, block_rows, 'missing.json')
+
+    nxx_rows[1][3] = 'Carrier E'
+    del nxx_rows[3]
+    nxx_rows.append(['AK', '907-556', '9106', 'Carrier C', 'ANCHORAGE', 'AS'])
+    block_rows.append(['212', '868', '1', 'NY', 'NWYRCYZN01', '9107', 'Carrier D'])
+
+    # The incremental import patches the first database in place of a rebuild
+    os.replace(self.path('first.sqlite3'), self.path('patched.sqlite3'))
+    manifest = self.build(
+      'patched', nxx_rows, block_rows, 'first.json', '--incremental')
+    self.build('full', nxx_rows, block_rows, 'missing.json')
+
+    self.assertEqual(manifest['importMode'], 'incremental')
+    self.assertEqual(manifest['changes']['npa_nxx'], {
+      'inserted': ['907-556'],
+      'updated': ['212-868'],
+      'deleted': ['907-555'],
+    })
+    self.assertEqual(manifest['changes']['blocks']['inserted'], ['212-868-1'])
+    self.assertNotIn('npa', manifest['changes'])
+    self.assertEqual(
+      self.tables(self.path('patched.sqlite3')),
+      self.tables(self.path('full.sqlite3')))
+    with open(self.path('patched.idx'), 'rb') as patched, \
+        open(self.path('full.idx'), 'rb') as full:
+      self.assertEqual(patched.read(), full.read())
+
+  def test_rebuilds_database_not_produced_by_previous_import(self):
+    nxx_rows = [['NY', '212-867', '9104', 'Carrier A', 'NWYRCYZN01', 'AS']]
+    self.build('first', nxx_rows, [], 'missing.json')
+    self.build('other', nxx_rows + [
+      ['NY', '212-868', '9104', 'Carrier A', 'NWYRCYZN01', 'AS'],
+    ], [], 'missing.json')
+
+    # The previous manifest describes the first database, not this one
+    os.replace(self.path('other.sqlite3'), self.path('patched.sqlite3'))
+    manifest = self.build(
+      'patched', nxx_rows, [], 'first.json', '--incremental')
+
+    self.assertEqual(manifest['importMode'], 'full')
+    self.assertEqual(
+      self.tables(self.path('patched.sqlite3')),
+      self.tables(self.path('first.sqlite3')))
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class VectorizedIntegrationTest(unittest.TestCase):
+  def test_matches_single_number_lookups(self):
+    numbers = [2128675309, 1555555555, 9115555555, 2129115555, 2048675309, -1]
+    statuses = [
+      phone2geo.LookupStatus.OK,
+      phone2geo.LookupStatus.INVALID_NUMBER,
+      phone2geo.LookupStatus.INVALID_AREA_CODE,
+      phone2geo.LookupStatus.INVALID_EXCHANGE,
+      phone2geo.LookupStatus.OK,
+      phone2geo.LookupStatus.INVALID_NUMBER,
+    ]
+
+    result = phone2geo_vectorized.locate_array(numpy.array(numbers))
+    self.assertEqual(list(result.status), statuses)
+
+    carriers = result.carrier.decode()
+    rate_centers = result.rate_center.decode()
+    countries = result.country.decode()
+    for idx in (0, 4):
+      record = phone2geo.locate_number(str(numbers[idx]))
+      self.assertEqual(carriers[idx], record.carrier)
+      self.assertEqual(rate_centers[idx], record.rate_center)
+      self.assertEqual(countries[idx], record.country)
+
+    # Failed lookups carry no metadata
+    self.assertEqual(list(result.region.codes[[1, 2, 3, 5]]), [-1] * 4)
+
+@unittest.skipIf(numpy is None or pandas is None, 'pandas is not installed')
+class FramesIntegrationTest(unittest.TestCase):
+  numbers = [
+    '2128675309', '(212) 867-5309', '9115555555', '2129115555', '2048675309',
+    'not a number', None, '212\u00e98675309', '212\uff18\uff16\uff17\uff15\uff13\uff10\uff19',
+  ]
+
+  def assertMatchesLookups(self, numbers, status, columns):
+    for idx, number in enumerate(numbers):
+      result = phone2geo.shared_locator().lookup(str(number) if number is not None else '')
+      self.assertEqual(status[idx], result.status, number)
+      for name in phone2geo_frames.METADATA_COLUMNS:
+        value = columns[name][idx]
+        expected = getattr(result.record, name) if result.record is not None else None
+        self.assertEqual(value if isinstance(value, str) else None, expected, number)
+
+  def test_enriches_string_columns_in_chunks(self):
+    frame = pandas.DataFrame({'id': range(len(self.numbers)), 'phone': self.numbers})
+    enriched = phone2geo_frames.enrich_frame(frame, 'phone', chunk_size=4)
+
+    self.assertEqual(list(frame.columns), ['id', 'phone'])
+    self.assertEqual(
+      list(enriched.columns),
+      ['id', 'phone'] + phone2geo_frames.enrichment_columns())
+    self.assertEqual(enriched['carrier'].dtype, 'category')
+    self.assertMatchesLookups(
+      self.numbers,
+      enriched['status'].to_numpy(),
+      {name: enriched[name].tolist() for name in phone2geo_frames.METADATA_COLUMNS})
+    # Digits outside ASCII are malformed whichever lookup path is used
+    self.assertEqual(
+      list(enriched['status'][-2:]),
+      [phone2geo.LookupStatus.INVALID_NUMBER] * 2)
+
+    with self.assertRaises(ValueError):
+      phone2geo_frames.enrich_frame(enriched, 'phone')
+    self.assertIn(
+      'geo_status',
+      phone2geo_frames.enrich_frame(enriched, 'phone', prefix='geo_').columns)
+
+  def test_enriches_integer_columns(self):
+    numbers = [2128675309, 9115555555, None, 1555555555]
+    frame = pandas.DataFrame({'phone': pandas.array(numbers, dtype='Int64')})
+    enriched = phone2geo_frames.enrich_frame(frame, 'phone')
+
+    self.assertMatchesLookups(
+      numbers,
+      enriched['status'].to_numpy(),
+      {name: enriched[name].tolist() for name in phone2geo_frames.METADATA_COLUMNS})
+
+  @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+  def test_enriches_arrow_tables(self):
+    table = pyarrow.concat_tables([
+      pyarrow.table({'phone': pyarrow.array(self.numbers[:5])}),
+      pyarrow.table({'phone': pyarrow.array(self.numbers[5:])}),
+    ])
+    enriched = phone2geo_frames.enrich_table(table, 'phone', chunk_size=3)
+
+    self.assertEqual(enriched.num_rows, len(self.numbers))
+    self.assertTrue(pyarrow.types.is_dictionary(enriched.schema.field('carrier').type))
+    self.assertMatchesLookups(
+      self.numbers,
+      enriched['status'].to_numpy(),
+      {name: enriched[name].to_pylist() for name in phone2geo_frames.METADATA_COLUMNS})
+    self.assertEqual(
+      enriched['status'].to_pylist()[-2:],
+      [phone2geo.LookupStatus.INVALID_NUMBER] * 2)
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,203 @@
+import dataclasses
+import os
+import sqlite3
+import threading
+import typing
+
+import numpy as np
+
+import phone2geo
+import phone2geo_build
+
+
+@dataclasses.dataclass(frozen=True)
+class EncodedColumn:
+  """A dictionary-encoded column. Each code indexes into categories, and a
+  code of -1 stands in for None."""
+
+  codes: np.ndarray
+  categories: typing.Tuple[str, ...]
+
+  def decode(self) -> np.ndarray:
+    """Expand the column into an object array of strings and None values"""
+
+    lookup = np.array(list(self.categories) + [None], dtype=object)
+    return lookup[self.codes]
+
+
+@dataclasses.dataclass(frozen=True)
+class ColumnarMetadata:
+  """Columnar counterpart of MetadataRecord for an array of numbers. Instead of
+  raising, failures are reported per number in status using LookupStatus
+  values, and every metadata column is -1 (None) for failed lookups."""
+
+  status: np.ndarray
+  country: EncodedColumn
+  time_zone: EncodedColumn
+  region: EncodedColumn
+  rate_center: EncodedColumn
+  operating_company_number: EncodedColumn
+  carrier: EncodedColumn
+
+
+class LookupTables:
+  """Dense NPA and NPA-NXX tables plus a sorted block table, all encoded
+  against shared per-column category lists, built from the carrier metadata
+  database."""
+
+  def __init__(self, db_path: str):
+    categories = {name: {} for name in (
+      'country', 'time_zone', 'region', 'rate_center',
+      'operating_company_number', 'carrier')}
+
+    def encode(column, value):
+      if value is None:
+        return -1
+      return categories[column].setdefault(value, len(categories[column]))
+
+    self.npa_status = np.full(
+      1000, phone2geo.LookupStatus.AREA_CODE_NOT_FOUND, dtype=np.uint8)
+    self.npa_is_us = np.zeros(1000, dtype=bool)
+    self.npa_country = np.full(1000, -1, dtype=np.int32)
+    self.npa_time_zone = np.full(1000, -1, dtype=np.int32)
+    self.npa_region = np.full(1000, -1, dtype=np.int32)
+    self.exchange_row = np.full(1000 * 1000, -1, dtype=np.int32)
+
+    conn = sqlite3.connect(db_path)
+    try:
+      for (area_code, usable, _, country, time_zone,
+          location) in phone2geo_build.scan_area_codes(conn):
+        if not usable:
+          self.npa_status[area_code] = phone2geo.LookupStatus.INVALID_AREA_CODE
+          continue
+
+        self.npa_status[area_code] = phone2geo.LookupStatus.OK
+        self.npa_is_us[area_code] = country == 'US'
+        self.npa_country[area_code] = encode('country', country)
+        self.npa_time_zone[area_code] = encode('time_zone', time_zone)
+        self.npa_region[area_code] = encode('region', location)
+
+      exchanges = [
+        (key, *self.__encode_geography(encode, values))
+        for key, *values in phone2geo_build.scan_exchanges(conn)
+      ]
+      blocks = [
+        (key * 10 + x, *self.__encode_geography(encode, values))
+        for key, x, *values in phone2geo_build.scan_blocks(conn)
+      ]
+    finally:
+      conn.close()
+
+    (self.exchange_key, self.exchange_region, self.exchange_rate_center,
+      self.exchange_ocn, self.exchange_carrier) = self.__columns(exchanges)
+    self.exchange_row[self.exchange_key] = np.arange(
+      len(self.exchange_key), dtype=np.int32)
+
+    (self.block_key, self.block_region, self.block_rate_center,
+      self.block_ocn, self.block_carrier) = self.__columns(blocks)
+
+    self.categories = {
+      name: tuple(values) for name, values in categories.items()
+    }
+
+  @staticmethod
+  def __encode_geography(encode, values):
+    region, rate_center, ocn, carrier = values
+    return (
+      encode('region', region),
+      encode('rate_center', rate_center),
+      encode('operating_company_number', ocn),
+      encode('carrier', carrier)
+    )
+
+  @staticmethod
+  def __columns(rows):
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 5)
+    return (rows[:, 0],) + tuple(
+      rows[:, col].astype(np.int32) for col in range(1, 5))
+
+
+__tables_lock = threading.Lock()
+__tables = {}
+
+
+def load_tables(db_path: str = phone2geo.DEFAULT_DB_PATH) -> LookupTables:
+  """Return lookup tables for the database at db_path. Tables are built once
+  and shared until the database file is replaced."""
+
+  stat = os.stat(db_path)
+  signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+  with __tables_lock:
+    cached = __tables.get(db_path)
+    if cached is None or cached[0] != signature:
+      cached = (signature, LookupTables(db_path))
+      __tables[db_path] = cached
+    return cached[1]
+
+
+def locate_array(
+  numbers: np.ndarray,
+  tables: typing.Optional[LookupTables] = None
+) -> ColumnarMetadata:
+  """Resolve an array of 10-digit numbers with array indexing alone. Numbers
+  outside the NANP format are reported as LookupStatus.INVALID_NUMBER."""
+
+  if tables is None:
+    tables = load_tables()
+
+  numbers = np.asarray(numbers, dtype=np.int64)
+  status = np.full(
+    numbers.shape, phone2geo.LookupStatus.INVALID_NUMBER, dtype=np.uint8)
+  well_formed = (numbers >= 2000000000) & (numbers <= 9999999999)
+
+  area_code = np.where(well_formed, numbers // 10000000, 0)
+  status[well_formed] = tables.npa_status[area_code[well_formed]]
+  usable = status == phone2geo.LookupStatus.OK
+
+  country = np.where(usable, tables.npa_country[area_code], -1)
+  time_zone = np.where(usable, tables.npa_time_zone[area_code], -1)
+  region = np.where(usable, tables.npa_region[area_code], -1)
+  rate_center = np.full(numbers.shape, -1, dtype=np.int32)
+  ocn = np.full(numbers.shape, -1, dtype=np.int32)
+  carrier = np.full(numbers.shape, -1, dtype=np.int32)
+
+  us = usable & tables.npa_is_us[area_code]
+  exchange_row = np.where(
+    us, tables.exchange_row[np.where(us, numbers // 10000, 0)], -1)
+
+  invalid_exchange = us & (exchange_row < 0)
+  status[invalid_exchange] = phone2geo.LookupStatus.INVALID_EXCHANGE
+  for column in (country, time_zone, region):
+    column[invalid_exchange] = -1
+
+  found = np.nonzero(exchange_row >= 0)[0]
+  rows = exchange_row[found]
+  region[found] = tables.exchange_region[rows]
+  rate_center[found] = tables.exchange_rate_center[rows]
+  ocn[found] = tables.exchange_ocn[rows]
+  carrier[found] = tables.exchange_carrier[rows]
+
+  # Pooled blocks override the exchange-level assignment
+  block_key = numbers[found] // 1000
+  position = np.searchsorted(tables.block_key, block_key)
+  position = np.minimum(position, max(len(tables.block_key) - 1, 0))
+  if len(tables.block_key) > 0:
+    pooled = tables.block_key[position] == block_key
+    found, position = found[pooled], position[pooled]
+    region[found] = tables.block_region[position]
+    rate_center[found] = tables.block_rate_center[position]
+    ocn[found] = tables.block_ocn[position]
+    carrier[found] = tables.block_carrier[position]
+
+  def column(codes, name):
+    return EncodedColumn(codes.astype(np.int32), tables.categories[name])
+
+  return ColumnarMetadata(
+    status,
+    column(country, 'country'),
+    column(time_zone, 'time_zone'),
+    column(region, 'region'),
+    column(rate_center, 'rate_center'),
+    column(ocn, 'operating_company_number'),
+    column(carrier, 'carrier')
+  )